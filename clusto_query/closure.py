@@ -0,0 +1,119 @@
+import collections
+
+
+def transitive_closure(forward_map, roots=None, closure=None):
+    """Flatten a parent -> children map into parent -> all descendants
+
+    forward_map maps each parent to an iterable of its direct children;
+    anything that isn't a key has no children. The graph may have cycles, in
+    which case every member of a cycle is its own descendant.
+
+    Strongly-connected components are found with (iterative) Tarjan, which
+    emits them children-first, so each component's descendant set is built
+    once from its children's already-finished sets and shared by all of its
+    members.
+
+    If closure is given, its entries are taken as already finished and only
+    what's reachable from roots (default: every parent) that isn't in it
+    is added.
+
+    Returns a dict mapping each key of forward_map to a frozenset.
+    """
+    if closure is None:
+        closure = {}
+    finished = set(closure)
+    if roots is None:
+        roots = forward_map
+    index_of = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    counter = 0
+
+    for root in roots:
+        if root in index_of or root in finished:
+            continue
+        index_of[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(forward_map[root]))]
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child in finished:
+                    continue
+                elif child not in index_of:
+                    index_of[child] = lowlink[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(forward_map.get(child, ()))))
+                    break
+                elif child in on_stack:
+                    lowlink[node] = min(lowlink[node], index_of[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index_of[node]:
+                    _close_component(node, stack, on_stack, forward_map, closure)
+    return closure
+
+
+def update_closure(forward_map, closure, changed):
+    """Bring closure up to date after the children of the parents in changed changed
+
+    closure is the transitive_closure of forward_map as it was before; it's
+    updated in place. Only the entries of changed parents and of their
+    ancestors can differ, so only those are rebuilt.
+
+    Returns the set of parents whose entries were rebuilt.
+    """
+    parents_of = collections.defaultdict(set)
+    for parent, children in forward_map.iteritems():
+        for child in children:
+            parents_of[child].add(parent)
+    # anything that was an ancestor before the change is still an ancestor
+    # of some changed parent afterwards
+    affected = set()
+    pending = list(changed)
+    while pending:
+        node = pending.pop()
+        if node not in affected:
+            affected.add(node)
+            pending.extend(parents_of.get(node, ()))
+    for node in affected:
+        closure.pop(node, None)
+    transitive_closure(forward_map, [n for n in affected if n in forward_map], closure)
+    return affected
+
+
+def _close_component(root, stack, on_stack, forward_map, closure):
+    component = []
+    while True:
+        member = stack.pop()
+        on_stack.discard(member)
+        component.append(member)
+        if member == root:
+            break
+    if len(component) == 1 and root not in forward_map:
+        # a leaf; nothing to record
+        return
+
+    members = set(component)
+    descendants = set()
+    for member in component:
+        for child in forward_map.get(member, ()):
+            if child in members:
+                continue
+            descendants.add(child)
+            descendants.update(closure.get(child, ()))
+    if len(component) > 1 or root in forward_map[root]:
+        descendants.update(members)
+
+    descendants = frozenset(descendants)
+    for member in component:
+        if member in forward_map:
+            closure[member] = descendants
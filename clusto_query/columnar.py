@@ -0,0 +1,225 @@
+"""Evaluate queries as NumPy boolean arrays over every entity
+
+Entities are numbered by the Context's HostIds. An attribute's values across
+all of them are stored as a Column: one row per (flattened) value, with
+the id of the entity it belongs to and a code into the attribute's
+distinct values. A comparison is made once per distinct value and the
+result spread over the rows and then the entities with array operations,
+so any/all over multi-valued attributes work the same as they do in
+InfixOperator.run. and/or/-/not are &, | and ~ over the entity masks, and
+a PushedDownQuery's SQL prefilter narrows the mask of what it wraps.
+
+Clauses that aren't about attributes, or whose values can't be compared
+up front, are run the usual way over the hosts still in play.
+
+numpy is optional; nothing here works without it (see HAVE_NUMPY).
+"""
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import clusto_query.optimizer
+from clusto_query.index import is_number
+from clusto_query.query import QueryObject
+from clusto_query.query.objects import Attribute
+from clusto_query.query.operator.affix import ExistsOperator, InfixOperator, RangeOperator, Between, flatten
+from clusto_query.query.operator.boolean import Intersection, Union, Subtraction, Not
+from clusto_query.pushdown import PushedDownQuery
+
+
+log = logging.getLogger("clusto-query-logger")
+
+HAVE_NUMPY = numpy is not None
+
+# numbers beyond this can't all be held exactly as float64
+_EXACT_FLOAT_LIMIT = 2 ** 53
+
+
+def _exactly_float(value):
+    return is_number(value) and abs(value) < _EXACT_FLOAT_LIMIT
+
+
+class Column(object):
+    """ The values of one attribute for every entity, dictionary-encoded """
+
+    def __init__(self, owners, codes, uniques):
+        # entity id and distinct value of each row
+        self.owners = numpy.array(owners, dtype=numpy.intp)
+        self.codes = numpy.array(codes, dtype=numpy.intp)
+        self.uniques = uniques
+        # the distinct values that can be compared as float64 without losing anything
+        self.numeric = numpy.array([_exactly_float(u) for u in uniques], dtype=bool)
+        self.numbers = numpy.array([u if n else 0 for u, n in zip(uniques, self.numeric)], dtype=numpy.float64)
+
+    def compare(self, clause):
+        """ Whether each distinct value satisfies clause, or None if that can't be worked out up front """
+        rhs = clause.rhs
+        truth = numpy.zeros(len(self.uniques), dtype=bool)
+        pending = xrange(len(self.uniques))
+        if isinstance(clause, RangeOperator) and _exactly_float(rhs):
+            truth[self.numeric] = clause.comparator(self.numbers[self.numeric], rhs)
+            pending = numpy.flatnonzero(~self.numeric)
+        comparator = clause.comparator
+        try:
+            for code in pending:
+                truth[code] = bool(comparator(self.uniques[code], rhs))
+        except Exception:
+            # some host may have a value that can't be compared; that's
+            # only an error if it's one of the candidates
+            return None
+        return truth
+
+
+class ColumnStore(object):
+    """ Columns for a Context, over the ids of host_ids, built as they're needed """
+
+    def __init__(self, context, host_ids):
+        self.context = context
+        self.keys = host_ids.hosts
+        self.id_of = host_ids.ids
+        self.columns = {}
+
+    def mask_of(self, hosts):
+        mask = numpy.zeros(len(self.keys), dtype=bool)
+        mask[[self.id_of[h] for h in hosts]] = True
+        return mask
+
+    def hosts_of(self, mask):
+        keys = self.keys
+        return [keys[i] for i in numpy.flatnonzero(mask)]
+
+    def column(self, attribute):
+        """ The Column of attribute, or None if its values aren't all loaded or can't be encoded """
+        column_key = (attribute.key, attribute.subkey or None, attribute.number)
+        if column_key not in self.columns:
+            self.columns[column_key] = self._build_column(attribute)
+        return self.columns[column_key]
+
+    def forget(self, key):
+        """ Drop the Columns of every subkey and number of key """
+        for column_key in [k for k in self.columns if k[0] == key]:
+            del self.columns[column_key]
+
+    def _build_column(self, attribute):
+        context = self.context
+        context.prefetch_attributes([attribute])
+        if not context.attribute_loaded(attribute):
+            return None
+        key, subkey, number = attribute.key, attribute.subkey or None, attribute.number
+        owners = []
+        codes = []
+        uniques = []
+        code_of = {}
+        for entity_id, host in enumerate(self.keys):
+            values = context.attribute_values(host, key, subkey)
+            for value in flatten([v.value for v in values if number is None or v.number == number]):
+                # 1, 1.0 and True are equal but don't compare the same as strings
+                marker = (type(value), value)
+                try:
+                    code = code_of.get(marker)
+                except TypeError:
+                    return None
+                if code is None:
+                    code = code_of[marker] = len(uniques)
+                    uniques.append(value)
+                owners.append(entity_id)
+                codes.append(code)
+        return Column(owners, codes, uniques)
+
+    def _clause_mask(self, clause):
+        """ The entities clause matches, or None if it has to be run host by host """
+        if not isinstance(clause.lhs, Attribute):
+            return None
+        column = self.column(clause.lhs)
+        if column is None:
+            return None
+        if isinstance(clause, ExistsOperator):
+            truth = numpy.ones(len(column.uniques), dtype=bool)
+            satisfy_all = False
+        else:
+            truth = column.compare(clause)
+            if truth is None:
+                return None
+            satisfy_all = clause.satisfy_all()
+        rows = truth[column.codes]
+        if satisfy_all:
+            mask = numpy.ones(len(self.keys), dtype=bool)
+            mask[column.owners[~rows]] = False
+        else:
+            mask = numpy.zeros(len(self.keys), dtype=bool)
+            mask[column.owners[rows]] = True
+        return mask
+
+    def evaluate(self, query, candidates):
+        """ The mask of the entities in the candidates mask that query matches """
+        optimizer = clusto_query.optimizer
+        if isinstance(query, Intersection):
+            mask = candidates
+            for clause in optimizer.sort_clauses(optimizer.merge_ranges(query.operands()), self.context):
+                mask = self.evaluate(clause, mask)
+                if not mask.any():
+                    break
+            return mask
+        elif isinstance(query, Union):
+            mask = numpy.zeros(len(self.keys), dtype=bool)
+            remaining = candidates
+            for p in query.parameters:
+                matched = self.evaluate(p, remaining)
+                mask |= matched
+                remaining = remaining & ~matched
+                if not remaining.any():
+                    break
+            return mask
+        elif isinstance(query, Subtraction):
+            mask = self.evaluate(query.parameters[0], candidates)
+            for p in query.parameters[1:]:
+                if not mask.any():
+                    break
+                mask = mask & ~self.evaluate(p, mask)
+            return mask
+        elif isinstance(query, Not):
+            return candidates & ~self.evaluate(query.parameters[0], candidates)
+        elif isinstance(query, Between):
+            return self.evaluate(query.upper, self.evaluate(query.lower, candidates))
+        elif isinstance(query, optimizer.SharedQuery):
+            return self.evaluate(query.query, candidates)
+        elif isinstance(query, PushedDownQuery):
+            if not candidates.any():
+                return candidates
+            return self.evaluate(query.query, candidates & self.mask_of(query.prefiltered(self.context)))
+        elif isinstance(query, (ExistsOperator, InfixOperator)):
+            mask = self._clause_mask(query)
+            if mask is not None:
+                return candidates & mask
+        if not candidates.any():
+            return candidates
+        return self.mask_of(query.run(self.hosts_of(candidates), self.context))
+
+
+class ColumnarQuery(QueryObject):
+    """ Runs query over the Context's ColumnStore """
+
+    def __init__(self, query):
+        self.query = query
+
+    def __repr__(self):
+        return "ColumnarQuery(%r)" % (self.query,)
+
+    def run(self, candidate_hosts, context):
+        store = context.column_store()
+        return set(store.hosts_of(store.evaluate(self.query, store.mask_of(candidate_hosts))))
+
+    def visit_iter(self):
+        yield self
+        for p in self.query.visit_iter():
+            yield p
+
+
+def columnar_query(query):
+    """ Wrap query so that running it evaluates it over NumPy arrays """
+    if not HAVE_NUMPY:
+        raise ImportError('numpy is needed to evaluate queries over columns')
+    return ColumnarQuery(query)
@@ -0,0 +1,275 @@
+"""Compile a query into one predicate that's checked against each host in a single pass
+
+Every node becomes a function of a host, bound to a Context and the
+candidate hosts up front. Clauses an index can answer are looked up once
+and become a set membership test; anything else is checked host by host
+with its property lookup and comparison bound directly, without going
+through InfixOperator.run. Boolean operators short-circuit, so a host is
+only checked against the clauses that can still change its answer.
+
+The indexed clauses of an and are looked up first, and the rest compiled
+against only the hosts those leave, so that whatever they prefetch or
+index is narrowed the same way Intersection.run narrows it.
+
+This gives exactly the same answers as running the query, which is
+kept as the way to check that.
+"""
+import itertools
+import logging
+
+import clusto_query.optimizer
+from clusto_query.query import QueryObject
+from clusto_query.query.objects import Attribute
+from clusto_query.query.operator.affix import (ExistsOperator, InfixOperator, Equality, Between,
+                                               flatten, _extract_name_from_key, _load_for, _restrict)
+from clusto_query.query.operator.boolean import Intersection, Union, Subtraction, Not
+from clusto_query.pushdown import PushedDownQuery
+from clusto_query.hostset import HostSet
+
+
+log = logging.getLogger("clusto-query-logger")
+
+
+def _never(host):
+    return False
+
+
+def _all(predicates):
+    if not predicates:
+        return lambda host: True
+    elif len(predicates) == 1:
+        return predicates[0]
+    elif len(predicates) == 2:
+        first, second = predicates
+        return lambda host: first(host) and second(host)
+
+    def predicate(host):
+        for p in predicates:
+            if not p(host):
+                return False
+        return True
+    return predicate
+
+
+def _any(predicates):
+    if not predicates:
+        return _never
+    elif len(predicates) == 1:
+        return predicates[0]
+    elif len(predicates) == 2:
+        first, second = predicates
+        return lambda host: first(host) or second(host)
+
+    def predicate(host):
+        for p in predicates:
+            if p(host):
+                return True
+        return False
+    return predicate
+
+
+def _attribute_values(attribute, context):
+    """ A function returning the flattened values of attribute for a host """
+    key, subkey, number = attribute.key, attribute.subkey or None, attribute.number
+    attribute_values = context.attribute_values
+    get = attribute.get
+
+    def values(host):
+        prefetched = attribute_values(host, key, subkey)
+        if prefetched is None:
+            return flatten(get(host, context).values())
+        return flatten([v.value for v in prefetched if number is None or v.number == number])
+    return values
+
+
+def _property(prop, context):
+    """ (function returning prop for a host, whether it returns a list of values) """
+    if isinstance(prop, Attribute):
+        return _attribute_values(prop, context), True
+    elif prop == "clusto_type":
+        return (lambda host: host.item_type), False
+    elif prop == "name":
+        return (lambda host: host.name), False
+    elif prop == "role":
+        return context.role_for_host, False
+    elif prop in context.CONTEXT_TYPES:
+        parents = context.context
+        return (lambda host: map(_extract_name_from_key, parents(prop, host))), True
+    entity_map = context.entity_map
+    return (lambda host: getattr(entity_map[host], prop)), None
+
+
+def _comparison(clause):
+    """ A function comparing one value against clause's rhs """
+    rhs = clause.rhs
+    if isinstance(clause, Equality):
+        try:
+            rhs_text = str(rhs)
+        except Exception:
+            # let the comparison raise when (if) it's actually made
+            pass
+        else:
+            return lambda value: str(value) == rhs_text
+    comparator = clause.comparator
+    return lambda value: comparator(value, rhs)
+
+
+def _compile_exists(clause, candidate_hosts, context):
+    _load_for(clause.lhs, candidate_hosts, context)
+    extract, _ = _property(clause.lhs, context)
+    return lambda host: bool(extract(host))
+
+
+def _compile_infix(clause, candidate_hosts, context):
+    _load_for(clause.lhs, candidate_hosts, context)
+    extract, is_list = _property(clause.lhs, context)
+    compare = _comparison(clause)
+    satisfy_all = clause.satisfy_all()
+
+    def predicate(host):
+        # only looking the property up is allowed to rule a host out this way
+        try:
+            values = extract(host)
+        except AttributeError:
+            return False
+        if is_list is False:
+            return compare(values)
+        if is_list is None and not isinstance(values, (list, set, tuple)):
+            return compare(values)
+        if satisfy_all:
+            for value in values:
+                if not compare(value):
+                    return False
+            return True
+        for value in values:
+            if compare(value):
+                return True
+        return False
+    return predicate
+
+
+def _compile_shared(query, candidate_hosts, context):
+    inner = compile_predicate(query.query, candidate_hosts, context)
+    if context.subquery_results is None:
+        return inner
+    checked, matched = context.subquery_results.setdefault(query.key, (set(), set()))
+
+    def predicate(host):
+        if host in checked:
+            return host in matched
+        result = inner(host)
+        checked.add(host)
+        if result:
+            matched.add(host)
+        return result
+    return predicate
+
+
+def _compile_pushed_down(query, candidate_hosts, context):
+    if not isinstance(candidate_hosts, (set, frozenset, HostSet)):
+        candidate_hosts = set(candidate_hosts)
+    hosts = set(h for h in query.prefiltered(context) if h in candidate_hosts)
+    if not hosts:
+        return _never
+    inner = compile_predicate(query.query, hosts, context)
+    return lambda host: host in hosts and inner(host)
+
+
+def _lookup(clause, candidate_hosts, context):
+    """ The members of candidate_hosts clause matches, if an index can answer it; otherwise None """
+    if isinstance(clause, Between):
+        index = context.value_index(clause.lower.lhs, candidate_hosts)
+        if index is not None and index.single_valued:
+            return _restrict(index.between(clause.lower.rhs, clause.lower.inclusive,
+                                           clause.upper.rhs, clause.upper.inclusive),
+                             candidate_hosts)
+        return None
+    elif isinstance(clause, (ExistsOperator, InfixOperator)):
+        return clause.lookup(candidate_hosts, context)
+    return None
+
+
+def _compile_intersection(query, candidate_hosts, context):
+    optimizer = clusto_query.optimizer
+    clauses = optimizer.sort_clauses(optimizer.merge_ranges(query.operands()), context)
+    narrowed = None
+    rest = []
+    for clause in clauses:
+        indexed = _lookup(clause, candidate_hosts if narrowed is None else narrowed, context)
+        if indexed is None:
+            rest.append(clause)
+        elif not indexed:
+            return _never
+        else:
+            narrowed = indexed
+    if narrowed is None:
+        return _all([compile_predicate(c, candidate_hosts, context) for c in rest])
+    return _all([narrowed.__contains__] + [compile_predicate(c, narrowed, context) for c in rest])
+
+
+def _compile_between(clause, candidate_hosts, context):
+    indexed = _lookup(clause, candidate_hosts, context)
+    if indexed is not None:
+        return indexed.__contains__
+    return _all([compile_predicate(clause.lower, candidate_hosts, context),
+                 compile_predicate(clause.upper, candidate_hosts, context)])
+
+
+def compile_predicate(query, candidate_hosts, context):
+    """ Return a function of a host that's true if query.run(candidate_hosts, context) would return it
+
+    The function must only be called with members of candidate_hosts.
+    """
+    optimizer = clusto_query.optimizer
+    if isinstance(query, Intersection):
+        return _compile_intersection(query, candidate_hosts, context)
+    elif isinstance(query, Union):
+        return _any([compile_predicate(p, candidate_hosts, context) for p in query.parameters])
+    elif isinstance(query, Subtraction):
+        first = compile_predicate(query.parameters[0], candidate_hosts, context)
+        rest = _any([compile_predicate(p, candidate_hosts, context) for p in query.parameters[1:]])
+        return lambda host: first(host) and not rest(host)
+    elif isinstance(query, Not):
+        inner = compile_predicate(query.parameters[0], candidate_hosts, context)
+        return lambda host: not inner(host)
+    elif isinstance(query, optimizer.SharedQuery):
+        return _compile_shared(query, candidate_hosts, context)
+    elif isinstance(query, PushedDownQuery):
+        return _compile_pushed_down(query, candidate_hosts, context)
+    elif isinstance(query, Between):
+        return _compile_between(query, candidate_hosts, context)
+    elif isinstance(query, (ExistsOperator, InfixOperator)):
+        indexed = _lookup(query, candidate_hosts, context)
+        if indexed is not None:
+            return indexed.__contains__
+        if isinstance(query, ExistsOperator):
+            return _compile_exists(query, candidate_hosts, context)
+        return _compile_infix(query, candidate_hosts, context)
+    # anything else is run as it is
+    return query.run(candidate_hosts, context).__contains__
+
+
+class CompiledQuery(QueryObject):
+    """ Runs query by compiling it to a predicate and filtering the candidate hosts with it """
+
+    def __init__(self, query):
+        self.query = query
+
+    def __repr__(self):
+        return "CompiledQuery(%r)" % (self.query,)
+
+    def run(self, candidate_hosts, context):
+        predicate = compile_predicate(self.query, candidate_hosts, context)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Compiled %r', self.query)
+        return set(itertools.ifilter(predicate, candidate_hosts))
+
+    def visit_iter(self):
+        yield self
+        for p in self.query.visit_iter():
+            yield p
+
+
+def compile_query(query):
+    """ Wrap query so that running it checks every host against one compiled predicate """
+    return CompiledQuery(query)
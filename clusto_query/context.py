@@ -1,14 +1,40 @@
 import collections
+import itertools
 
-from . import clusto_types
+import clusto
+from clusto.drivers.base.device import Device
 
-try:
-    from clusto import adjacency_map
-except:
-    from .clusto_backport import adjacency_map
+from . import clusto_types
+from . import columnar
+from .closure import transitive_closure, update_closure
+from .hostset import HostIds
+from .index import SortedValueIndex, AffixIndex, TrigramIndex, AddressIndex
+from . import loader
+from . import optimizer
+from . import settings
+from .query.objects import Attribute, parse_address
+from .query.operator.affix import flatten
 
 
 ContextKey = collections.namedtuple('ContextKey', ['item_type', 'name'])
+AttributeValue = collections.namedtuple('AttributeValue', ['key', 'subkey', 'number', 'value'])
+# how many values and hosts an attribute has, and how many distinct values
+AttributeCounts = collections.namedtuple('AttributeCounts', ['values', 'entities', 'distinct_values'])
+
+# candidate sets up to this size have their attributes prefetched with
+# batched IN (...) queries instead of loading every value for the key
+PREFETCH_MAX_BATCHED_HOSTS = 5000
+PREFETCH_BATCH_SIZE = 500
+
+# a context more than this many rows behind clusto is rebuilt rather than refreshed
+REFRESH_MAX_CHANGES = 20000
+
+# a restored context at the same version has to have loaded at least this
+# many rows from clusto to be worth rewriting the whole snapshot for
+SNAPSHOT_MIN_NEW_ROWS = 5000
+
+POOLTYPE_ATTRIBUTE = Attribute('pooltype', None, None)
+HOSTNAME_ATTRIBUTE = Attribute('hostname', None, None)
 
 
 def _generate_key(clusto_item):
@@ -16,23 +42,423 @@ def _generate_key(clusto_item):
     return ContextKey(clusto_item._clusto_type, clusto_item.name)
 
 
+class EntityMap(collections.Mapping):
+    """ Maps ContextKeys to clusto Drivers, fetching Drivers only when needed
+
+    Looking up a Driver that hasn't been fetched yet fetches just that one;
+    use load() to fetch many in one go.
+    """
+    LOAD_BATCH_SIZE = 500
+
+    def __init__(self, clusto_proxy, drivers=(), keys=(), driver_names=None, entity_types=None):
+        self.clusto_proxy = clusto_proxy
+        # the clusto types of everything in the map, if it's only some
+        self.entity_types = entity_types
+        self._drivers = dict((k, None) for k in keys)
+        self._drivers.update((_generate_key(e), e) for e in drivers)
+        self._missing = sum(1 for d in self._drivers.itervalues() if d is None)
+        # key -> the name its Driver class is registered under, where known
+        self.driver_names = {} if driver_names is None else driver_names
+
+    @classmethod
+    def from_table(cls, clusto_proxy, entity_types=None):
+        """ An EntityMap of every live entity (of entity_types), read from ENTITY_TABLE without fetching a Driver """
+        driver_names = dict((ContextKey(row.type, row.name), row.driver) for row in loader.entities(entity_types))
+        return cls(clusto_proxy, keys=driver_names.iterkeys(), driver_names=driver_names, entity_types=entity_types)
+
+    def _add(self, entities):
+        for e in entities:
+            key = _generate_key(e)
+            if self._drivers.get(key, False) is None:
+                self._drivers[key] = e
+                self._missing -= 1
+
+    def load(self, keys=None):
+        """ Fetch the Drivers for keys (or for everything) that aren't loaded yet """
+        if not self._missing:
+            return
+        if keys is None:
+            if self.entity_types is None:
+                self._add(self.clusto_proxy.get_entities())
+            else:
+                self._add(self.clusto_proxy.get_entities(clusto_types=list(self.entity_types)))
+            return
+        names = [k.name for k in keys if self._drivers.get(k, False) is None]
+        for offset in xrange(0, len(names), self.LOAD_BATCH_SIZE):
+            self._add(self.clusto_proxy.get_entities(names=names[offset:offset + self.LOAD_BATCH_SIZE]))
+
+    def add_keys(self, keys, driver_names=None):
+        """ Add keys whose Drivers will be fetched when needed """
+        for key in keys:
+            if key not in self._drivers:
+                self._drivers[key] = None
+                self._missing += 1
+        if driver_names:
+            self.driver_names.update(driver_names)
+
+    def remove_keys(self, keys):
+        for key in keys:
+            self.driver_names.pop(key, None)
+            if key in self._drivers and self._drivers.pop(key) is None:
+                self._missing -= 1
+
+    def forget(self, keys):
+        """ Drop the Drivers fetched for keys so they're fetched again """
+        for key in keys:
+            if self._drivers.get(key) is not None:
+                self._drivers[key] = None
+                self._missing += 1
+
+    def __getitem__(self, key):
+        driver = self._drivers[key]
+        if driver is None:
+            self.load([key])
+            driver = self._drivers[key]
+            if driver is None:
+                raise KeyError(key)
+        return driver
+
+    def driver_class(self, key):
+        """ The Driver class of key, fetching its Driver only if the class isn't known otherwise """
+        driver = self._drivers[key]
+        if driver is None:
+            driver_class = clusto.driverlist.get(self.driver_names.get(key))
+            if driver_class is not None:
+                return driver_class
+            driver = self[key]
+        return type(driver)
+
+    def __contains__(self, key):
+        return key in self._drivers
+
+    def __iter__(self):
+        return iter(self._drivers)
+
+    def __len__(self):
+        return len(self._drivers)
+
+    def keys(self):
+        return self._drivers.keys()
+
+
 class Context(object):
     """ Context for a clusto query. """
     CONTEXT_TYPES = clusto_types.CONTEXT_TYPES
 
-    def __init__(self, clusto_proxy):
+    def __init__(self, clusto_proxy, snapshot=None, entity_types=None):
+        """ entity_types limits the entities loaded to those clusto types; such a context can't be snapshotted """
         self.clusto_proxy = clusto_proxy
-        self.entity_map = dict((_generate_key(e), e)
-                               for e in clusto_proxy.get_entities())
-        self.context_dict = None
+        self.entity_types = None if entity_types is None else frozenset(entity_types)
+        # direct parent -> children for parents of CONTEXT_TYPES, and its
+        # closure; that's only complete for parents of the closed_types
+        self.forward_map = None
+        self.contents_dict = None
+        self.closed_types = None
+        self.members_by_type = None
+        # type -> child -> its parents of that type, for closed types as they're needed
+        self.context_dict = {}
+        self._role_index = None
+        # (key, subkey) -> {host: [AttributeValue]}; a subkey of None holds every subkey
+        self.attribute_map = {}
+        # (key, subkey) -> set of hosts loaded so far, or None once every host is loaded
+        self.attribute_hosts = {}
+        self._keys_by_name = None
+        # (key, subkey, number) -> SortedValueIndex
+        self._value_indexes = {}
+        # 'name'/'hostname' -> AffixIndex, or None if it can't be indexed
+        self._affix_indexes = {}
+        # 'name'/'hostname'/(key, subkey, number) -> TrigramIndex, or None if it can't be indexed
+        self._trigram_indexes = {}
+        self._type_index = None
+        # (key, subkey, number) -> AddressIndex, or None if it can't be indexed
+        self._address_indexes = {}
+        # key -> {subkey: AttributeCounts}, for the optimizer
+        self._attribute_counts = {}
+        self._type_counts = None
+        # HostIds of entity_map, and the columnar.ColumnStore built on them
+        self._host_ids = None
+        self._column_store = None
+        # only while run_query is running: canonical key -> (hosts checked,
+        # hosts matched) for each SharedQuery, and memoized Attribute.get results
+        self.subquery_results = None
+        self.attribute_results = None
+        if snapshot is None:
+            # the clusto version this reflects, if clusto is versioned
+            self.version = None
+            if clusto_proxy.SESSION.clusto_versioning_enabled:
+                self.version = clusto_proxy.get_latest_version_number()
+            self.entity_map = EntityMap.from_table(clusto_proxy, self.entity_types)
+            # whether this holds anything a saved snapshot doesn't
+            self.modified = True
+        else:
+            self._restore(snapshot)
+            self.modified = False
+        # the version of the snapshot this was restored from, and how many
+        # rows have been loaded from clusto since
+        self.snapshot_version = None if snapshot is None else self.version
+        self.unsaved_rows = 0
+
+    def to_snapshot(self):
+        """ Return the loaded state of this context as plain picklable data
+
+        Hosts are stored as indexes into the list of entity keys.
+        """
+        if self.entity_types is not None:
+            raise ValueError("Can't snapshot a context of only %s" % ', '.join(sorted(self.entity_types)))
+        keys = [tuple(k) for k in self.entity_map]
+        entity_count = len(keys)
+        index = dict((k, i) for i, k in enumerate(keys))
+
+        def index_of(key):
+            # parents/children that aren't in entity_map still need an index
+            if key not in index:
+                index[key] = len(keys)
+                keys.append(tuple(key))
+            return index[key]
+
+        def encode_map(parent_map):
+            if parent_map is None:
+                return None
+            return dict(
+                (index_of(parent), [index_of(c) for c in children])
+                for parent, children in parent_map.iteritems()
+            )
+        attribute_map = dict(
+            (store_key, dict((index[host], [tuple(v) for v in values])
+                             for host, values in values_by_host.iteritems()))
+            for store_key, values_by_host in self.attribute_map.iteritems()
+        )
+        attribute_hosts = dict(
+            (store_key, None if hosts is None else [index[h] for h in hosts])
+            for store_key, hosts in self.attribute_hosts.iteritems()
+        )
+        forward_map = encode_map(self.forward_map)
+        contents_dict = encode_map(self.contents_dict)
+        return {
+            'version': self.version,
+            'entity_keys': keys,
+            'entity_count': entity_count,
+            'entity_drivers': [self.entity_map.driver_names.get(k) for k in keys[:entity_count]],
+            'forward_map': forward_map,
+            'contents_dict': contents_dict,
+            'closed_types': None if self.closed_types is None else sorted(self.closed_types),
+            'attribute_map': attribute_map,
+            'attribute_hosts': attribute_hosts,
+            'attribute_counts': self._attribute_counts,
+        }
+
+    def worth_saving(self):
+        """ Whether this holds enough that its snapshot doesn't to be worth rewriting it
+
+        That's anything not restored from a snapshot, anything refreshed to a
+        newer version, and anything that's loaded SNAPSHOT_MIN_NEW_ROWS rows
+        since; less than that is quicker to load again than to save.
+        """
+        if not self.modified:
+            return False
+        if self.snapshot_version is None or self.version != self.snapshot_version:
+            return True
+        return self.unsaved_rows >= SNAPSHOT_MIN_NEW_ROWS
+
+    def _restore(self, snapshot):
+        keys = [ContextKey(*k) for k in snapshot['entity_keys']]
+        self.version = snapshot['version']
+        entity_keys = keys[:snapshot['entity_count']]
+        driver_names = dict((k, d) for k, d in itertools.izip(entity_keys, snapshot['entity_drivers']) if d is not None)
+        self.entity_map = EntityMap(self.clusto_proxy, keys=entity_keys, driver_names=driver_names)
+        if snapshot['contents_dict'] is not None:
+            self.forward_map = dict(
+                (keys[parent], set(keys[c] for c in children))
+                for parent, children in snapshot['forward_map'].iteritems()
+            )
+            self._set_contents(dict(
+                (keys[parent], frozenset(keys[c] for c in children))
+                for parent, children in snapshot['contents_dict'].iteritems()
+            ), snapshot['closed_types'])
+        for store_key, values_by_host in snapshot['attribute_map'].iteritems():
+            self.attribute_map[store_key] = dict(
+                (keys[host], [AttributeValue(*v) for v in values])
+                for host, values in values_by_host.iteritems()
+            )
+        for store_key, hosts in snapshot['attribute_hosts'].iteritems():
+            self.attribute_hosts[store_key] = None if hosts is None else set(keys[h] for h in hosts)
+        self._attribute_counts = snapshot['attribute_counts']
+
+    def run_query(self, query, hosts=None):
+        """ Run query over hosts (or every host), memoizing lookups until it's done """
+        return self.run_queries([query], hosts)[0]
+
+    def run_queries(self, queries, hosts=None):
+        """ Run each of queries over hosts (or every host), sharing memoized lookups between them
+
+        Attributes that more than one of the queries looks at are loaded
+        for every host up front, in one go.
+        """
+        if hosts is None:
+            hosts = self.entity_map.keys()
+        if len(queries) > 1:
+            seen = collections.Counter()
+            for query in queries:
+                seen.update(set((p.key, p.subkey or None) for p in query.visit_iter() if isinstance(p, Attribute)))
+            self.prefetch_attributes([Attribute(key, subkey, None) for (key, subkey), n in seen.iteritems() if n > 1])
+        self.subquery_results = {}
+        self.attribute_results = {}
+        try:
+            return [query.run(hosts, self) for query in queries]
+        finally:
+            self.subquery_results = None
+            self.attribute_results = None
+
+    def refresh(self, version):
+        """ Apply the changes clusto has had since this context's version, up to version
+
+        Entities, attributes and contents that changed are reloaded in place
+        and anything built from them is updated or dropped. Returns False if
+        that can't be done (clusto isn't versioned, version is older than
+        this context or too much has changed) and a new Context is needed.
+        """
+        if self.version is None or version < self.version:
+            return False
+        if version == self.version:
+            return True
+        limit = REFRESH_MAX_CHANGES + 1
+        entity_changes = list(itertools.islice(loader.entity_changes(self.version, version), limit))
+        attribute_changes = list(itertools.islice(loader.attribute_changes(self.version, version), limit))
+        if len(entity_changes) + len(attribute_changes) > REFRESH_MAX_CHANGES:
+            return False
+        self._apply_entity_changes(entity_changes)
+        self._apply_attribute_changes(attribute_changes)
+        self.version = version
+        self.modified = True
+        return True
+
+    def _apply_entity_changes(self, changes):
+        added = set()
+        removed = set()
+        driver_names = {}
+        for change in changes:
+            key = ContextKey(change.type, change.name)
+            if self.entity_types is not None and key.item_type not in self.entity_types:
+                continue
+            if change.is_live:
+                added.add(key)
+                driver_names[key] = change.driver
+            elif change.was_live:
+                removed.add(key)
+        # deleted and recreated
+        removed -= added
+        if not (added or removed):
+            return
+        self.entity_map.remove_keys(removed)
+        self.entity_map.add_keys(added, driver_names)
+        if self._keys_by_name is not None:
+            for key in removed:
+                if self._keys_by_name.get(key.name) == key:
+                    del self._keys_by_name[key.name]
+            for key in added:
+                self._keys_by_name[key.name] = key
+        for values_by_host in self.attribute_map.itervalues():
+            for key in removed:
+                values_by_host.pop(key, None)
+        for hosts in self.attribute_hosts.itervalues():
+            if hosts is not None:
+                hosts.difference_update(removed)
+        if self._type_index is not None:
+            for key in removed:
+                self._type_index[key.item_type].discard(key)
+            for key in added:
+                self._type_index[key.item_type].add(key)
+        self._type_counts = None
+        # entity ids are positions in the old entity map
+        self._host_ids = None
+        self._column_store = None
+        for prop in ('name', 'hostname'):
+            self._affix_indexes.pop(prop, None)
+            self._trigram_indexes.pop(prop, None)
+        # their attributes and memberships were deleted along with them, so
+        # the rest is taken care of as attribute changes
+
+    def _apply_attribute_changes(self, changes):
+        hosts_by_key = collections.defaultdict(set)
+        for change in changes:
+            hosts_by_key[change.key].add(ContextKey(change.entity_type, change.entity_name))
+        for hosts in hosts_by_key.itervalues():
+            self.entity_map.forget(hosts)
+        parents = hosts_by_key.pop('_contains', None)
+        if parents:
+            self._refresh_contents(parents)
+        for key, hosts in hosts_by_key.iteritems():
+            self._reload_attributes(key, hosts)
+            self._attribute_counts.pop(key, None)
+            for indexes in (self._value_indexes, self._trigram_indexes, self._address_indexes):
+                for index_key in [k for k in indexes if isinstance(k, tuple) and k[0] == key]:
+                    del indexes[index_key]
+            if self._column_store is not None:
+                self._column_store.forget(key)
+        if 'hostname' in hosts_by_key:
+            self._affix_indexes.pop('hostname', None)
+            self._trigram_indexes.pop('hostname', None)
+        if 'pooltype' in hosts_by_key:
+            self._role_index = None
+
+    def _reload_attributes(self, key, hosts):
+        """ Reload the prefetched values of key for those of hosts that have them """
+        for store_key, loaded in self.attribute_hosts.iteritems():
+            if store_key[0] != key:
+                continue
+            values_by_host = self.attribute_map[store_key]
+            reload_hosts = [h for h in hosts if h in self.entity_map and (loaded is None or h in loaded)]
+            for host in reload_hosts:
+                values_by_host.pop(host, None)
+            names = [h.name for h in reload_hosts]
+            for offset in xrange(0, len(names), PREFETCH_BATCH_SIZE):
+                self._load_attributes([store_key], names[offset:offset + PREFETCH_BATCH_SIZE])
+
+    def _refresh_contents(self, parents):
+        """ Reload the direct contents of parents and update everything built from them """
+        if self.contents_dict is None:
+            # not loaded yet; it'll be loaded fresh when it's needed
+            return
+        parents = [p for p in parents if p.item_type in self.CONTEXT_TYPES]
+        children = collections.defaultdict(set)
+        names = [p.name for p in parents]
+        for offset in xrange(0, len(names), PREFETCH_BATCH_SIZE):
+            for row in loader.contents(names[offset:offset + PREFETCH_BATCH_SIZE]):
+                children[ContextKey(row.parent_type, row.parent_name)].add(
+                    ContextKey(row.child_type, row.child_name))
+        for parent in parents:
+            if children.get(parent):
+                self.forward_map[parent] = children[parent]
+            else:
+                self.forward_map.pop(parent, None)
+
+        previous = dict(self.contents_dict)
+        for parent in update_closure(self.forward_map, self.contents_dict, parents):
+            before = previous.get(parent, frozenset())
+            after = self.contents_dict.get(parent, frozenset())
+            members = self.members_by_type[parent.item_type]
+            if after:
+                members[parent] = after
+            else:
+                members.pop(parent, None)
+            if parent.item_type in self.context_dict:
+                parents_of = self.context_dict[parent.item_type]
+                for child in before - after:
+                    parents_of[child].discard(parent)
+                for child in after - before:
+                    parents_of[child].add(parent)
+        self._role_index = None
+
+    def key_for_name(self, name):
+        if self._keys_by_name is None:
+            self._keys_by_name = dict((k.name, k) for k in self.entity_map)
+        return self._keys_by_name.get(name)
 
     @staticmethod
     def str_type(clusto_object):
         return getattr(clusto_object, 'type', 'other')
 
     def populate_pools_and_datacenters(self):
-        seen = set()
-
         forward_map = collections.defaultdict(set)
 
         # we're building a reverse map from (parent_type, object) to
@@ -45,59 +471,373 @@ class Context(object):
         # flatten it to get transitive parent relationships, then reverse it.
         #
         # yay.
-        relationships = adjacency_map()
-        for row in relationships:
-            if row.parent_type not in self.CONTEXT_TYPES:
-                continue
-            root_name = ContextKey(row.parent_type, row.parent_name)
-            child_name = ContextKey(row.child_type, row.child_name)
-            forward_map[root_name].add(child_name)
-
-        # now flatten it
-        transitive_contents = {}
-        for pool_or_datacenter, contents in forward_map.iteritems():
-            recursive_contents = set()
-            seen = set()
-            work_queue = list(contents)
-            while work_queue:
-                t = work_queue.pop(0)
-                if t in seen:
-                    continue
-                seen.add(t)
-                if t in forward_map:
-                    work_queue.extend(forward_map[t])
-                    recursive_contents.add(t)
-                else:
-                    recursive_contents.add(t)
-            transitive_contents[pool_or_datacenter] = recursive_contents
-
-        results = dict(
-            (typ, collections.defaultdict(set))
-            for typ
-            in self.CONTEXT_TYPES
-        )
+        #
+        # the shallow map is built from entity ids first, so there's only
+        # one ContextKey for each entity however many parents it has
+        children_by_id = collections.defaultdict(set)
+        for parent_id, child_id in loader.contains_edges(self.CONTEXT_TYPES):
+            children_by_id[parent_id].add(child_id)
+        wanted = set(children_by_id)
+        for child_ids in children_by_id.itervalues():
+            wanted.update(child_ids)
+        key_of = dict((entity_id, ContextKey(typ, name)) for entity_id, typ, name in loader.entity_keys(wanted))
+        for parent_id, child_ids in children_by_id.iteritems():
+            # (anything deleted in between is left out)
+            children = set(key_of[c] for c in child_ids if c in key_of)
+            if parent_id in key_of and children:
+                forward_map[key_of[parent_id]] = children
+
+        # it's flattened (and reversed) a type at a time, as each is needed
+        self.forward_map = dict(forward_map)
+        self._set_contents({}, ())
+        self.modified = True
+        self.unsaved_rows += sum(len(child_ids) for child_ids in children_by_id.itervalues())
+
+    def _set_contents(self, contents_dict, closed_types):
+        """ Index the flattened parent -> descendants map; it's reversed lazily """
+        self.contents_dict = contents_dict
+        self.closed_types = set(closed_types)
+        self.members_by_type = dict((typ, {}) for typ in self.CONTEXT_TYPES)
+        for parent, children in contents_dict.iteritems():
+            self.members_by_type[parent.item_type][parent] = children
+        self.context_dict = {}
+        self._role_index = None
 
+    def _close(self, typ):
+        """ Flatten the contents of every typ parent, if that isn't done yet """
+        if self.contents_dict is None:
+            self.populate_pools_and_datacenters()
+        if typ in self.closed_types:
+            return
+        # anything else reachable from them is flattened on the way; any of
+        # those that weren't there before are new
+        before = len(self.contents_dict)
+        transitive_closure(self.forward_map, [p for p in self.forward_map if p.item_type == typ], self.contents_dict)
+        if len(self.contents_dict) != before:
+            for parent, children in self.contents_dict.iteritems():
+                self.members_by_type[parent.item_type].setdefault(parent, children)
+        self.closed_types.add(typ)
+        self.modified = True
+
+    def _reverse_contents(self, typ):
         # finally, reverse it
-        for parent, children in transitive_contents.iteritems():
+        parents_of = collections.defaultdict(set)
+        for parent, children in self.members_by_type[typ].iteritems():
             for child in children:
-                results[parent.item_type][child].add(parent)
+                parents_of[child].add(parent)
+        self.context_dict[typ] = parents_of
 
-        self.context_dict = results
+    def members(self, typ):
+        """ Map every typ parent to the set of everything it (transitively) contains """
+        self._close(typ)
+        return self.members_by_type[typ]
 
-    def context(self, typ, host):
-        if self.context_dict is None:
-            self.populate_pools_and_datacenters()
-        if typ in self.CONTEXT_TYPES:
-            return self.context_dict[typ].get(host, set([]))
+    def _attribute_store(self, key, subkey, host=None):
+        """ Return the prefetched (key, subkey) that holds host, if any """
+        store_keys = [(key, None)]
+        if subkey is not None:
+            store_keys.insert(0, (key, subkey))
+        for store_key in store_keys:
+            if store_key not in self.attribute_hosts:
+                continue
+            loaded = self.attribute_hosts[store_key]
+            if loaded is None or (host is not None and host in loaded):
+                return store_key
+        return None
+
+    def _load_attributes(self, store_keys, names=None):
+        self.modified = True
+        for row in loader.attribute_rows(store_keys, names):
+            self.unsaved_rows += 1
+            host = self.key_for_name(row.entity_name)
+            if host is None:
+                continue
+            value = row.value if row.is_relation else Attribute._check(row.value)
+            attribute_value = AttributeValue(row.key, row.subkey, row.number, value)
+            # a row without a subkey only belongs in (key, None), once
+            for store_key in set([(row.key, None), (row.key, row.subkey)]):
+                if store_key in store_keys:
+                    self.attribute_map[store_key].setdefault(host, []).append(attribute_value)
+
+    def prefetch_attributes(self, attributes, hosts=None):
+        """ Load the values of attributes for hosts (or every host) in bulk
+
+        Small candidate sets are loaded in batches of IN (...) queries;
+        anything larger loads every value for the attributes in one query.
+        """
+        if settings.merge_container_attrs:
+            # clusto merges parents' attributes in per-host; leave that to it,
+            # but fetch the Drivers of the hosts it'll be asked about together
+            if hosts is not None:
+                self.entity_map.load(hosts)
+            return
+        if hosts is not None and len(hosts) > PREFETCH_MAX_BATCHED_HOSTS:
+            hosts = None
+        full_loads = []
+        for attribute in attributes:
+            store_key = (attribute.key, attribute.subkey or None)
+            if self._attribute_store(*store_key) is not None:
+                continue
+            self.attribute_map.setdefault(store_key, {})
+            if hosts is None:
+                full_loads.append(store_key)
+                self.attribute_hosts[store_key] = None
+                continue
+            loaded = self.attribute_hosts.setdefault(store_key, set())
+            missing = [h.name for h in hosts if self._attribute_store(store_key[0], store_key[1], h) is None]
+            for offset in xrange(0, len(missing), PREFETCH_BATCH_SIZE):
+                names = missing[offset:offset + PREFETCH_BATCH_SIZE]
+                self._load_attributes([store_key], names)
+                loaded.update(self.key_for_name(name) for name in names)
+        if full_loads:
+            # drop anything partially loaded so rows aren't appended twice
+            for store_key in full_loads:
+                self.attribute_map[store_key] = {}
+            self._load_attributes(full_loads)
+
+    def attribute_values(self, host, key, subkey=None):
+        """ Return the prefetched AttributeValues of key/subkey for host
+
+        Returns None if they haven't been prefetched.
+        """
+        store_key = self._attribute_store(key, subkey, host)
+        if store_key is None:
+            return None
+        values = self.attribute_map[store_key].get(host, [])
+        if subkey is not None and store_key[1] is None:
+            values = [v for v in values if v.subkey == subkey]
+        return values
+
+    def attribute_loaded(self, attribute):
+        """ Whether attribute has been prefetched for every host """
+        return self._attribute_store(attribute.key, attribute.subkey or None) is not None
+
+    def gather_attribute_counts(self, attributes):
+        """ Count the values of any of attributes' keys that haven't been counted, in one query """
+        keys = set(a.key for a in attributes if a.key not in self._attribute_counts)
+        if not keys:
+            return
+        self.modified = True
+        for key in keys:
+            self._attribute_counts[key] = {}
+        for row in loader.attribute_counts(keys):
+            self.unsaved_rows += 1
+            self._attribute_counts[row.key][row.subkey] = AttributeCounts(
+                row.values, row.entities, row.distinct_values)
+
+    def attribute_counts(self, attribute):
+        """ Return the AttributeCounts of attribute, summed over subkeys if it has none """
+        self.gather_attribute_counts([attribute])
+        counts_by_subkey = self._attribute_counts[attribute.key]
+        if attribute.subkey:
+            return counts_by_subkey.get(attribute.subkey, AttributeCounts(0, 0, 0))
+        return AttributeCounts(*(sum(column) for column in zip((0, 0, 0), *counts_by_subkey.values())))
+
+    def type_counts(self):
+        """ Map each clusto type to how many hosts have it """
+        if self._type_counts is None:
+            self._type_counts = collections.Counter(host.item_type for host in self.entity_map)
+        return self._type_counts
+
+    def value_index(self, attribute, hosts=None):
+        """ Return a SortedValueIndex of attribute over every host
+
+        If it isn't built yet and the optimizer reckons checking hosts one by
+        one is cheaper than loading the attribute for every host, this
+        returns None. It also returns None if the values can't be ordered
+        against numbers.
+        """
+        index_key = (attribute.key, attribute.subkey or None, attribute.number)
+        if index_key not in self._value_indexes:
+            pairs = self._attribute_pairs(attribute, hosts)
+            if pairs is None:
+                return None
+            self._value_indexes[index_key] = SortedValueIndex(pairs)
+        index = self._value_indexes[index_key]
+        if not index.orderable:
+            return None
+        return index
+
+    def host_ids(self):
+        """ The HostIds of every entity, kept until entities are added or removed """
+        if self._host_ids is None:
+            self._host_ids = HostIds(self.entity_map)
+        return self._host_ids
+
+    def column_store(self):
+        """ The columnar.ColumnStore of this context, kept until entities are added or removed """
+        if self._column_store is None:
+            self._column_store = columnar.ColumnStore(self, self.host_ids())
+        return self._column_store
+
+    def _hostnames(self):
+        """ (hostname, host) for every host with a hostname, or None if one isn't a string """
+        self.prefetch_attributes([HOSTNAME_ATTRIBUTE])
+        pairs = []
+        # hosts whose hostname has to be read off their Driver
+        unprefetched = []
+        for host in self.entity_map:
+            prop = getattr(self.entity_map.driver_class(host), 'hostname', None)
+            if prop is None:
+                continue
+            values = self.attribute_values(host, 'hostname') if prop is Device.hostname else None
+            if values is None:
+                unprefetched.append(host)
+            elif values:
+                pairs.append((values[0].value, host))
+            else:
+                pairs.append((host.name, host))
+        self.entity_map.load(unprefetched)
+        pairs.extend((self.entity_map[host].hostname, host) for host in unprefetched)
+        # the prefetched value may have been coerced by Attribute._check
+        if not all(isinstance(hostname, basestring) for hostname, _ in pairs):
+            return None
+        return pairs
+
+    def _worth_indexing(self, prop, hosts):
+        """ Whether indexing prop for every host beats checking hosts one by one """
+        if hosts is None:
+            return True
+        if isinstance(prop, Attribute):
+            rows = self.attribute_counts(prop).values
+            if self.attribute_loaded(prop):
+                return optimizer.worth_indexing(hosts, optimizer.MEMORY_COST, rows, optimizer.INDEX_COST)
+            return optimizer.worth_indexing(hosts, optimizer.FETCH_COST,
+                                            rows, optimizer.LOAD_COST + optimizer.INDEX_COST)
+        elif prop == 'hostname':
+            # read off each host's Driver
+            return optimizer.worth_indexing(hosts, optimizer.FETCH_COST,
+                                            len(self.entity_map), optimizer.LOAD_COST + optimizer.INDEX_COST)
+        return optimizer.worth_indexing(hosts, optimizer.MEMORY_COST, len(self.entity_map), optimizer.INDEX_COST)
+
+    def affix_index(self, prop, hosts=None):
+        """ Return an AffixIndex of 'name' or 'hostname' over every host
+
+        Returns None if it isn't built yet and checking hosts one by one is
+        cheaper, or if some hostname isn't a string.
+        """
+        if prop not in self._affix_indexes:
+            if not self._worth_indexing(prop, hosts):
+                return None
+            if prop == 'name':
+                pairs = [(host.name, host) for host in self.entity_map]
+            else:
+                pairs = self._hostnames()
+            self._affix_indexes[prop] = AffixIndex(pairs) if pairs is not None else None
+        return self._affix_indexes[prop]
+
+    def _attribute_pairs(self, attribute, hosts=None):
+        """ (value, host) for every value of attribute, or None if it isn't worth loading """
+        if settings.merge_container_attrs:
+            return None
+        store_key = self._attribute_store(attribute.key, attribute.subkey or None)
+        if not self._worth_indexing(attribute, hosts):
+            return None
+        if store_key is None:
+            self.prefetch_attributes([attribute])
+            store_key = self._attribute_store(attribute.key, attribute.subkey or None)
+        pairs = []
+        for host in self.attribute_map[store_key]:
+            for value in flatten(attribute.get(host, self).values()):
+                pairs.append((value, host))
+        return pairs
+
+    def trigram_index(self, prop, hosts=None):
+        """ Return a TrigramIndex of 'name', 'hostname' or an Attribute over every host
+
+        Returns None if it isn't built yet and checking hosts one by one is
+        cheaper, or if some of the values aren't strings.
+        """
+        if isinstance(prop, Attribute):
+            index_key = (prop.key, prop.subkey or None, prop.number)
         else:
+            index_key = prop
+        if index_key not in self._trigram_indexes:
+            if not self._worth_indexing(prop, hosts):
+                return None
+            if prop == 'name':
+                pairs = [(host.name, host) for host in self.entity_map]
+            elif prop == 'hostname':
+                pairs = self._hostnames()
+            else:
+                pairs = self._attribute_pairs(prop)
+            if pairs is not None and not all(isinstance(v, basestring) for v, _ in pairs):
+                pairs = None
+            self._trigram_indexes[index_key] = TrigramIndex(pairs) if pairs is not None else None
+        return self._trigram_indexes[index_key]
+
+    def address_index(self, attribute, hosts=None):
+        """ Return an AddressIndex of the IPs stored in attribute over every host
+
+        Returns None if it isn't built yet and checking hosts one by one is
+        cheaper, or if some value isn't an IP address.
+        """
+        index_key = (attribute.key, attribute.subkey or None, attribute.number)
+        if index_key not in self._address_indexes:
+            pairs = self._attribute_pairs(attribute, hosts)
+            if pairs is None:
+                return None
+            try:
+                pairs = [(parse_address(value), host) for value, host in pairs]
+            except ValueError:
+                self._address_indexes[index_key] = None
+            else:
+                self._address_indexes[index_key] = AddressIndex(pairs)
+        return self._address_indexes[index_key]
+
+    def type_index(self, hosts=None):
+        """ Map each clusto type to the set of its hosts
+
+        Returns None if it isn't built yet and checking hosts one by one is
+        cheaper.
+        """
+        if self._type_index is None:
+            if not self._worth_indexing('clusto_type', hosts):
+                return None
+            self._type_index = collections.defaultdict(set)
+            for host in self.entity_map:
+                self._type_index[host.item_type].add(host)
+        return self._type_index
+
+    def context(self, typ, host):
+        if typ not in self.CONTEXT_TYPES:
             raise AttributeError()
+        if typ not in self.context_dict:
+            self._close(typ)
+            self._reverse_contents(typ)
+        return self.context_dict[typ].get(host, set([]))
+
+    def _is_role_pool(self, pool_key):
+        self.prefetch_attributes([POOLTYPE_ATTRIBUTE])
+        maybe_attrs = self.attribute_values(pool_key, 'pooltype')
+        if maybe_attrs is None:
+            maybe_attrs = self.entity_map[pool_key].attrs(key='pooltype')
+        return bool(maybe_attrs) and maybe_attrs[0].value == 'role'
 
     def role_for_host(self, host):
         if not isinstance(host, ContextKey):
             host = _generate_key(host)
-        for pool_key in self.context('pool', host):
-            pool = self.entity_map[pool_key]
-            maybe_attrs = pool.attrs(key='pooltype')
-            if maybe_attrs and maybe_attrs[0].value == 'role':
-                return pool.name
-        return None
+        pools = self.context('pool', host)
+        if settings.merge_container_attrs:
+            # pooltype is read off each pool's Driver
+            self.entity_map.load(pools)
+        # a host should only be in one role pool; if it's in more, the same
+        # one is picked however the pools happen to be ordered in memory
+        roles = [pool_key.name for pool_key in pools if self._is_role_pool(pool_key)]
+        return min(roles) if roles else None
+
+    def role_index(self):
+        """ Map each role to the set of hosts role_for_host gives it """
+        if self._role_index is None:
+            role_hosts = set()
+            pools = self.members('pool')
+            if settings.merge_container_attrs:
+                self.entity_map.load(pools)
+            for pool_key, hosts in pools.iteritems():
+                if self._is_role_pool(pool_key):
+                    role_hosts.update(hosts)
+            role_index = collections.defaultdict(set)
+            for host in role_hosts:
+                role_index[self.role_for_host(host)].add(host)
+            self._role_index = role_index
+        return self._role_index
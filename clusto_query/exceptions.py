@@ -1,14 +1,26 @@
+def _at_column(column):
+    return '' if column is None else ' at column %d' % column
+
+
 class ExpectedTokenError(StandardError):
-    def __init__(self, expected, got):
+    def __init__(self, expected, got, column=None):
         self.expected = expected
         self.got = got
+        self.column = column
 
     def __str__(self):
-        return "Missing expected token (expected '%s', got '%s')" % (self.expected, self.got)
+        return "Missing expected token (expected '%s', got '%s')%s" % (
+            self.expected, self.got, _at_column(self.column))
 
 
 class UnexpectedTokenError(StandardError):
-    pass
+    def __init__(self, rest, column=None):
+        StandardError.__init__(self, rest)
+        self.rest = rest
+        self.column = column
+
+    def __str__(self):
+        return '%s%s' % (self.rest, _at_column(self.column))
 
 
 class StringParseError(StandardError):
@@ -0,0 +1,152 @@
+"""Sets of hosts as bitmaps over dense integer ids
+
+A Context numbers its entities (HostIds) and boolean operators combine
+their results as HostSets: one bit per id held in a python long, so
+and/or/-/not are single big-integer operations instead of building and
+hashing a set of ContextKeys. Hosts are only turned back into ContextKeys
+when a HostSet is iterated.
+
+A bitmap takes a pass over every id to build, so results that only hold a
+few hosts are combined as plain sets instead (see HostIds.union and
+HostIds.difference).
+"""
+import binascii
+import itertools
+
+
+_ONE = ord('1')
+
+# plain sets of fewer than one in this many hosts are combined as sets,
+# which is quicker than building their bitmaps
+SMALL_SET_RATIO = 32
+
+# the set bits of every byte value, low bit first
+_BYTE_BITS = tuple(tuple(bit for bit in xrange(8) if byte >> bit & 1) for byte in xrange(256))
+
+
+def _to_bytes(bits):
+    """ bits as a little-endian bytearray """
+    digits = '%x' % bits
+    if len(digits) % 2:
+        digits = '0' + digits
+    data = bytearray(binascii.unhexlify(digits))
+    data.reverse()
+    return data
+
+
+class HostIds(object):
+    """ A dense integer id for every host of a Context """
+
+    def __init__(self, hosts):
+        self.hosts = list(hosts)
+        self.ids = dict((host, host_id) for host_id, host in enumerate(self.hosts))
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def bits(self, hosts):
+        """ The bitmap of hosts, which must all have ids """
+        if isinstance(hosts, HostSet) and hosts.host_ids is self:
+            return hosts.bits
+        if not self.hosts:
+            return 0
+        # a digit per id is quicker to fill in than shifting bits into bytes
+        digits = bytearray('0' * len(self.hosts))
+        for host_id in itertools.imap(self.ids.__getitem__, hosts):
+            digits[host_id] = _ONE
+        digits.reverse()
+        return int(str(digits), 2)
+
+    def host_set(self, hosts):
+        """ hosts as a HostSet """
+        if isinstance(hosts, HostSet) and hosts.host_ids is self:
+            return hosts
+        return HostSet(self, self.bits(hosts))
+
+    def small(self, hosts):
+        """ Whether hosts is a plain set that's quicker to combine as one than as a bitmap """
+        return not isinstance(hosts, HostSet) and len(hosts) * SMALL_SET_RATIO < len(self.hosts)
+
+    def union(self, hosts, other):
+        """ hosts | other: a plain set if both are small plain sets, else a HostSet """
+        if isinstance(other, HostSet) and other.host_ids is self:
+            hosts, other = other, hosts
+        if self.small(hosts) and self.small(other):
+            return set(hosts).union(other)
+        return self.host_set(hosts) | other
+
+    def difference(self, hosts, other):
+        """ hosts - other: a plain set if hosts is a small plain set, else a HostSet
+
+        other must be a set or HostSet.
+        """
+        if self.small(hosts):
+            return set(h for h in hosts if h not in other)
+        return self.host_set(hosts) - other
+
+
+class HostSet(object):
+    """ An immutable set of hosts, held as a bitmap of their HostIds
+
+    &, | and - with another HostSet of the same HostIds are bit
+    operations; anything else is converted first.
+    """
+    __slots__ = ('host_ids', 'bits', '_bytes')
+
+    def __init__(self, host_ids, bits=0):
+        self.host_ids = host_ids
+        self.bits = bits
+        # bits as bytes, for testing membership without shifting a long
+        self._bytes = None
+
+    def __repr__(self):
+        return 'HostSet(%r)' % (sorted(self),)
+
+    def _data(self):
+        if self._bytes is None:
+            self._bytes = _to_bytes(self.bits)
+        return self._bytes
+
+    def __contains__(self, host):
+        host_id = self.host_ids.ids.get(host)
+        if host_id is None:
+            return False
+        data = self._data()
+        byte = host_id >> 3
+        return byte < len(data) and bool(data[byte] >> (host_id & 7) & 1)
+
+    def __iter__(self):
+        hosts = self.host_ids.hosts
+        for byte, value in enumerate(self._data()):
+            if value:
+                base = byte << 3
+                for bit in _BYTE_BITS[value]:
+                    yield hosts[base + bit]
+
+    def __len__(self):
+        return bin(self.bits).count('1')
+
+    def __nonzero__(self):
+        return self.bits != 0
+
+    def __and__(self, other):
+        return HostSet(self.host_ids, self.bits & self.host_ids.bits(other))
+
+    def __or__(self, other):
+        return HostSet(self.host_ids, self.bits | self.host_ids.bits(other))
+
+    def __sub__(self, other):
+        return HostSet(self.host_ids, self.bits & ~self.host_ids.bits(other))
+
+    def __eq__(self, other):
+        if isinstance(other, HostSet) and other.host_ids is self.host_ids:
+            return self.bits == other.bits
+        if not isinstance(other, (HostSet, set, frozenset)):
+            return NotImplemented
+        return frozenset(self) == frozenset(other)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
@@ -0,0 +1,161 @@
+"""In-memory indexes over a Context, used to answer clauses without a per-host scan"""
+import bisect
+import datetime
+import numbers
+
+
+# values python 2 can't order against numbers
+_UNORDERABLE_TYPES = (datetime.date, datetime.time, datetime.timedelta, set, frozenset)
+
+
+def is_number(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
+
+
+class SortedValueIndex(object):
+    """ The values of one attribute across all hosts, sorted for range scans
+
+    Only numeric bounds are supported. Python 2 orders None below every
+    number and everything else (strings, lists, ...) above them, so those
+    values are kept aside and added to the appropriate side of each range.
+    """
+
+    def __init__(self, pairs):
+        """ pairs is an iterable of (value, host) """
+        numeric = []
+        self.none_hosts = set()
+        self.other_hosts = set()
+        self.orderable = True
+        seen = set()
+        self.single_valued = True
+        for value, host in pairs:
+            if host in seen:
+                self.single_valued = False
+            seen.add(host)
+            if value is None:
+                self.none_hosts.add(host)
+            elif isinstance(value, _UNORDERABLE_TYPES):
+                self.orderable = False
+            elif is_number(value):
+                if value == value:
+                    numeric.append((value, host))
+                # NaN never compares true; leave it out entirely
+            else:
+                self.other_hosts.add(host)
+        numeric.sort(key=lambda pair: pair[0])
+        self.values = [v for v, _ in numeric]
+        self.hosts = [h for _, h in numeric]
+
+    def _lower_offset(self, bound, inclusive):
+        if inclusive:
+            return bisect.bisect_left(self.values, bound)
+        return bisect.bisect_right(self.values, bound)
+
+    def _upper_offset(self, bound, inclusive):
+        if inclusive:
+            return bisect.bisect_right(self.values, bound)
+        return bisect.bisect_left(self.values, bound)
+
+    def above(self, bound, inclusive):
+        """ Hosts with any value > bound (>= if inclusive) """
+        results = set(self.hosts[self._lower_offset(bound, inclusive):])
+        results.update(self.other_hosts)
+        return results
+
+    def below(self, bound, inclusive):
+        """ Hosts with any value < bound (<= if inclusive) """
+        results = set(self.hosts[:self._upper_offset(bound, inclusive)])
+        results.update(self.none_hosts)
+        return results
+
+    def between(self, lower, lower_inclusive, upper, upper_inclusive):
+        """ Hosts with a value inside both bounds
+
+        This is only the same as intersecting above() and below() when
+        every host has at most one value (see single_valued).
+        """
+        start = self._lower_offset(lower, lower_inclusive)
+        end = self._upper_offset(upper, upper_inclusive)
+        return set(self.hosts[start:end])
+
+
+class AffixIndex(object):
+    """ Strings sorted forwards and reversed, for prefix and suffix lookups """
+
+    def __init__(self, pairs):
+        """ pairs is an iterable of (string, host) """
+        pairs = list(pairs)
+        forward = sorted(pairs, key=lambda pair: pair[0])
+        self.strings = [s for s, _ in forward]
+        self.hosts = [h for _, h in forward]
+        backward = sorted(((s[::-1], h) for s, h in pairs), key=lambda pair: pair[0])
+        self.reversed_strings = [s for s, _ in backward]
+        self.reversed_hosts = [h for _, h in backward]
+
+    @staticmethod
+    def _scan(strings, hosts, prefix):
+        results = set()
+        offset = bisect.bisect_left(strings, prefix)
+        while offset < len(strings) and strings[offset].startswith(prefix):
+            results.add(hosts[offset])
+            offset += 1
+        return results
+
+    def prefixed(self, prefix):
+        """ Hosts whose string starts with prefix """
+        return self._scan(self.strings, self.hosts, prefix)
+
+    def suffixed(self, suffix):
+        """ Hosts whose string ends with suffix """
+        return self._scan(self.reversed_strings, self.reversed_hosts, suffix[::-1])
+
+
+class TrigramIndex(object):
+    """ Every three-character substring of a set of strings, for substring search
+
+    Lookups intersect the postings of the query's trigrams to get a small
+    candidate set and then check those with a real substring test.
+    """
+    N = 3
+
+    def __init__(self, pairs):
+        """ pairs is an iterable of (string, host) """
+        self.strings = []
+        self.hosts = []
+        self.postings = {}
+        for string, host in pairs:
+            entry = len(self.strings)
+            self.strings.append(string)
+            self.hosts.append(host)
+            for gram in set(string[i:i + self.N] for i in xrange(len(string) - self.N + 1)):
+                self.postings.setdefault(gram, []).append(entry)
+
+    def containing(self, substring):
+        """ Hosts with a string containing substring """
+        if len(substring) < self.N:
+            entries = xrange(len(self.strings))
+        else:
+            grams = set(substring[i:i + self.N] for i in xrange(len(substring) - self.N + 1))
+            postings = sorted((self.postings.get(gram, ()) for gram in grams), key=len)
+            entries = set(postings[0])
+            for posting in postings[1:]:
+                if not entries:
+                    break
+                entries.intersection_update(posting)
+        return set(self.hosts[e] for e in entries if substring in self.strings[e])
+
+
+class AddressIndex(object):
+    """ IP addresses of every host as sorted (version, integer) pairs, for CIDR range scans """
+
+    def __init__(self, pairs):
+        """ pairs is an iterable of ((version, address), host) """
+        pairs = sorted(pairs, key=lambda pair: pair[0])
+        self.addresses = [a for a, _ in pairs]
+        self.hosts = [h for _, h in pairs]
+
+    def within(self, version, first, last):
+        """ Hosts with an IPv<version> address between first and last inclusive """
+        start = bisect.bisect_left(self.addresses, (version, first))
+        end = bisect.bisect_right(self.addresses, (version, last))
+        return set(self.hosts[start:end])
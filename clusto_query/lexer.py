@@ -13,6 +13,42 @@ _single_quoted_string_re = re.compile(r"'(((\\')|[^'])*)'")
 _double_quoted_string_re = re.compile(r'"(((\\")|[^"])*)"')
 _unquoted_string_re = re.compile(r'([\w./:-]+)')
 _separator_re = re.compile(r'[^a-zA-Z0-9_-]|\Z')
+_whitespace_re = re.compile(r'\s*', re.UNICODE)
+
+
+def _keyword_table():
+    keywords = ["attr"]
+    keywords.extend(SEARCH_KEYWORDS)
+    keywords.extend(BOOLEAN_OPERATORS.keys())
+    keywords.extend(UNARY_BOOLEAN_OPERATORS.keys())
+    keywords.extend(INFIX_OPERATORS.keys())
+    keywords.extend(("(", ")"))
+    return dict((keyword, keyword) for keyword in keywords)
+
+
+def _token_re(keywords):
+    """ One regex matching the next token: a keyword, then a quoted or unquoted string
+
+    Keywords are tried longest first; one that looks like a word only
+    counts if it isn't just the start of a longer word.
+    """
+    alternatives = []
+    for keyword in sorted(keywords, key=len, reverse=True):
+        pattern = re.escape(keyword)
+        if _unquoted_string_re.match(keyword):
+            pattern += '(?=%s)' % _separator_re.pattern
+        alternatives.append(pattern)
+    return re.compile('(?P<keyword>%s)|(?P<single>%s)|(?P<double>%s)|(?P<unquoted>%s)' % (
+        '|'.join(alternatives),
+        _single_quoted_string_re.pattern.replace('(', '(?:'),
+        _double_quoted_string_re.pattern.replace('(', '(?:'),
+        _unquoted_string_re.pattern.replace('(', '(?:'),
+    ))
+
+
+# keyword -> the same string, so tokens are always the canonical keyword
+_KEYWORDS = _keyword_table()
+_TOKEN_RE = _token_re(_KEYWORDS)
 
 
 def consume(token, string):
@@ -53,41 +89,62 @@ def convert_size(string):
 def lex_string(string):
     parsed, maybe_is_number, rest = lex_string_inner(string)
     if maybe_is_number:
-        if all(c.isdigit() or c == "." for c in parsed[:-1]) and parsed[-1] in SIZE_MAP:
-            try:
-                return convert_size(parsed), rest
-            except Exception:
-                return parsed, rest
-        elif all(c.isdigit() for c in parsed):
-            return int(parsed), rest
-        elif all(c.isdigit() or c == "." for c in parsed):
-            try:
-                return float(parsed), rest
-            except ValueError:
-                return parsed, rest
+        return _convert_unquoted(parsed), rest
     return parsed, rest
 
 
-def lex(q):
-    keywords = ["attr"]
-    keywords.extend(SEARCH_KEYWORDS)
-    keywords.extend(BOOLEAN_OPERATORS.keys())
-    keywords.extend(UNARY_BOOLEAN_OPERATORS.keys())
-    keywords.extend(INFIX_OPERATORS.keys())
-    keywords.extend(("(", ")"))
-    keywords.sort(key=len, reverse=True)
-    results = []
-    while q:
-        q = q.lstrip()
-        for keyword in keywords:
-            if q.startswith(keyword):
-                if _unquoted_string_re.match(keyword):
-                    if not _separator_re.match(consume(keyword, q)):
-                        continue
-                results.append(keyword)
-                q = consume(keyword, q)
-                break
+def _convert_unquoted(parsed):
+    if all(c.isdigit() or c == "." for c in parsed[:-1]) and parsed[-1] in SIZE_MAP:
+        try:
+            return convert_size(parsed)
+        except Exception:
+            return parsed
+    elif all(c.isdigit() for c in parsed):
+        return int(parsed)
+    elif all(c.isdigit() or c == "." for c in parsed):
+        try:
+            return float(parsed)
+        except ValueError:
+            return parsed
+    return parsed
+
+
+def tokenize(q):
+    """ Yield (token, offset) for each token in q, offset being where it starts in q
+
+    q is scanned once, left to right, without copying what's left of it.
+    """
+    position = _whitespace_re.match(q).end()
+    while position < len(q):
+        match = _TOKEN_RE.match(q, position)
+        if match is None:
+            raise StringParseError('Unable to parse %r at column %d' % (q[position:], position + 1))
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == 'keyword':
+            token = _KEYWORDS[text]
+        elif kind == 'unquoted':
+            token = _convert_unquoted(text)
         else:
-            result, q = lex_string(q)
-            results.append(result)
-    return results
+            quote = text[0]
+            token = text[1:-1].replace('\\' + quote, quote)
+        yield token, position
+        position = _whitespace_re.match(q, match.end()).end()
+
+
+class Tokens(list):
+    """ The tokens lex found, with where each one starts in the query (offsets) and its length (end) """
+
+    def __init__(self, tokens, offsets, end):
+        super(Tokens, self).__init__(tokens)
+        self.offsets = offsets
+        self.end = end
+
+
+def lex(q):
+    tokens = []
+    offsets = []
+    for token, offset in tokenize(q):
+        tokens.append(token)
+        offsets.append(offset)
+    return Tokens(tokens, offsets, len(q))
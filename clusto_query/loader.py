@@ -0,0 +1,318 @@
+import collections
+import json
+
+from clusto import ENTITY_TABLE, ATTR_TABLE, SESSION
+
+from sqlalchemy import select, and_, or_, func
+
+
+AttributeRow = collections.namedtuple(
+    'AttributeRow',
+    ['entity_name', 'key', 'subkey', 'number', 'value', 'is_relation']
+)
+
+AttributeCounts = collections.namedtuple(
+    'AttributeCounts',
+    ['key', 'subkey', 'values', 'entities', 'distinct_values']
+)
+
+# rows fetched at a time by _streamed
+STREAM_BATCH_SIZE = 10000
+
+
+def _streamed(query):
+    """Execute query and yield its rows a batch at a time
+
+    The database driver is asked for a server-side cursor, so rows aren't
+    all buffered in memory first when it supports one.
+    """
+    result = SESSION.execute(query.execution_options(stream_results=True))
+    try:
+        while True:
+            rows = result.fetchmany(STREAM_BATCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        result.close()
+
+
+def _decode_value(datatype, int_value, string_value, datetime_value, relation_name):
+    """Mirror clusto.schema.Attribute.value for a raw ATTR_TABLE row"""
+    if datatype == 'relation':
+        return relation_name
+    elif datatype == 'int':
+        return int(int_value)
+    elif datatype == 'datetime':
+        return datetime_value
+    elif datatype == 'json':
+        return json.loads(string_value)
+    else:
+        return string_value
+
+
+def attribute_rows(keys, names=None):
+    """Return every live attribute matching one of keys in one pass
+
+    keys is an iterable of (key, subkey) tuples; a subkey of None matches
+    every subkey of that key. If names is given, only attributes of the
+    entities with those names are returned.
+
+    Returns a generator of AttributeRow namedtuples, in attribute order
+    """
+    owner_entities = ENTITY_TABLE.alias()
+    related_entities = ENTITY_TABLE.alias()
+    entity_attrs = ATTR_TABLE
+
+    key_clauses = []
+    for key, subkey in keys:
+        if subkey is None:
+            key_clauses.append(entity_attrs.c.key == key)
+        else:
+            key_clauses.append(and_(entity_attrs.c.key == key, entity_attrs.c.subkey == subkey))
+
+    where = [
+        entity_attrs.c.deleted_at_version == None,
+        owner_entities.c.deleted_at_version == None,
+        or_(*key_clauses),
+    ]
+    if names is not None:
+        where.append(owner_entities.c.name.in_(list(names)))
+
+    query = select([
+        owner_entities.c.name,
+        entity_attrs.c.key,
+        entity_attrs.c.subkey,
+        entity_attrs.c.number,
+        entity_attrs.c.datatype,
+        entity_attrs.c.int_value,
+        entity_attrs.c.string_value,
+        entity_attrs.c.datetime_value,
+        related_entities.c.name,
+    ]).select_from(
+        entity_attrs.
+        join(owner_entities,
+             owner_entities.c.entity_id == entity_attrs.c.entity_id).
+        outerjoin(related_entities,
+                  related_entities.c.entity_id == entity_attrs.c.relation_id)
+    ).where(
+        and_(*where)
+    ).order_by(entity_attrs.c.attr_id)
+
+    for row in SESSION.execute(query):
+        (name, key, subkey, number, datatype,
+         int_value, string_value, datetime_value, relation_name) = row
+        yield AttributeRow(
+            name, key, subkey, number,
+            _decode_value(datatype, int_value, string_value, datetime_value, relation_name),
+            datatype == 'relation'
+        )
+
+
+EntityRow = collections.namedtuple('EntityRow', ['name', 'type', 'driver'])
+
+
+def entities(types=None):
+    """Return an EntityRow for every live entity (of one of types), without building any Drivers
+
+    Rows share a single copy of each distinct type and driver name.
+    """
+    if types is not None and not types:
+        return
+    shared = {}
+    whereclause = ENTITY_TABLE.c.deleted_at_version == None
+    if types is not None:
+        whereclause = and_(whereclause, ENTITY_TABLE.c.type.in_(list(types)))
+    query = select([ENTITY_TABLE.c.name, ENTITY_TABLE.c.type, ENTITY_TABLE.c.driver]).where(whereclause)
+    for name, typ, driver in SESSION.execute(query):
+        yield EntityRow(name, shared.setdefault(typ, typ), shared.setdefault(driver, driver))
+
+
+def entity_keys(entity_ids):
+    """Return (entity_id, type, name) for every live entity whose id is in entity_ids
+
+    Every live entity is read (streamed) rather than sending the ids. Rows
+    share a single copy of each distinct type.
+    """
+    shared = {}
+    query = select([ENTITY_TABLE.c.entity_id, ENTITY_TABLE.c.type, ENTITY_TABLE.c.name]).where(
+        ENTITY_TABLE.c.deleted_at_version == None
+    )
+    for entity_id, typ, name in _streamed(query):
+        if entity_id in entity_ids:
+            yield entity_id, shared.setdefault(typ, typ), name
+
+
+def entity_names(whereclause):
+    """Return the names of every live entity matching whereclause
+
+    whereclause is built against ENTITY_TABLE itself (not an alias)
+    """
+    query = select([ENTITY_TABLE.c.name]).where(
+        and_(
+            ENTITY_TABLE.c.deleted_at_version == None,
+            whereclause,
+        )
+    )
+    for row in SESSION.execute(query):
+        yield row[0]
+
+
+def attribute_counts(keys):
+    """Count the live values of every attribute with one of keys
+
+    Returns a generator of AttributeCounts namedtuples, one per (key, subkey)
+    """
+    attrs = ATTR_TABLE
+    query = select([
+        attrs.c.key,
+        attrs.c.subkey,
+        func.count(),
+        func.count(attrs.c.entity_id.distinct()),
+        # at most one of these is set on each row
+        func.count(attrs.c.int_value.distinct()) +
+        func.count(attrs.c.string_value.distinct()) +
+        func.count(attrs.c.datetime_value.distinct()) +
+        func.count(attrs.c.relation_id.distinct()),
+    ]).where(
+        and_(
+            attrs.c.deleted_at_version == None,
+            attrs.c.key.in_(list(keys)),
+        )
+    ).group_by(attrs.c.key, attrs.c.subkey)
+    for row in SESSION.execute(query):
+        yield AttributeCounts(*row)
+
+
+def _changed_between(table, since, until):
+    """Rows of table created or deleted after version since, up to version until"""
+    return or_(
+        and_(table.c.version > since, table.c.version <= until),
+        and_(table.c.deleted_at_version > since, table.c.deleted_at_version <= until),
+    )
+
+
+def _live_at(table, version):
+    return and_(table.c.version <= version,
+                or_(table.c.deleted_at_version == None, table.c.deleted_at_version > version))
+
+
+EntityChange = collections.namedtuple('EntityChange', ['name', 'type', 'driver', 'was_live', 'is_live'])
+AttributeChange = collections.namedtuple('AttributeChange', ['entity_name', 'entity_type', 'key', 'subkey'])
+Adjacency = collections.namedtuple('Adjacency', ['parent_name', 'parent_type', 'child_name', 'child_type'])
+
+
+def entity_changes(since, until):
+    """Return an EntityChange for every entity row created or deleted between two versions
+
+    was_live and is_live say whether the row was live at since and at until
+    """
+    entities = ENTITY_TABLE
+    query = select([
+        entities.c.name,
+        entities.c.type,
+        entities.c.driver,
+        _live_at(entities, since),
+        _live_at(entities, until),
+    ]).where(_changed_between(entities, since, until))
+    for name, typ, driver, was_live, is_live in SESSION.execute(query):
+        yield EntityChange(name, typ, driver, bool(was_live), bool(is_live))
+
+
+def attribute_changes(since, until):
+    """Return an AttributeChange for every attribute row created or deleted between two versions"""
+    owner_entities = ENTITY_TABLE.alias()
+    query = select([
+        owner_entities.c.name,
+        owner_entities.c.type,
+        ATTR_TABLE.c.key,
+        ATTR_TABLE.c.subkey,
+    ]).select_from(
+        ATTR_TABLE.join(owner_entities, owner_entities.c.entity_id == ATTR_TABLE.c.entity_id)
+    ).where(_changed_between(ATTR_TABLE, since, until))
+    for row in SESSION.execute(query):
+        yield AttributeChange(*row)
+
+
+def contains_edges(parent_types):
+    """Return (parent_id, child_id) for every live entity directly contained by one with one of parent_types
+
+    Rows are streamed from the database rather than loaded all at once.
+    """
+    parent_entities = ENTITY_TABLE.alias()
+    child_entities = ENTITY_TABLE.alias()
+    query = select([
+        ATTR_TABLE.c.entity_id,
+        ATTR_TABLE.c.relation_id,
+    ]).select_from(
+        ATTR_TABLE.
+        join(parent_entities, parent_entities.c.entity_id == ATTR_TABLE.c.entity_id).
+        join(child_entities, child_entities.c.entity_id == ATTR_TABLE.c.relation_id)
+    ).where(
+        and_(
+            ATTR_TABLE.c.deleted_at_version == None,
+            child_entities.c.deleted_at_version == None,
+            parent_entities.c.deleted_at_version == None,
+            ATTR_TABLE.c.key == '_contains',
+            parent_entities.c.type.in_(list(parent_types)),
+        )
+    )
+    return _streamed(query)
+
+
+def contents(parent_names):
+    """Return an Adjacency for every live entity directly contained by the named parents"""
+    parent_entities = ENTITY_TABLE.alias()
+    child_entities = ENTITY_TABLE.alias()
+    query = select([
+        parent_entities.c.name,
+        parent_entities.c.type,
+        child_entities.c.name,
+        child_entities.c.type,
+    ]).select_from(
+        ATTR_TABLE.
+        join(parent_entities, parent_entities.c.entity_id == ATTR_TABLE.c.entity_id).
+        join(child_entities, child_entities.c.entity_id == ATTR_TABLE.c.relation_id)
+    ).where(
+        and_(
+            ATTR_TABLE.c.deleted_at_version == None,
+            child_entities.c.deleted_at_version == None,
+            parent_entities.c.deleted_at_version == None,
+            ATTR_TABLE.c.key == '_contains',
+            parent_entities.c.name.in_(list(parent_names)),
+        )
+    )
+    for row in SESSION.execute(query):
+        yield Adjacency(*row)
+
+
+Container = collections.namedtuple('Container', ['child_name', 'parent_name', 'parent_driver'])
+
+
+def containers(child_names):
+    """Return a Container for every live entity directly containing one of the named children
+
+    Rows are in attribute order, like Driver.parents()
+    """
+    parent_entities = ENTITY_TABLE.alias()
+    child_entities = ENTITY_TABLE.alias()
+    query = select([
+        child_entities.c.name,
+        parent_entities.c.name,
+        parent_entities.c.driver,
+    ]).select_from(
+        ATTR_TABLE.
+        join(parent_entities, parent_entities.c.entity_id == ATTR_TABLE.c.entity_id).
+        join(child_entities, child_entities.c.entity_id == ATTR_TABLE.c.relation_id)
+    ).where(
+        and_(
+            ATTR_TABLE.c.deleted_at_version == None,
+            child_entities.c.deleted_at_version == None,
+            parent_entities.c.deleted_at_version == None,
+            ATTR_TABLE.c.key == '_contains',
+            child_entities.c.name.in_(list(child_names)),
+        )
+    ).order_by(ATTR_TABLE.c.attr_id)
+    for row in SESSION.execute(query):
+        yield Container(*row)
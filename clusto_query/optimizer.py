@@ -1,28 +1,354 @@
+"""Cost-based ordering of the clauses of an Intersection
+
+Every clause gets an Estimate: the fraction of candidate hosts it keeps
+(selectivity) and the work it does per candidate host (cost, in units of
+one in-memory comparison). Running filters in ascending order of
+cost / (1 - selectivity) minimises the expected total work, so cheap,
+selective clauses narrow the candidate set before anything that has to
+fetch attributes host by host.
+"""
+import collections
+import copy
+
+import clusto_query.query.operator.boolean
+from clusto_query.query import QueryObject
 from clusto_query.query.operator.base import Operator
-from clusto_query.query.operator.affix import Equality
+from clusto_query.query.operator.affix import (ExistsOperator, InfixOperator, Equality, Inequality,
+                                               RangeOperator, Between, AffixOperator, SubString, InCidr)
 from clusto_query.query.objects import Attribute
+from clusto_query.index import is_number
+
+
+Estimate = collections.namedtuple('Estimate', ['selectivity', 'cost'])
+
+# relative costs, in units of checking one value that's already in memory
+MEMORY_COST = 1.0
+# checking a value that has to be fetched from the database for each host
+FETCH_COST = 20.0
+# loading one row as part of loading every value of an attribute
+LOAD_COST = 2.0
+# adding one value to an index
+INDEX_COST = 0.5
+# answering a clause from an index or membership map that's already built
+LOOKUP_COST = 0.1
+
+# selectivities used where there are no statistics to go on
+DEFAULT_SELECTIVITY = 0.5
+RANGE_SELECTIVITY = 1 / 3.0
+PATTERN_SELECTIVITY = 0.1
+
+
+def worth_indexing(candidates, scan_cost, rows, build_cost):
+    """ Whether indexing rows values costs less than checking candidates one by one
+
+    candidates of None means every host will be checked.
+    """
+    return candidates is None or len(candidates) * scan_cost >= rows * build_cost
+
+
+def _fraction(count, total):
+    return min(1.0, float(count) / max(total, 1))
+
+
+def _property_cost(prop, context):
+    if isinstance(prop, Attribute):
+        return MEMORY_COST if context.attribute_loaded(prop) else FETCH_COST
+    elif prop == 'role' or prop in context.CONTEXT_TYPES:
+        return LOOKUP_COST
+    elif prop in ('name', 'clusto_type'):
+        return MEMORY_COST
+    # anything else is read off each host's Driver
+    return FETCH_COST
+
 
+def _equality_selectivity(clause, context):
+    total = len(context.entity_map)
+    if isinstance(clause.lhs, Attribute):
+        counts = context.attribute_counts(clause.lhs)
+        return _fraction(counts.entities, total) / max(counts.distinct_values, 1)
+    elif clause.lhs == 'clusto_type':
+        return _fraction(context.type_counts().get(str(clause.rhs), 0), total)
+    elif clause.lhs in ('name', 'hostname'):
+        return _fraction(1, total)
+    elif clause.lhs in context.CONTEXT_TYPES:
+        name = str(clause.rhs)
+        members = sum(len(hosts) for parent, hosts in context.members(clause.lhs).iteritems()
+                      if parent.name == name)
+        return _fraction(members, total)
+    return PATTERN_SELECTIVITY
 
-def score_clause(clause):
-    score = 0
+
+def _presence(prop, context):
+    """ The fraction of hosts prop could match on at all """
+    if isinstance(prop, Attribute):
+        return _fraction(context.attribute_counts(prop).entities, len(context.entity_map))
+    return 1.0
+
+
+def _selectivity(clause, context):
     if isinstance(clause, Equality):
-        score -= 1
-    for possible_key in ('lhs', 'rhs'):
-        subclause = getattr(clause, possible_key, None)
-        if subclause is None:
-            continue
-        if isinstance(subclause, Attribute):
-            score += 100
-        elif isinstance(subclause, Operator):
-            score -= 1
-    return score
-
-
-def sort_clauses(iterable):
-    sort_space = []
-
-    for item in iterable:
-        score = score_clause(item)
-        sort_space.append((score, item))
-
-    return [v for (s, v) in sorted(sort_space)]
+        return _equality_selectivity(clause, context)
+    elif isinstance(clause, Inequality):
+        return 1.0 - _equality_selectivity(clause, context)
+    elif isinstance(clause, RangeOperator):
+        if not is_number(clause.rhs):
+            return DEFAULT_SELECTIVITY
+        return _presence(clause.lhs, context) * RANGE_SELECTIVITY
+    elif isinstance(clause, (AffixOperator, SubString, InCidr)):
+        return _presence(clause.lhs, context) * PATTERN_SELECTIVITY
+    elif isinstance(clause, ExistsOperator) and isinstance(clause.lhs, Attribute):
+        return _presence(clause.lhs, context)
+    return DEFAULT_SELECTIVITY
+
+
+def estimate(clause, context):
+    """ Return an Estimate of what running clause over the candidate hosts does """
+    boolean = clusto_query.query.operator.boolean
+    if isinstance(clause, boolean.Intersection):
+        selectivity, cost = 1.0, 0.0
+        for operand in sort_clauses(merge_ranges(clause.operands()), context):
+            operand_estimate = estimate(operand, context)
+            cost += selectivity * operand_estimate.cost
+            selectivity *= operand_estimate.selectivity
+        return Estimate(selectivity, cost)
+    elif isinstance(clause, (boolean.Union, boolean.Subtraction)):
+        estimates = [estimate(p, context) for p in clause.parameters]
+        cost = sum(e.cost for e in estimates)
+        if isinstance(clause, boolean.Union):
+            missed = 1.0
+            for e in estimates:
+                missed *= 1.0 - e.selectivity
+            return Estimate(1.0 - missed, cost)
+        selectivity = estimates[0].selectivity
+        for e in estimates[1:]:
+            selectivity *= 1.0 - e.selectivity
+        return Estimate(selectivity, cost)
+    elif isinstance(clause, boolean.Not):
+        inner = estimate(clause.parameters[0], context)
+        return Estimate(1.0 - inner.selectivity, inner.cost)
+    elif isinstance(clause, Between):
+        return Estimate(_presence(clause.lower.lhs, context) * RANGE_SELECTIVITY,
+                        _property_cost(clause.lower.lhs, context))
+    elif isinstance(clause, (ExistsOperator, InfixOperator)):
+        return Estimate(min(1.0, max(0.0, _selectivity(clause, context))), _property_cost(clause.lhs, context))
+    elif isinstance(clause, SharedQuery):
+        return estimate(clause.query, context)
+    elif isinstance(getattr(clause, 'query', None), QueryObject):
+        # a PushedDownQuery: its SQL prefilter is one cheap round trip
+        inner = estimate(clause.query, context)
+        return Estimate(inner.selectivity, LOOKUP_COST + inner.selectivity * inner.cost)
+    return Estimate(DEFAULT_SELECTIVITY, FETCH_COST)
+
+
+def _rank(clause_estimate):
+    return clause_estimate.cost / max(1.0 - clause_estimate.selectivity, 1e-6)
+
+
+def sort_clauses(clauses, context):
+    """ Order the clauses of an Intersection so the least work is done overall """
+    clauses = list(clauses)
+    if len(clauses) < 2:
+        return clauses
+    context.gather_attribute_counts(
+        p for clause in clauses for p in clause.visit_iter() if isinstance(p, Attribute)
+    )
+    ranks = [_rank(estimate(clause, context)) for clause in clauses]
+    order = sorted(xrange(len(clauses)), key=ranks.__getitem__)
+    return [clauses[i] for i in order]
+
+
+def merge_ranges(clauses):
+    """ Pair up lower and upper numeric bounds on the same attribute into Betweens """
+    bounds = {}
+    merged = []
+    for clause in clauses:
+        if isinstance(clause, RangeOperator) and isinstance(clause.lhs, Attribute) and is_number(clause.rhs):
+            attribute = (clause.lhs.key, clause.lhs.subkey or None, clause.lhs.number)
+            lower, upper = bounds.setdefault(attribute, ([], []))
+            if clause.lower:
+                lower.append(clause)
+            else:
+                upper.append(clause)
+        else:
+            merged.append(clause)
+    for lower, upper in bounds.itervalues():
+        while lower and upper:
+            merged.append(Between(lower.pop(0), upper.pop(0)))
+        merged.extend(lower)
+        merged.extend(upper)
+    return merged
+
+
+def _associative_operands(query):
+    """ The operands of query and of any directly nested query of the same class """
+    operands = []
+    for p in query.parameters:
+        if p.__class__ is query.__class__:
+            operands.extend(_associative_operands(p))
+        else:
+            operands.append(p)
+    return operands
+
+
+def _children(query):
+    """ The subqueries directly under query, looking through nested and/or """
+    boolean = clusto_query.query.operator.boolean
+    if isinstance(query, (boolean.Intersection, boolean.Union)):
+        return _associative_operands(query)
+    elif isinstance(query, Operator):
+        return [p for p in query.parameters if isinstance(p, QueryObject) and not isinstance(p, Attribute)]
+    elif isinstance(getattr(query, 'query', None), QueryObject):
+        return [query.query]
+    return []
+
+
+def canonical_key(query):
+    """ A hashable key that's equal for subqueries that always match the same hosts
+
+    and/or are commutative, associative and idempotent, so their operands
+    are compared as a set.
+    """
+    boolean = clusto_query.query.operator.boolean
+    if isinstance(query, SharedQuery):
+        return query.key
+    elif isinstance(query, (boolean.Intersection, boolean.Union)):
+        return (query.__class__.__name__, frozenset(canonical_key(p) for p in _associative_operands(query)))
+    elif isinstance(query, Attribute):
+        return ('Attribute', query.key, query.subkey or None, query.number)
+    elif isinstance(query, Operator):
+        return (query.__class__.__name__,) + tuple(canonical_key(p) for p in query.parameters)
+    elif isinstance(getattr(query, 'query', None), QueryObject):
+        # a PushedDownQuery's SQL is compiled from the query it wraps
+        return (query.__class__.__name__, canonical_key(query.query))
+    return (type(query).__name__, query)
+
+
+class SharedQuery(QueryObject):
+    """ A subquery that appears more than once in a query
+
+    Every occurrence is the same SharedQuery. While Context.run_query is
+    running, which hosts it matched is remembered, so each host is only
+    ever checked against it once.
+    """
+
+    def __init__(self, query, key):
+        self.query = query
+        self.key = key
+
+    def __repr__(self):
+        return "SharedQuery(%r)" % (self.query,)
+
+    def run(self, candidate_hosts, context):
+        if context.subquery_results is None:
+            return self.query.run(candidate_hosts, context)
+        checked, matched = context.subquery_results.setdefault(self.key, (set(), set()))
+        unchecked = [h for h in candidate_hosts if h not in checked]
+        if unchecked:
+            matched.update(self.query.run(unchecked, context))
+            checked.update(unchecked)
+        return set(h for h in candidate_hosts if h in matched)
+
+    def visit_iter(self):
+        yield self
+        for p in self.query.visit_iter():
+            yield p
+
+
+def eliminate_common_subexpressions(query):
+    """ Rewrite query so that repeated subqueries become one SharedQuery """
+    return share_common_subexpressions([query])[0]
+
+
+def share_common_subexpressions(queries):
+    """ Rewrite queries so that subqueries repeated anywhere among them become one SharedQuery
+
+    The SharedQuerys only share their results if the queries are run
+    together by Context.run_queries.
+    """
+    boolean = clusto_query.query.operator.boolean
+    counts = collections.Counter()
+    keys = {}
+
+    def count(node):
+        keys[id(node)] = key = canonical_key(node)
+        counts[key] += 1
+        for child in _children(node):
+            count(child)
+
+    for query in queries:
+        count(query)
+    shared = {}
+
+    def rewrite(node, enclosing_count):
+        key = keys[id(node)]
+        if key in shared:
+            return shared[key]
+        children = _children(node)
+        # everything under a shared subquery appears at least as often as
+        # it does, so is only worth sharing on its own if it appears
+        # somewhere else as well
+        is_shared = counts[key] > enclosing_count
+        rewritten_children = [rewrite(c, counts[key] if is_shared else enclosing_count) for c in children]
+        if any(new is not old for new, old in zip(rewritten_children, children)):
+            if isinstance(node, (boolean.Intersection, boolean.Union)):
+                node = node.__class__(*rewritten_children)
+            elif isinstance(node, Operator):
+                replacements = dict((id(old), new) for old, new in zip(children, rewritten_children))
+                node = node.__class__(*[replacements.get(id(p), p) for p in node.parameters])
+            else:
+                node = copy.copy(node)
+                node.query = rewritten_children[0]
+        if is_shared:
+            node = shared[key] = SharedQuery(node, key)
+        return node
+
+    return [rewrite(query, 1) for query in queries]
+
+
+def _matched_types(query):
+    """ The clusto types of every host query can match, or None if it can match any """
+    boolean = clusto_query.query.operator.boolean
+    if isinstance(query, boolean.Intersection):
+        types = None
+        for p in _associative_operands(query):
+            p_types = _matched_types(p)
+            if p_types is not None:
+                types = p_types if types is None else types & p_types
+        return types
+    elif isinstance(query, boolean.Union):
+        types = set()
+        for p in _associative_operands(query):
+            p_types = _matched_types(p)
+            if p_types is None:
+                return None
+            types |= p_types
+        return types
+    elif isinstance(query, boolean.Subtraction):
+        return _matched_types(query.parameters[0])
+    elif isinstance(query, Equality) and query.lhs == 'clusto_type':
+        # compared the same way as Equality does
+        try:
+            return set([str(query.rhs)])
+        except Exception:
+            return None
+    elif isinstance(getattr(query, 'query', None), QueryObject):
+        return _matched_types(query.query)
+    return None
+
+
+def entity_types(queries):
+    """ The clusto types of the entities needed to run queries, or None if that's all of them
+
+    That's the types a query can match, going by clusto_type = x at the
+    top of it (or of every branch of an or), plus pools if it asks for
+    role, which comes from the pools' attributes.
+    """
+    types = set()
+    for query in queries:
+        matched = _matched_types(query)
+        if matched is None:
+            return None
+        types |= matched
+        if any(getattr(node, 'lhs', None) == 'role' for node in query.visit_iter()):
+            types.add('pool')
+    return types
@@ -1,3 +1,4 @@
+import collections
 import re
 
 from clusto_query.exceptions import (StringParseError,
@@ -8,67 +9,175 @@ from clusto_query.query.operator import (UNARY_BOOLEAN_OPERATORS,
                                          SUFFIX_OPERATORS,
                                          INFIX_OPERATORS,
                                          BOOLEAN_OPERATORS)
+from clusto_query.query.operator.boolean import Intersection, Union
 
 
 _attribute_re = re.compile(r'([\w-]+)(\.([\w-]+))?(\:([0-9]+))?')
 
+# boolean operators whose chains are built as one node with every operand
+_FLAT_OPERATORS = (Intersection, Union)
 
-def _expect(token, q):
-    if not q or q[0] != token:
-        raise ExpectedTokenError(token, q[0])
-    else:
-        return q[1:]
+# how many parsed queries cached_parse_query remembers
+PARSE_CACHE_SIZE = 256
+
+
+class _Parser(object):
+    """ Walks a list of tokens with a cursor instead of slicing it
+
+    There's no precedence between boolean operators: a chain of them
+    groups to the right, so 'a and b or c' is 'a and (b or c)' and
+    'a - b - c' is 'a - (b - c)'.
+
+    Errors give the column they're at when the tokens came from lex.
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        # where each token starts in the query, if that's known
+        self.offsets = getattr(tokens, 'offsets', None)
+        self.position = 0
+
+    def rest(self):
+        return list(self.tokens[self.position:])
+
+    def column(self, position=None):
+        """ The column (from 1) of the token at position (default the cursor), or None if it's not known """
+        if self.offsets is None:
+            return None
+        if position is None:
+            position = self.position
+        if position < len(self.offsets):
+            return self.offsets[position] + 1
+        return self.tokens.end + 1
+
+    def _peek(self):
+        if self.position >= len(self.tokens):
+            raise UnexpectedTokenError(self.rest(), self.column())
+        return self.tokens[self.position]
+
+    def _next(self):
+        token = self._peek()
+        self.position += 1
+        return token
+
+    def _expect(self, token):
+        got = self.tokens[self.position] if self.position < len(self.tokens) else None
+        if got != token:
+            raise ExpectedTokenError(token, got, self.column())
+        self.position += 1
+
+    def parse_attribute(self):
+        smd = _attribute_re.match(self._next())
+        if not smd:
+            column = self.column(self.position - 1)
+            raise StringParseError(None if column is None else 'Bad attribute at column %d' % column)
+        return Attribute(smd.group(1), smd.group(3), smd.group(5))
+
+    def parse_expression(self):
+        token = self._peek()
+        if token == "(":
+            self.position += 1
+            lhs = self.parse_boolean()
+            self._expect(")")
+            return lhs
+        elif token == "attr":
+            self.position += 1
+            lhs = self.parse_attribute()
+        elif "." in token:
+            column = self.column()
+            raise StringParseError("Found a . in %s%s; missing attr?" % (
+                token, '' if column is None else ' at column %d' % column))
+        elif token in UNARY_BOOLEAN_OPERATORS:
+            self.position += 1
+            return UNARY_BOOLEAN_OPERATORS[token](self.parse_expression())
+        else:
+            lhs = token
+            self.position += 1
+        token = self._peek()
+        if token in SUFFIX_OPERATORS:
+            self.position += 1
+            return SUFFIX_OPERATORS[token](lhs)
+        elif token in INFIX_OPERATORS:
+            self.position += 1
+            return INFIX_OPERATORS[token](lhs, self._next())
+        raise UnexpectedTokenError(self.rest(), self.column())
+
+    def parse_boolean(self):
+        operands = [self.parse_expression()]
+        operators = []
+        while self.position < len(self.tokens):
+            token = self.tokens[self.position]
+            if token in BOOLEAN_OPERATORS:
+                self.position += 1
+                operators.append(BOOLEAN_OPERATORS[token])
+                operands.append(self.parse_expression())
+            elif token == ")":
+                break
+            else:
+                raise UnexpectedTokenError(self.rest(), self.column())
+        return _group_right(operands, operators)
+
+
+def _group_right(operands, operators):
+    """ Combine operands[i] and what follows it with operators[i], right to left
+
+    Runs of the same and/or become a single node.
+    """
+    kls = None
+    group = [operands[-1]]
+    for i in xrange(len(operators) - 1, -1, -1):
+        operator = operators[i]
+        if operator is kls:
+            group.append(operands[i])
+            continue
+        node = kls(*reversed(group)) if kls is not None else group[0]
+        if operator in _FLAT_OPERATORS:
+            kls = operator
+            group = [node, operands[i]]
+        else:
+            kls = None
+            group = [operator(operands[i], node)]
+    return kls(*reversed(group)) if kls is not None else group[0]
+
+
+def _parse_with(method, q):
+    parser = _Parser(q)
+    result = method(parser)
+    return result, parser.rest()
 
 
 def parse_attribute(q):
-    smd = _attribute_re.match(q[0])
-    if not smd:
-        raise StringParseError
-    return Attribute(smd.group(1), smd.group(3), smd.group(5)), q[1:]
+    return _parse_with(_Parser.parse_attribute, q)
 
 
 def parse_expression(q):
-    if q[0] == "(":
-        lhs, q = parse_boolean(q[1:])
-        q = _expect(")", q)
-        return lhs, q
-    elif q[0] == "attr":
-        lhs, q = parse_attribute(_expect("attr", q))
-    elif "." in q[0]:
-        raise StringParseError("Found a . in %s; missing attr?" % q[0])
-    else:
-        for op, kls in sorted(UNARY_BOOLEAN_OPERATORS.iteritems(), key=len, reverse=True):
-            if op == q[0]:
-                exp, rest = parse_expression(_expect(op, q))
-                return kls(exp), rest
-        else:
-            lhs = q[0]
-            q = q[1:]
-    for op, kls in sorted(SUFFIX_OPERATORS.iteritems(), key=len, reverse=True):
-        if q[0] == op:
-            return kls(lhs), q[1:]
-    for op, kls in sorted(INFIX_OPERATORS.iteritems(), key=len, reverse=True):
-        if q[0] == op:
-            return kls(lhs, q[1]), q[2:]
-    else:
-        raise UnexpectedTokenError(q)
+    return _parse_with(_Parser.parse_expression, q)
 
 
 def parse_boolean(q):
-    lhs, rest = parse_expression(q)
-    if rest:
-        for op, kls in sorted(BOOLEAN_OPERATORS.iteritems(), key=len, reverse=True):
-            if rest[0] == op:
-                rhs, rest = parse_boolean(rest[1:])
-                lhs = kls(lhs, rhs)
-                break
-        else:
-            if rest[0] == ")":
-                return lhs, rest
-            else:
-                raise UnexpectedTokenError(rest)
-    return lhs, rest
+    return _parse_with(_Parser.parse_boolean, q)
 
 
 def parse_query(q):
     return parse_boolean(q)
+
+
+_parse_cache = collections.OrderedDict()
+
+
+def cached_parse_query(q):
+    """ parse_query, remembering the last PARSE_CACHE_SIZE distinct token lists
+
+    Parsed queries are never modified once built, so the same one is
+    handed out every time.
+    """
+    # 1, 1.0 and '1' are all different queries
+    key = tuple((type(token), token) for token in q)
+    try:
+        parsed_query, rest = _parse_cache.pop(key)
+    except KeyError:
+        parsed_query, rest = parse_query(q)
+        if len(_parse_cache) >= PARSE_CACHE_SIZE:
+            _parse_cache.popitem(last=False)
+    _parse_cache[key] = (parsed_query, rest)
+    return parsed_query, list(rest)
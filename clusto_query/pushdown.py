@@ -0,0 +1,174 @@
+"""Push the parts of a query the clusto database can answer down into SQL
+
+The database can't reproduce clusto-query's comparison semantics exactly
+(collations, the number coercion in Attribute._check, multi-valued
+attributes...), so compiled clauses are only ever used to narrow the
+candidate set to a superset of the real answer. The original operator tree
+is then run over that much smaller set to get the exact result.
+"""
+import numbers
+import re
+
+from clusto import ENTITY_TABLE, ATTR_TABLE
+from sqlalchemy import and_, or_, exists
+
+from clusto_query import loader
+from clusto_query import settings
+from clusto_query.hostset import HostSet
+from clusto_query.query import QueryObject
+from clusto_query.query.objects import Attribute
+from clusto_query.query.operator.affix import (ExistsOperator, InfixOperator, Inequality, Equality,
+                                               GT, GE, LT, LE, StartsWith, EndsWith, SubString)
+from clusto_query.query.operator.boolean import (BooleanOperator, UnaryBooleanOperator,
+                                                 Intersection, Union, Subtraction)
+
+
+ENTITY_COLUMNS = {
+    'name': ENTITY_TABLE.c.name,
+    'clusto_type': ENTITY_TABLE.c.type,
+}
+
+# anything made only of these may compare equal to a number once
+# Attribute._check has coerced it
+_numeric_looking_re = re.compile(r'^([0-9.eE+-]*|inf|nan)$')
+
+
+def _like_pattern(operator, rhs):
+    escaped = rhs.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    if isinstance(operator, StartsWith):
+        return escaped + '%'
+    elif isinstance(operator, EndsWith):
+        return '%' + escaped
+    else:
+        return '%' + escaped + '%'
+
+
+def _compile_entity_clause(operator):
+    column = ENTITY_COLUMNS[operator.lhs]
+    if isinstance(operator, Equality):
+        return column == str(operator.rhs)
+    elif isinstance(operator, (StartsWith, EndsWith, SubString)) and isinstance(operator.rhs, basestring):
+        return column.like(_like_pattern(operator, operator.rhs), escape='\\')
+    return None
+
+
+def _compile_value_clause(operator):
+    """ Returns a clause matching a superset of the attribute rows that satisfy operator """
+    rhs = operator.rhs
+    if isinstance(operator, Equality):
+        rhs = str(rhs)
+        if _numeric_looking_re.match(rhs):
+            try:
+                return or_(ATTR_TABLE.c.datatype != 'int', ATTR_TABLE.c.int_value == int(rhs))
+            except ValueError:
+                return ATTR_TABLE.c.datatype != 'int'
+        return or_(
+            and_(ATTR_TABLE.c.datatype == 'string',
+                 or_(ATTR_TABLE.c.string_value == rhs, ATTR_TABLE.c.string_value == None)),
+            ~ATTR_TABLE.c.datatype.in_(['string', 'int'])
+        )
+    elif isinstance(operator, (GT, GE, LT, LE)):
+        if not isinstance(rhs, numbers.Real) or isinstance(rhs, bool):
+            return None
+        if isinstance(operator, GT):
+            int_clause = ATTR_TABLE.c.int_value > rhs
+        elif isinstance(operator, GE):
+            int_clause = ATTR_TABLE.c.int_value >= rhs
+        elif isinstance(operator, LT):
+            int_clause = ATTR_TABLE.c.int_value < rhs
+        else:
+            int_clause = ATTR_TABLE.c.int_value <= rhs
+        return or_(ATTR_TABLE.c.datatype != 'int', int_clause)
+    elif isinstance(operator, (StartsWith, EndsWith, SubString)) and isinstance(rhs, basestring):
+        return or_(ATTR_TABLE.c.datatype != 'string',
+                   ATTR_TABLE.c.string_value.like(_like_pattern(operator, rhs), escape='\\'))
+    return None
+
+
+def _compile_attribute_clause(operator):
+    attribute = operator.lhs
+    if settings.merge_container_attrs:
+        # hosts can match on their parents' attributes
+        return None
+    if isinstance(operator, Inequality):
+        # satisfied by hosts without the attribute at all
+        return None
+    where = [
+        ATTR_TABLE.c.entity_id == ENTITY_TABLE.c.entity_id,
+        ATTR_TABLE.c.deleted_at_version == None,
+        ATTR_TABLE.c.key == attribute.key,
+    ]
+    if attribute.subkey:
+        where.append(ATTR_TABLE.c.subkey == attribute.subkey)
+    if attribute.number is not None:
+        where.append(ATTR_TABLE.c.number == attribute.number)
+    if isinstance(operator, InfixOperator):
+        value_clause = _compile_value_clause(operator)
+        if value_clause is not None:
+            where.append(value_clause)
+    return exists().where(and_(*where))
+
+
+def compile_clause(query):
+    """ Compile query into a where clause against ENTITY_TABLE
+
+    The clause matches a superset of the entities query matches. Returns
+    None if nothing in query narrows the result in SQL.
+    """
+    if isinstance(query, Intersection):
+        clauses = [c for c in map(compile_clause, query.parameters) if c is not None]
+        if clauses:
+            return and_(*clauses)
+    elif isinstance(query, Union):
+        clauses = map(compile_clause, query.parameters)
+        if all(c is not None for c in clauses):
+            return or_(*clauses)
+    elif isinstance(query, Subtraction):
+        return compile_clause(query.parameters[0])
+    elif isinstance(query, (ExistsOperator, InfixOperator)):
+        if isinstance(query.lhs, Attribute):
+            return _compile_attribute_clause(query)
+        elif isinstance(query, InfixOperator) and query.lhs in ENTITY_COLUMNS:
+            return _compile_entity_clause(query)
+    return None
+
+
+class PushedDownQuery(QueryObject):
+    """ Runs query over only the hosts its compiled SQL prefilter returns """
+
+    def __init__(self, query, whereclause):
+        self.query = query
+        self.whereclause = whereclause
+
+    def __repr__(self):
+        return "PushedDownQuery(%r)" % (self.query,)
+
+    def prefiltered(self, context):
+        """ The hosts of context the SQL prefilter returns """
+        hosts = set()
+        for name in loader.entity_names(self.whereclause):
+            host = context.key_for_name(name)
+            if host is not None:
+                hosts.add(host)
+        return hosts
+
+    def run(self, candidate_hosts, context):
+        if not isinstance(candidate_hosts, (set, frozenset, HostSet)):
+            candidate_hosts = set(candidate_hosts)
+        hosts = set(h for h in self.prefiltered(context) if h in candidate_hosts)
+        return self.query.run(hosts, context)
+
+    def visit_iter(self):
+        yield self
+        for p in self.query.visit_iter():
+            yield p
+
+
+def push_down(query):
+    """ Rewrite query so that every maximal subtree with a SQL prefilter uses it """
+    whereclause = compile_clause(query)
+    if whereclause is not None:
+        return PushedDownQuery(query, whereclause)
+    elif isinstance(query, (BooleanOperator, UnaryBooleanOperator)):
+        return query.__class__(*map(push_down, query.parameters))
+    return query
@@ -1,3 +1,4 @@
+import bisect
 import socket
 import struct
 
@@ -6,31 +7,67 @@ from clusto_query.query import QueryObject
 from clusto_query import settings
 
 
+ADDRESS_BITS = {4: 32, 6: 128}
+
+
+def parse_address(address):
+    """Parse a dotted IPv4 or colon-separated IPv6 address
+
+    Returns (version, address as an integer); raises ValueError if it's
+    neither.
+    """
+    if not isinstance(address, basestring):
+        raise ValueError("%r is not an IP address" % (address,))
+    try:
+        if ':' in address:
+            high, low = struct.unpack('!QQ', socket.inet_pton(socket.AF_INET6, address))
+            return 6, (high << 64) | low
+        return 4, struct.unpack('!L', socket.inet_aton(address))[0]
+    except (socket.error, UnicodeError):
+        raise ValueError("%r is not an IP address" % (address,))
+
+
+def parse_cidr(base, mask):
+    """Returns (version, first address, last address) as integers"""
+    version, base = parse_address(base)
+    bits = ADDRESS_BITS[version]
+    mask = int(mask)
+    if not 0 <= mask <= bits:
+        raise ValueError("/%d is not a valid IPv%d netmask" % (mask, version))
+    host_mask = (1 << (bits - mask)) - 1
+    return version, base & ~host_mask, base | host_mask
+
+
 class SimpleCidrSet(object):
     def __init__(self):
+        # sorted, non-overlapping (version, first, last)
         self.ranges = []
 
     def add_cidr(self, base, mask):
         """
-        base: dotted-notation version of the base
+        base: dotted (IPv4) or colon-separated (IPv6) version of the base
         mask: integer for the netmask
         """
-        mask = int(mask)
-        base = struct.unpack('!L', socket.inet_aton(base))[0]
-        maxsz = (01 << 32) - 1
-        mask = 32 - mask
-        mask = ((01 << mask) - 1) & maxsz
-        min_addr = base & ~mask
-        max_addr = base | mask
-        self.ranges.append((min_addr, max_addr))
+        version, first, last = parse_cidr(base, mask)
+        merged = []
+        for r_version, r_first, r_last in self.ranges:
+            if r_version == version and r_first <= last and first <= r_last:
+                first, last = min(first, r_first), max(last, r_last)
+            else:
+                merged.append((r_version, r_first, r_last))
+        bisect.insort(merged, (version, first, last))
+        self.ranges = merged
 
     def __contains__(self, address):
-        """address should be dotted notation"""
-        addr = struct.unpack('!L', socket.inet_aton(address))[0]
-        for mina, maxa in self.ranges:
-            if addr >= mina and addr <= maxa:
-                return True
-        return False
+        """address should be dotted or colon-separated notation"""
+        version, addr = parse_address(address)
+        # the last range starting at or before addr
+        offset = bisect.bisect_left(self.ranges, (version, addr + 1)) - 1
+        if offset < 0:
+            return False
+        r_version, r_first, r_last = self.ranges[offset]
+        return r_version == version and r_first <= addr <= r_last
+
 
 RFC1918 = SimpleCidrSet()
 RFC1918.add_cidr('10.0.0.0', 8)
@@ -53,6 +90,22 @@ class Attribute(QueryObject):
         return "Attribute(%s)" % description
 
     def get(self, host, context):
+        if context.attribute_results is None:
+            return self._get(host, context)
+        memo_key = (host, self.key, self.subkey or None, self.number)
+        if memo_key not in context.attribute_results:
+            context.attribute_results[memo_key] = self._get(host, context)
+        return context.attribute_results[memo_key]
+
+    def _get(self, host, context):
+        prefetched = context.attribute_values(host, self.key, self.subkey or None)
+        if prefetched is not None:
+            resv = {}
+            for v in prefetched:
+                if self.number is not None and v.number != self.number:
+                    continue
+                resv.setdefault((v.key, v.subkey, v.number), []).append(v.value)
+            return resv
         kwargs = {
             'key': self.key,
             'merge_container_attrs': settings.merge_container_attrs
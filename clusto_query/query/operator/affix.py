@@ -1,8 +1,9 @@
 import logging
-import socket
 
 from clusto_query.query.operator.base import Operator
 from clusto_query.query.objects import Attribute, SimpleCidrSet
+from clusto_query.index import is_number
+from clusto_query.hostset import HostSet
 
 
 SUFFIX_OPERATORS = {}
@@ -28,7 +29,10 @@ def _extract_property(host, attribute, context):
     if isinstance(attribute, Attribute):
         return flatten(attribute.get(host, context).values())
     if attribute == "clusto_type":
-        return context.entity_map[host]._clusto_type
+        # context keys are built from the Driver's _clusto_type and name
+        return host.item_type
+    elif attribute == "name":
+        return host.name
     elif attribute == "role":
         return context.role_for_host(host)
     elif attribute in context.CONTEXT_TYPES:
@@ -37,6 +41,49 @@ def _extract_property(host, attribute, context):
         return getattr(context.entity_map[host], attribute)
 
 
+def _load_for(attribute, candidate_hosts, context):
+    """ Load what _extract_property needs to look attribute up for all of candidate_hosts at once """
+    if isinstance(attribute, Attribute):
+        context.prefetch_attributes([attribute], candidate_hosts)
+    elif attribute not in ("clusto_type", "name", "role") and attribute not in context.CONTEXT_TYPES:
+        # read off each host's Driver
+        context.entity_map.load(candidate_hosts)
+
+
+def _restrict(hosts, candidate_hosts):
+    """ Return the members of hosts that are also in candidate_hosts """
+    if not isinstance(candidate_hosts, (set, frozenset, HostSet)):
+        candidate_hosts = set(candidate_hosts)
+    if len(hosts) < len(candidate_hosts):
+        return set(h for h in hosts if h in candidate_hosts)
+    return set(h for h in candidate_hosts if h in hosts)
+
+
+def _text(value):
+    """ value as unicode if it's a string that can safely be compared to unicode, else None """
+    if isinstance(value, str):
+        try:
+            return value.decode('ascii')
+        except UnicodeDecodeError:
+            return None
+    elif isinstance(value, unicode):
+        return value
+    return None
+
+
+def _membership_groups(attribute, candidate_hosts, context):
+    """ (value, hosts with that value) pairs for clusto_type, a context type or role """
+    if attribute == "clusto_type":
+        index = context.type_index(candidate_hosts)
+        return index.items() if index is not None else None
+    elif attribute == "role":
+        return context.role_index().items()
+    elif isinstance(attribute, basestring) and attribute in context.CONTEXT_TYPES:
+        return [(_extract_name_from_key(parent), hosts)
+                for parent, hosts in context.members(attribute).iteritems()]
+    return None
+
+
 class SuffixOperator(Operator):
     operator_map = SUFFIX_OPERATORS
 
@@ -52,7 +99,25 @@ class ExistsOperator(SuffixOperator):
         prop = _extract_property(host, self.lhs, context)
         return bool(prop)
 
+    def lookup(self, candidate_hosts, context):
+        """ Answer this clause from an index; None if hosts have to be checked one by one """
+        groups = _membership_groups(self.lhs, candidate_hosts, context)
+        if groups is None:
+            return None
+        hosts = set()
+        for _, members in groups:
+            hosts.update(members)
+        return _restrict(hosts, candidate_hosts)
+
     def run(self, candidate_hosts, context):
+        indexed = self.lookup(candidate_hosts, context)
+        if indexed is not None:
+            return indexed
+        return self.scan(candidate_hosts, context)
+
+    def scan(self, candidate_hosts, context):
+        """ Check candidate_hosts one by one """
+        _load_for(self.lhs, candidate_hosts, context)
         hosts = set()
         for host in candidate_hosts:
             if self._exists(host, context):
@@ -72,8 +137,51 @@ class InfixOperator(Operator):
     def get_host_attribute(self, host, attribute, context):
         return _extract_property(host, attribute, context)
 
+    def satisfy_all(self):
+        return (self.lhs == 'pool' or isinstance(self.lhs, Attribute)) and not self.satisfy_any_with_pool
+
+    def _match_groups(self, groups, candidate_hosts):
+        """ Match candidate_hosts against (value, hosts with that value) pairs
+
+        Hosts in no group are treated as having no values at all.
+        """
+        if self.satisfy_all():
+            failing = set()
+            for value, hosts in groups:
+                if not self.comparator(value, self.rhs):
+                    failing.update(hosts)
+            return set(h for h in candidate_hosts if h not in failing)
+        matching = set()
+        for value, hosts in groups:
+            if self.comparator(value, self.rhs):
+                matching.update(hosts)
+        return _restrict(matching, candidate_hosts)
+
+    def lookup(self, candidate_hosts, context):
+        """ Answer this clause from an index; None if hosts have to be checked one by one """
+        groups = _membership_groups(self.lhs, candidate_hosts, context)
+        if groups is None:
+            return None
+        results = self._match_groups(groups, candidate_hosts)
+        if self.lhs == "role":
+            # hosts without a role compare as None rather than having no values
+            roleless = _restrict(candidate_hosts, candidate_hosts)
+            for _, hosts in groups:
+                roleless -= hosts
+            if roleless and self.comparator(None, self.rhs):
+                results |= roleless
+        return results
+
     def run(self, candidate_hosts, context):
+        indexed = self.lookup(candidate_hosts, context)
+        if indexed is not None:
+            return indexed
+        return self.scan(candidate_hosts, context)
+
+    def scan(self, candidate_hosts, context):
+        """ Check candidate_hosts one by one """
         results = set()
+        _load_for(self.lhs, candidate_hosts, context)
 
         for host in candidate_hosts:
             log.debug("Checking %s for %s key %s and %s",
@@ -85,8 +193,7 @@ class InfixOperator(Operator):
             match = False
             if not isinstance(lhses, (list, set, tuple)):
                 lhses = [lhses]
-            if (self.lhs == 'pool' or isinstance(self.lhs, Attribute)) and \
-                    not self.satisfy_any_with_pool:
+            if self.satisfy_all():
                 log.debug('satisfying all')
                 match = all(self.comparator(lhs, self.rhs) for lhs in lhses)
             else:
@@ -123,57 +230,135 @@ class Inequality(InfixOperator):
         return lhs != rhs
 
 
-class GT(InfixOperator):
+class RangeOperator(InfixOperator):
+    """ Numeric bounds on an attribute are answered from a SortedValueIndex """
+    # whether this is a lower bound (> / >=) or an upper one (< / <=)
+    lower = None
+    inclusive = None
+
+    def lookup(self, candidate_hosts, context):
+        if isinstance(self.lhs, Attribute) and is_number(self.rhs):
+            index = context.value_index(self.lhs, candidate_hosts)
+            if index is not None:
+                if self.lower:
+                    return _restrict(index.above(self.rhs, self.inclusive), candidate_hosts)
+                return _restrict(index.below(self.rhs, self.inclusive), candidate_hosts)
+        return super(RangeOperator, self).lookup(candidate_hosts, context)
+
+
+class GT(RangeOperator):
     operator = ">"
+    lower = True
+    inclusive = False
 
     @staticmethod
     def comparator(lhs, rhs):
         return lhs > rhs
 
 
-class GE(InfixOperator):
+class GE(RangeOperator):
     operator = ">="
+    lower = True
+    inclusive = True
 
     @staticmethod
     def comparator(lhs, rhs):
         return lhs >= rhs
 
 
-class LT(InfixOperator):
+class LT(RangeOperator):
     operator = "<"
+    lower = False
+    inclusive = False
 
     @staticmethod
     def comparator(lhs, rhs):
         return lhs < rhs
 
 
-class LE(InfixOperator):
+class LE(RangeOperator):
     operator = "<="
+    lower = False
+    inclusive = True
 
     @staticmethod
     def comparator(lhs, rhs):
         return lhs <= rhs
 
 
-class StartsWith(InfixOperator):
+class Between(Operator):
+    """ A lower and an upper RangeOperator on the same attribute
+
+    Built by optimizer.merge_ranges; never parsed directly. When every host
+    has a single value this is one slice of the SortedValueIndex.
+    """
+
+    def __init__(self, lower, upper):
+        self.lower = lower
+        self.upper = upper
+        super(Between, self).__init__(lower, upper)
+
+    def run(self, candidate_hosts, context):
+        index = context.value_index(self.lower.lhs, candidate_hosts)
+        if index is not None and index.single_valued:
+            return _restrict(index.between(self.lower.rhs, self.lower.inclusive,
+                                           self.upper.rhs, self.upper.inclusive),
+                             candidate_hosts)
+        return self.upper.run(self.lower.run(candidate_hosts, context), context)
+
+
+class AffixOperator(InfixOperator):
+    """ Prefix/suffix matches on name or hostname are answered from an AffixIndex """
+    indexed_properties = ('name', 'hostname')
+
+    def lookup(self, candidate_hosts, context):
+        rhs = _text(self.rhs)
+        if self.lhs in self.indexed_properties and rhs is not None:
+            index = context.affix_index(self.lhs, candidate_hosts)
+            if index is not None:
+                return _restrict(self.affix_lookup(index, rhs), candidate_hosts)
+        return super(AffixOperator, self).lookup(candidate_hosts, context)
+
+    @staticmethod
+    def affix_lookup(index, rhs):
+        raise NotImplementedError()
+
+
+class StartsWith(AffixOperator):
     operator = ("^", "startswith")
 
     @staticmethod
     def comparator(lhs, rhs):
         return lhs.startswith(rhs)
 
+    @staticmethod
+    def affix_lookup(index, rhs):
+        return index.prefixed(rhs)
+
 
-class EndsWith(InfixOperator):
+class EndsWith(AffixOperator):
     operator = (",", "endswith")
 
     @staticmethod
     def comparator(lhs, rhs):
         return lhs.endswith(rhs)
 
+    @staticmethod
+    def affix_lookup(index, rhs):
+        return index.suffixed(rhs)
+
 
 class SubString(InfixOperator):
     operator = "contains"
 
+    def lookup(self, candidate_hosts, context):
+        rhs = _text(self.rhs)
+        if rhs is not None and (self.lhs in ('name', 'hostname') or isinstance(self.lhs, Attribute)):
+            index = context.trigram_index(self.lhs, candidate_hosts)
+            if index is not None:
+                return _restrict(index.containing(rhs), candidate_hosts)
+        return super(SubString, self).lookup(candidate_hosts, context)
+
     @staticmethod
     def comparator(lhs, rhs):
         return rhs in lhs
@@ -186,17 +371,19 @@ class InCidr(InfixOperator):
         super(InCidr, self).__init__(lhs, rhs)
         try:
             base, mask = rhs.split("/")
-            base = socket.inet_ntoa(socket.inet_aton(base))  # check parse
-            mask = int(mask)
-            assert mask >= 0 and mask < 32
-        except:
+            self.cidr_set = SimpleCidrSet()
+            self.cidr_set.add_cidr(base, mask)
+        except (AttributeError, ValueError):
             raise ValueError("RHS must be a Cidr (base/mask)")
-
-    @staticmethod
-    def comparator(lhs, rhs):
-        # TODO(jbrown): Support IPv6
-        query = socket.inet_ntoa(socket.inet_aton(lhs))  # check parse
-        cidr_set = SimpleCidrSet()
-        base, mask = rhs.split("/")
-        cidr_set.add_cidr(base, mask)
-        return query in cidr_set
+        self.network = self.cidr_set.ranges[0]
+
+    def lookup(self, candidate_hosts, context):
+        if isinstance(self.lhs, Attribute):
+            index = context.address_index(self.lhs, candidate_hosts)
+            if index is not None:
+                return _restrict(index.within(*self.network), candidate_hosts)
+        return super(InCidr, self).lookup(candidate_hosts, context)
+
+    def comparator(self, lhs, rhs):
+        # rhs was parsed into cidr_set up front
+        return lhs in self.cidr_set
@@ -1,5 +1,5 @@
 from clusto_query.query.operator.base import Operator
-from clusto_query import optimizer
+import clusto_query.optimizer
 
 
 BOOLEAN_OPERATORS = {}
@@ -13,10 +13,25 @@ class BooleanOperator(Operator):
 class Intersection(BooleanOperator):
     operator = ("&", "and")
 
+    def operands(self):
+        """ The parameters of this and any directly nested Intersections """
+        operands = []
+        for p in self.parameters:
+            if isinstance(p, Intersection):
+                operands.extend(p.operands())
+            else:
+                operands.append(p)
+        return operands
+
     def run(self, candidate_hosts, context):
-        results = set(candidate_hosts)
-        for p in optimizer.sort_clauses(self.parameters):
-            results &= p.run(results, context)
+        # every operator only ever returns a subset of the hosts it's given,
+        # so each clause just narrows what the previous one returned
+        optimizer = clusto_query.optimizer
+        results = candidate_hosts
+        for p in optimizer.sort_clauses(optimizer.merge_ranges(self.operands()), context):
+            results = p.run(results, context)
+            if not results:
+                break
         return results
 
 
@@ -24,9 +39,20 @@ class Union(BooleanOperator):
     operator = ("|", "or")
 
     def run(self, candidate_hosts, context):
+        host_ids = context.host_ids()
         results = set()
+        remaining = candidate_hosts
         for p in self.parameters:
-            results |= p.run(candidate_hosts, context)
+            matched = p.run(remaining, context)
+            if matched:
+                results = host_ids.union(results, matched)
+                # hosts an earlier branch matched don't need checking again,
+                # unless there are too few to be worth building a bitmap to
+                # take them out
+                if host_ids.small(remaining) or not host_ids.small(matched):
+                    remaining = host_ids.difference(remaining, matched)
+                    if not remaining:
+                        break
         return results
 
 
@@ -34,9 +60,12 @@ class Subtraction(BooleanOperator):
     operator = "-"
 
     def run(self, candidate_hosts, context):
+        host_ids = context.host_ids()
         results = self.parameters[0].run(candidate_hosts, context)
         for p in self.parameters[1:]:
-            results -= p.run(candidate_hosts, context)
+            if not results:
+                break
+            results = host_ids.difference(results, p.run(results, context))
         return results
 
 
@@ -48,4 +77,4 @@ class Not(UnaryBooleanOperator):
     operator = ("not", "~")
 
     def run(self, candidate_hosts, context):
-        return set(candidate_hosts) - self.parameters[0].run(candidate_hosts, context)
+        return context.host_ids().difference(candidate_hosts, self.parameters[0].run(candidate_hosts, context))
@@ -4,22 +4,40 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import collections
+import cStringIO
+import csv
+import heapq
 import itertools
+import json
 import logging
 import optparse
 import os
+import signal
+import socket
 import sys
 import string
+import time
 
 import clusto
 import clusto.script_helper
+from clusto.drivers.base.device import Device
+from clusto.drivers.devices.common import IPMixin
 
 
 from clusto_query.query.objects import RFC1918
 from clusto_query.lexer import lex, SEARCH_KEYWORDS
-from clusto_query.parser import parse_query
+from clusto_query.parser import cached_parse_query
+from clusto_query.pushdown import push_down
+from clusto_query.optimizer import eliminate_common_subexpressions, share_common_subexpressions, entity_types
+from clusto_query import loader
+from clusto_query.compiler import compile_query
+from clusto_query import columnar
+from clusto_query import server
+from clusto_query.exceptions import ExpectedTokenError, UnexpectedTokenError, StringParseError
 from clusto_query import settings
-from clusto_query.context import Context
+from clusto_query import snapshot
+from clusto_query.context import Context, PREFETCH_BATCH_SIZE
 from clusto_query.query.operator.affix import Equality, Inequality
 from clusto_query.query.operator.boolean import Intersection
 
@@ -78,46 +96,126 @@ Quoting and parens work the way you expect them to.
 }
 
 
-log = None
+log = logging.getLogger("clusto-query-logger")
+
+OUTPUT_FORMATS = ('text', 'json', 'csv', 'nul')
 
 
 class HostFormatter(object):
     option = None
     default = False
+    # placeholders answered from the host's ContextKey and the Context alone
+    KEY_PLACEHOLDERS = ('name', 'type', 'role')
 
-    def __init__(self, host, context):
+    def __init__(self, host, context, prefetched=None):
+        # a ContextKey; its Driver is only fetched if a placeholder needs it
         self.host = host
         self.context = context
+        # placeholder -> value, for whatever prefetch() loaded for this host
+        self.prefetched = prefetched or {}
+
+    @classmethod
+    def needs_driver(cls, placeholders, prefetched=None):
+        """ Whether formatting placeholders for a host with prefetched reads anything off its Driver """
+        prefetched = prefetched or {}
+        return any(p not in cls.KEY_PLACEHOLDERS and p not in prefetched for p in placeholders)
+
+    @classmethod
+    def prefetch(cls, placeholders, hosts, context):
+        """ Load what placeholders need for all of hosts in bulk
+
+        Returns a dict mapping each host (a ContextKey) to the prefetched
+        argument for its HostFormatter. Anything that isn't in there for a
+        host is read off its Driver as usual.
+        """
+        prefetched = dict((host, {}) for host in hosts)
+        keys = set()
+        if 'hostname' in placeholders:
+            keys.add(('hostname', None))
+        if 'internal_ips' in placeholders or 'public_ips' in placeholders:
+            keys.add(('ip', 'ipstring'))
+        for item in placeholders:
+            if item.count(".") == 1:
+                keys.add(tuple(item.split(".")))
+
+        values = dict((key, collections.defaultdict(list)) for key in keys)
+        racks = collections.defaultdict(list)
+        by_name = dict((host.name, host) for host in hosts)
+        names = list(by_name)
+        for offset in xrange(0, len(names), PREFETCH_BATCH_SIZE):
+            batch = names[offset:offset + PREFETCH_BATCH_SIZE]
+            if keys:
+                for row in loader.attribute_rows(keys, batch):
+                    for key, subkey in ((row.key, row.subkey), (row.key, None)):
+                        if (key, subkey) in values:
+                            values[key, subkey][by_name[row.entity_name]].append(row)
+            if 'rack' in placeholders:
+                for row in loader.containers(batch):
+                    parent_class = clusto.driverlist.get(row.parent_driver)
+                    if parent_class is not None and issubclass(parent_class, clusto.drivers.racks.BasicRack):
+                        racks[by_name[row.child_name]].append(row.parent_name)
+
+        for host in hosts:
+            items = prefetched[host]
+            driver_class = context.entity_map.driver_class(host)
+            if 'rack' in placeholders:
+                items['rack'] = ','.join(racks.get(host, ()))
+            if 'hostname' in placeholders and getattr(driver_class, 'hostname', None) is Device.hostname:
+                rows = values['hostname', None].get(host)
+                if not rows:
+                    items['hostname'] = host.name
+                elif not rows[0].is_relation:
+                    items['hostname'] = rows[0].value
+            if ('ip', 'ipstring') in values and getattr(driver_class, 'get_ips', None) == IPMixin.get_ips:
+                ips = [row.value for row in values['ip', 'ipstring'].get(host, ())]
+                if 'internal_ips' in placeholders:
+                    items['internal_ips'] = ",".join(ip for ip in ips if ip in RFC1918)
+                if 'public_ips' in placeholders:
+                    items['public_ips'] = ",".join(ip for ip in ips if ip not in RFC1918)
+            for item in placeholders:
+                if item.count(".") == 1:
+                    rows = values[tuple(item.split("."))].get(host, ())
+                    # relations print as Drivers; leave those to clusto
+                    if not any(row.is_relation for row in rows):
+                        items[item] = ",".join(str(row.value) for row in rows)
+        return prefetched
+
+    @property
+    def driver(self):
+        return self.context.entity_map[self.host]
 
     def name(self):
         return self.host.name
 
     def hostname(self):
-        return self.host.hostname
+        return self.driver.hostname
 
     def role(self):
         return self.context.role_for_host(self.host)
 
     def internal_ips(self):
-        return ",".join(ip for ip in self.host.get_ips() if ip in RFC1918)
+        return ",".join(ip for ip in self.driver.get_ips() if ip in RFC1918)
 
     def public_ips(self):
-        return ",".join(ip for ip in self.host.get_ips() if ip not in RFC1918)
+        return ",".join(ip for ip in self.driver.get_ips() if ip not in RFC1918)
 
     def rack(self):
         return ','.join(
             p.name for p
-            in self.host.parents()
+            in self.driver.parents()
             if isinstance(p, clusto.drivers.racks.BasicRack)
         )
 
     def type(self):
-        return self.host.type
+        # the Driver's type is the clusto type its key was made from
+        return self.host.item_type
 
     def __getitem__(self, item):
+        if item in self.prefetched:
+            return self.prefetched[item]
         if "." in item:
             key, subkey = item.split(".")
-            return ",".join(map(str, (k.value for k in self.host.attrs(key=key, subkey=subkey))))
+            return ",".join(map(str, (k.value for k in self.driver.attrs(key=key, subkey=subkey))))
         return getattr(self, item)()
 
 
@@ -126,6 +224,319 @@ class EasierTemplate(string.Template):
     delimiter = "%"
     idpattern = r'[a-z_][a-zA-Z0-9_.-]*'
 
+    def placeholders(self):
+        """ The names substituted into this template, in the order they first appear """
+        names = []
+        for match in self.pattern.finditer(self.template):
+            name = match.group('named') or match.group('braced')
+            if name is not None and name not in names:
+                names.append(name)
+        return names
+
+
+# how each --engine runs a query
+ENGINES = {
+    'compiled': compile_query,
+    'interpreted': None,
+    'columnar': columnar.columnar_query,
+}
+
+
+def for_engine(query, engine):
+    """ Wrap query to be run by engine (one of ENGINES) """
+    wrap = ENGINES[engine]
+    return wrap(query) if wrap is not None else query
+
+
+def prepare_query(raw_query, pushdown=True, type_filter=None, share=True, engine='compiled'):
+    """ Parse raw_query and rewrite it for running; returns None if it doesn't all parse
+
+    If share is False, common subexpressions are left for the caller to
+    share (and hand to an engine). Otherwise the query is wrapped to be
+    run by engine: 'compiled' to a predicate, 'columnar' over NumPy arrays
+    or 'interpreted' operator by operator.
+    """
+    log.info("Going to parse %r", raw_query)
+    lexed_query = lex(raw_query)
+    log.info("Lexed into %r", lexed_query)
+    parsed_query, unparsed = cached_parse_query(lexed_query)
+    log.info("Parsed into %r", parsed_query)
+    if unparsed:
+        log.warning("Unparsed content: %r", unparsed)
+        return None
+
+    if type_filter is not None:
+        def look_for_type(node):
+            if isinstance(node, (Equality, Inequality)) and\
+                    ('type' in node.parameters or 'clusto_type' in node.parameters) and\
+                    'server' in node.parameters:
+                return True
+            return False
+
+        if not any(look_for_type(node) for node in parsed_query.visit_iter()):
+            log.debug('Adding intersection with type=%s' % type_filter)
+            parsed_query = Intersection(
+                parsed_query,
+                Equality('clusto_type', type_filter)
+            )
+            log.info('After intersection, parsed into %r', parsed_query)
+        else:
+            log.debug('Not adding type intersection')
+
+    if pushdown:
+        parsed_query = push_down(parsed_query)
+        log.info('After pushdown, parsed into %r', parsed_query)
+
+    if share:
+        parsed_query = eliminate_common_subexpressions(parsed_query)
+        log.debug('After eliminating common subexpressions, parsed into %r', parsed_query)
+        parsed_query = for_engine(parsed_query, engine)
+    return parsed_query
+
+
+def _ordered_results(results, limit, unsorted):
+    if unsorted:
+        return list(itertools.islice(results, limit))
+    elif limit is not None:
+        return heapq.nsmallest(limit, results)
+    return sorted(results)
+
+
+def _csv_record(values):
+    row = cStringIO.StringIO()
+    csv.writer(row, lineterminator='').writerow([(u'%s' % v).encode('utf-8') for v in values])
+    return row.getvalue().decode('utf-8')
+
+
+def output_records(results, context, formatter, output_format='text', limit=None, unsorted=False, count=False):
+    """ Yield a record of output for each of the ContextKeys in results to be printed
+
+    Results are sorted unless unsorted, and only the first limit are
+    printed if limit isn't None. With count, the only record is how many
+    results there are. Hosts are formatted a batch at a time, so the first
+    records come out before the rest have been loaded. Drivers are only
+    fetched for hosts with a placeholder that prefetching can't fill in.
+    """
+    if count:
+        yield u'%d' % len(results)
+        return
+    format_template = EasierTemplate(formatter)
+    placeholders = format_template.placeholders()
+    if output_format == 'csv':
+        yield _csv_record(placeholders)
+    results = _ordered_results(results, limit, unsorted)
+    for offset in xrange(0, len(results), PREFETCH_BATCH_SIZE):
+        batch = results[offset:offset + PREFETCH_BATCH_SIZE]
+        prefetched = HostFormatter.prefetch(placeholders, batch, context)
+        context.entity_map.load([h for h in batch if HostFormatter.needs_driver(placeholders, prefetched[h])])
+        for result_key in batch:
+            host_formatter = HostFormatter(result_key, context, prefetched[result_key])
+            if output_format == 'json':
+                yield json.dumps(collections.OrderedDict((p, host_formatter[p]) for p in placeholders),
+                                 default=lambda value: '%s' % value)
+            elif output_format == 'csv':
+                yield _csv_record([host_formatter[p] for p in placeholders])
+            else:
+                yield format_template.substitute(host_formatter)
+
+
+def write_records(records, output_format, out=None):
+    """ Write records to out (default stdout), each followed by a newline or, for nul, a NUL """
+    if out is None:
+        out = sys.stdout
+    terminator = '\0' if output_format == 'nul' else '\n'
+    for record in records:
+        out.write(record.encode('utf-8') + terminator)
+
+
+def output_options(opts):
+    """ The arguments to output_records that opts asks for """
+    return {
+        'formatter': opts.formatter,
+        'output_format': opts.output_format,
+        'limit': opts.limit,
+        'unsorted': opts.unsorted,
+        'count': opts.count,
+    }
+
+
+def read_batch(batch_file):
+    """ Return the queries in batch_file, one per line; blank lines and # comments are skipped """
+    queries = []
+    for line in batch_file:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            queries.append(line)
+    return queries
+
+
+def run_batch(raw_queries, opts, conf, type_filter):
+    """ Run every one of raw_queries against one Context, printing each one's results under it
+
+    Returns 1 if any of them didn't parse.
+    """
+    status = 0
+    output = output_options(opts)
+    parsed_queries = []
+    for raw_query in raw_queries:
+        try:
+            parsed_query = prepare_query(raw_query, not opts.no_pushdown, type_filter, share=False)
+        except (ExpectedTokenError, UnexpectedTokenError, StringParseError) as e:
+            log.error('Unable to parse %r: %s', raw_query, e)
+            parsed_query = None
+        if parsed_query is None:
+            status = 1
+        parsed_queries.append(parsed_query)
+    runnable = share_common_subexpressions([q for q in parsed_queries if q is not None])
+    runnable = [for_engine(q, opts.engine) for q in runnable]
+
+    context, snapshot_path = load_context(opts, conf, needed_entity_types(runnable, opts.formatter))
+    results = iter(context.run_queries(runnable))
+    save_context(context, snapshot_path, conf)
+
+    for raw_query, parsed_query in zip(raw_queries, parsed_queries):
+        write_records([u'# %s' % raw_query], output['output_format'])
+        if parsed_query is not None:
+            write_records(output_records(next(results), context, **output), output['output_format'])
+    return status
+
+
+def needed_entity_types(queries, formatter):
+    """ The clusto types of the entities needed to run queries and format their results, or None for all """
+    types = entity_types(queries)
+    if types is not None and 'role' in EasierTemplate(formatter).placeholders():
+        types.add('pool')
+    return types
+
+
+def load_context(opts, conf, types=None):
+    """ Return a Context, from a snapshot if there's a usable one, and where to save it
+
+    A snapshot holds every entity, so if there isn't a usable one and types
+    isn't None, only entities of types are loaded and nothing is saved. The
+    location is None whenever there's nothing to save.
+    """
+    # snapshots can only be brought up to date if clusto is versioned
+    if opts.no_cache or not clusto.SESSION.clusto_versioning_enabled:
+        return Context(clusto, entity_types=types), None
+    version = clusto.get_latest_version_number()
+    dsn = conf.get('clusto', 'dsn')
+    snapshot_path = snapshot.snapshot_path(opts.cache_dir, dsn)
+    saved = snapshot.load(snapshot_path, dsn)
+    if saved is not None:
+        context = Context(clusto, snapshot=saved)
+        if context.refresh(version):
+            log.debug('Using snapshot %s', snapshot_path)
+            return context, snapshot_path
+        log.info('Snapshot %s is too far behind clusto', snapshot_path)
+    if types is not None:
+        return Context(clusto, entity_types=types), None
+    return Context(clusto), snapshot_path
+
+
+def save_context(context, snapshot_path, conf):
+    """ Snapshot context to snapshot_path, unless that's None or it isn't worth it """
+    if snapshot_path is not None and context.worth_saving():
+        snapshot.save(snapshot_path, conf.get('clusto', 'dsn'), context.to_snapshot())
+
+
+class QueryDaemon(object):
+    """ Keeps a Context warm and answers requests from clients with it
+
+    The Context is refreshed whenever clusto's version changes or, if
+    clusto isn't versioned, rebuilt once it's older than refresh_interval
+    seconds. In that case every response says how old it is.
+    """
+
+    def __init__(self, opts, conf):
+        self.opts = opts
+        self.conf = conf
+        self.context = None
+
+    def load(self):
+        self.context, self.snapshot_path = load_context(self.opts, self.conf)
+        self.loaded_at = time.time()
+
+    def _update(self):
+        # end the last request's transaction so that changes since are visible
+        clusto.SESSION.rollback()
+        if clusto.SESSION.clusto_versioning_enabled:
+            version = clusto.get_latest_version_number()
+            if version != self.context.version and not self.context.refresh(version):
+                log.info('clusto has changed too much; reloading')
+                self.load()
+        elif time.time() - self.loaded_at > self.opts.refresh_interval:
+            self.load()
+
+    def save(self):
+        if self.context is not None:
+            save_context(self.context, self.snapshot_path, self.conf)
+
+    def __call__(self, request):
+        if request['merge_container_attrs'] != bool(settings.merge_container_attrs):
+            return {'unsupported': 'the daemon was started with%s --merge-container-attrs' % (
+                '' if settings.merge_container_attrs else 'out')}
+        if request['engine'] == 'columnar' and not columnar.HAVE_NUMPY:
+            return {'unsupported': 'the daemon has no numpy for --columnar'}
+        parsed_query = prepare_query(request['query'], request['pushdown'], request['type_filter'],
+                                     engine=request['engine'])
+        if parsed_query is None:
+            return {'status': 1, 'output': []}
+        if self.context is None:
+            self.load()
+        else:
+            self._update()
+        results = self.context.run_query(parsed_query)
+        response = {'status': 0, 'output': list(output_records(results, self.context, **request['output']))}
+        if not clusto.SESSION.clusto_versioning_enabled:
+            # changes since it was loaded can't be seen
+            response['age'] = time.time() - self.loaded_at
+        return response
+
+
+def ask_daemon(path, request, output_format):
+    """ Have the daemon listening at path answer request, and print what it says
+
+    Returns the exit status, or None if there's no daemon that can answer
+    and the query has to be run in this process.
+    """
+    response = server.send_request(path, request)
+    if response is None:
+        log.debug('No daemon listening on %s', path)
+        return None
+    elif 'unsupported' in response:
+        log.info('Not using the daemon: %s', response['unsupported'])
+        return None
+    elif 'error' in response:
+        log.error('The daemon failed: %s', response['error'])
+        return 1
+    if response.get('age') is not None:
+        log.warning("clusto isn't versioned, so the daemon's answer may be up to %d seconds out of date "
+                    "(--no-daemon to ask clusto)", response['age'])
+    write_records(response['output'], output_format)
+    return response['status']
+
+
+def serve(opts, conf, path):
+    daemon = QueryDaemon(opts, conf)
+    try:
+        query_server = server.QueryServer(path, daemon)
+    except socket.error as e:
+        log.error('Unable to listen on %s: %s', path, e)
+        return 1
+    daemon.load()
+    # make sure a plain kill still cleans up
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    log.info('Listening on %s', path)
+    try:
+        query_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        query_server.server_close()
+        daemon.save()
+    return 0
+
 
 def main():
     global log
@@ -133,6 +544,15 @@ def main():
     parser.add_option('-v', '--verbose', action='count', default=0)
     parser.add_option('-f', '--formatter', default=r"%name",
                       help='Formatter to use for printing, default "%default"')
+    parser.add_option('-o', '--output-format', choices=OUTPUT_FORMATS, default='text',
+                      help='One of %s; json and csv have a field per placeholder in the formatter '
+                      '(default %%default)' % ', '.join(OUTPUT_FORMATS))
+    parser.add_option('-n', '--limit', type='int', default=None,
+                      help='Print at most this many results')
+    parser.add_option('--unsorted', action='store_true', default=False,
+                      help="Print results in no particular order, without sorting them first")
+    parser.add_option('-c', '--count', action='store_true', default=False,
+                      help='Print how many results there are instead of the results')
     parser.add_option('--list-attributes', default=False, action='store_true',
                       help='Print all the queryable attributes')
     parser.add_option('--clusto-config', default='/etc/clusto/clusto.conf',
@@ -142,7 +562,31 @@ def main():
         '-m', '--merge-container-attrs', action='store_true',
         help="When showing attributes, merge in parents' attributes"
     )
+    parser.add_option('--no-pushdown', action='store_true', default=False,
+                      help="Don't narrow the query with SQL run against the clusto database")
+    parser.add_option('--interpreted', action='store_const', dest='engine', const='interpreted', default='compiled',
+                      help="Run the query operator by operator instead of compiling it first")
+    parser.add_option('--columnar', action='store_const', dest='engine', const='columnar',
+                      help="Evaluate the query over NumPy arrays of every host's attributes (needs numpy)")
+    parser.add_option('--cache-dir', default=snapshot.DEFAULT_CACHE_DIR,
+                      help='Directory to keep context snapshots in (default %default)')
+    parser.add_option('--no-cache', action='store_true', default=False,
+                      help="Don't read or write context snapshots")
+    parser.add_option('--batch', metavar='FILE', default=None,
+                      help='Run every query in FILE (one per line, - for stdin) against one context')
+    parser.add_option('--serve', action='store_true', default=False,
+                      help='Keep a context in memory and answer queries from other clusto-query runs')
+    parser.add_option('--socket', default=None,
+                      help='Unix socket the daemon listens on (default: in the cache directory)')
+    parser.add_option('--no-daemon', action='store_true', default=False,
+                      help="Don't ask a running daemon; always run the query in this process")
+    parser.add_option('--refresh-interval', type='float', default=60,
+                      help='Seconds a daemon keeps its context if clusto is not versioned (default %default)')
     opts, args = parser.parse_args()
+    if opts.limit is not None and opts.limit < 0:
+        parser.error("--limit can't be negative")
+    if opts.engine == 'columnar' and not columnar.HAVE_NUMPY:
+        parser.error("--columnar needs numpy")
 
     level = logging.WARNING
     if opts.verbose == 1:
@@ -169,50 +613,57 @@ def main():
     log.addHandler(handler)
     log.setLevel(level)
 
+    socket_path = opts.socket or server.socket_path(opts.cache_dir, conf.get('clusto', 'dsn'))
+
     if opts.list_attributes:
         all_attrs = [it.attrs() for it in clusto.get_entities()]
         print("\n".join(sorted(set([".".join(map(str, (at.key, at.subkey)))
                                     for at in itertools.chain.from_iterable(all_attrs)]))))
         return 0
 
+    if opts.serve:
+        return serve(opts, conf, socket_path)
+
+    # stop quietly as soon as whatever's reading the output (head, say) goes away
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+    type_filter = os.environ.get('CLUSTO_TYPE_FILTER', None)
+
+    if opts.batch is not None:
+        if args:
+            parser.error("Queries can't be given as arguments with --batch")
+        if opts.batch == '-':
+            raw_queries = read_batch(sys.stdin)
+        else:
+            with open(opts.batch) as batch_file:
+                raw_queries = read_batch(batch_file)
+        return run_batch(raw_queries, opts, conf, type_filter)
+
     if not args:
         parser.error("No query provided")
     raw_query = " ".join(args)
 
-    log.info("Going to parse %r", raw_query)
-    lexed_query = lex(raw_query)
-    log.info("Lexed into %r", lexed_query)
-    parsed_query, unparsed = parse_query(lexed_query)
-    log.info("Parsed into %r", parsed_query)
-    if unparsed:
-        log.warning("Unparsed content: %r", unparsed)
+    if not opts.no_daemon:
+        status = ask_daemon(socket_path, {
+            'query': raw_query,
+            'output': output_options(opts),
+            'pushdown': not opts.no_pushdown,
+            'engine': opts.engine,
+            'type_filter': type_filter,
+            'merge_container_attrs': bool(settings.merge_container_attrs),
+        }, opts.output_format)
+        if status is not None:
+            return status
+
+    parsed_query = prepare_query(raw_query, not opts.no_pushdown, type_filter, engine=opts.engine)
+    if parsed_query is None:
         return 1
 
-    if os.environ.get('CLUSTO_TYPE_FILTER', None) is not None:
-        def look_for_type(node):
-            if isinstance(node, (Equality, Inequality)) and\
-                    ('type' in node.parameters or 'clusto_type' in node.parameters) and\
-                    'server' in node.parameters:
-                return True
-            return False
-
-        if not any(look_for_type(node) for node in parsed_query.visit_iter()):
-            log.debug('Adding intersection with type=%s' % os.environ['CLUSTO_TYPE_FILTER'])
-            parsed_query = Intersection(
-                parsed_query,
-                Equality('clusto_type', os.environ['CLUSTO_TYPE_FILTER'])
-            )
-            log.info('After intersection, parsed into %r', parsed_query)
-        else:
-            log.debug('Not adding type intersection')
-
-    # fetch all the hosts
-    format_template = EasierTemplate(opts.formatter)
+    context, snapshot_path = load_context(opts, conf, needed_entity_types([parsed_query], opts.formatter))
+    results = context.run_query(parsed_query)
+    save_context(context, snapshot_path, conf)
 
-    context = Context(clusto)
-    for result_key in sorted(parsed_query.run(context.entity_map.keys(), context)):
-        host = context.entity_map[result_key]
-        print(format_template.substitute(HostFormatter(host, context)))
+    write_records(output_records(results, context, **output_options(opts)), opts.output_format)
     return 0
 
 
@@ -0,0 +1,99 @@
+"""Answer queries from a long-running process over a Unix socket
+
+Each connection carries one request and one response, each a single line
+of JSON.
+"""
+import errno
+import json
+import logging
+import os
+import socket
+import SocketServer
+
+from clusto_query import snapshot
+
+
+log = logging.getLogger("clusto-query-logger")
+
+
+def socket_path(cache_dir, dsn):
+    """ Path of the socket a daemon for the clusto database at dsn listens on """
+    return os.path.join(os.path.expanduser(cache_dir), 'daemon-%s.sock' % snapshot.dsn_digest(dsn))
+
+
+def _connect(path):
+    """ Return a socket connected to path, or None if nothing is listening there """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error as e:
+        sock.close()
+        if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            return None
+        raise
+    return sock
+
+
+def send_request(path, request):
+    """ Send request to the daemon listening at path and return its response
+
+    Returns None if no daemon is listening.
+    """
+    sock = _connect(path)
+    if sock is None:
+        return None
+    try:
+        sock.sendall(json.dumps(request) + '\n')
+        return json.loads(sock.makefile('rb').readline())
+    finally:
+        sock.close()
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # just checking whether anything is listening
+            return
+        try:
+            response = self.server.answer(json.loads(line))
+        except Exception as e:
+            log.exception('Unable to answer request')
+            response = {'error': '%s: %s' % (type(e).__name__, e)}
+        try:
+            self.wfile.write(json.dumps(response) + '\n')
+        except socket.error as e:
+            log.info('Client went away: %s', e)
+
+
+class QueryServer(SocketServer.UnixStreamServer):
+    """ Answers one request at a time with answer(request) -> response
+
+    Requests and responses are JSON-serializable dicts.
+    """
+
+    def __init__(self, path, answer):
+        self.answer = answer
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        existing = _connect(path)
+        if existing is not None:
+            existing.close()
+            raise socket.error(errno.EADDRINUSE, 'A daemon is already listening on %s' % path)
+        elif os.path.exists(path):
+            # left behind by a daemon that didn't shut down cleanly
+            os.unlink(path)
+        old_umask = os.umask(0077)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, path, _RequestHandler)
+        finally:
+            os.umask(old_umask)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.server_address)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
@@ -0,0 +1,66 @@
+"""On-disk snapshots of a Context, brought up to date with Context.refresh when reused"""
+import cPickle as pickle
+import errno
+import hashlib
+import logging
+import os
+import tempfile
+
+import clusto_query
+
+
+log = logging.getLogger("clusto-query-logger")
+
+# bump whenever the layout of Context.to_snapshot() changes
+SNAPSHOT_FORMAT = 7
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', '~/.cache'), 'clusto-query')
+
+
+def dsn_digest(dsn):
+    """ A short name for the clusto database at dsn that's safe to put in a path """
+    return hashlib.sha1(dsn).hexdigest()[:16]
+
+
+def snapshot_path(cache_dir, dsn):
+    """ Path of the snapshot for the clusto database at dsn """
+    return os.path.join(os.path.expanduser(cache_dir), 'context-%s.pickle' % dsn_digest(dsn))
+
+
+def _header(dsn):
+    return (SNAPSHOT_FORMAT, clusto_query.__version__, dsn_digest(dsn))
+
+
+def load(path, dsn):
+    """ Return the snapshot of the clusto database at dsn saved at path, or None if there isn't a usable one """
+    try:
+        with open(path, 'rb') as f:
+            header = pickle.load(f)
+            if header != _header(dsn):
+                log.info('Snapshot %s is stale or of another database (%r)', path, header)
+                return None
+            return pickle.load(f)
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            log.warning('Unable to read snapshot %s: %s', path, e)
+    except Exception as e:
+        log.warning('Ignoring corrupt snapshot %s: %s', path, e)
+    return None
+
+
+def save(path, dsn, snapshot):
+    """ Atomically replace the snapshot at path with one of the clusto database at dsn """
+    directory = os.path.dirname(path)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(_header(dsn), f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+    except (IOError, OSError) as e:
+        log.warning('Unable to write snapshot %s: %s', path, e)
@@ -7,6 +7,7 @@ setup(name='clusto_query',
       author_email='jbrown@uber.com',
       description='Perform arbitrary boolean queries against clusto',
       install_requires=map(str.strip, open('requirements.txt').readlines()),
+      extras_require={'columnar': ['numpy']},
       packages=find_packages(exclude='test'),
       entry_points={
           'console_scripts': [
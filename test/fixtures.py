@@ -0,0 +1,185 @@
+"""Contexts for tests: a real clusto in sqlite, and fakes that never touch a database"""
+import collections
+import ConfigParser
+import random
+import unittest
+
+import clusto
+from clusto.drivers import BasicServer, BasicDatacenter, BasicRack, Pool
+
+from clusto_query.closure import transitive_closure
+from clusto_query.context import Context, ContextKey, AttributeCounts
+from clusto_query.lexer import lex
+from clusto_query.parser import parse_query
+
+
+def parse(query):
+    return parse_query(lex(query))[0]
+
+
+def clusto_config(dsn='sqlite:///:memory:', versioning=True):
+    conf = ConfigParser.SafeConfigParser()
+    conf.add_section('clusto')
+    conf.set('clusto', 'dsn', dsn)
+    conf.set('clusto', 'versioning', 'true' if versioning else 'false')
+    return conf
+
+
+class ClustoTestCase(unittest.TestCase):
+    """ Each test gets a fresh clusto in an in-memory sqlite database, versioned unless versioning is False """
+    versioning = True
+
+    def setUp(self):
+        clusto.SESSION.remove()
+        clusto.connect(clusto_config(versioning=self.versioning))
+        clusto.init_clusto()
+
+    def tearDown(self):
+        clusto.SESSION.remove()
+
+
+def build_site():
+    """ Fill clusto with two datacenters of servers in role and plain pools; returns the Drivers by name
+
+    s3 is in two role pools, pools are nested in pools, and system.memory
+    has ints, strings and more than one value on some servers.
+    """
+    drivers = {}
+    for name in ('dc1', 'dc2'):
+        drivers[name] = BasicDatacenter(name)
+    for name, datacenter in (('r1', 'dc1'), ('r2', 'dc2')):
+        drivers[name] = BasicRack(name)
+        drivers[datacenter].insert(drivers[name])
+    for name in ('web', 'api', 'db', 'everything'):
+        drivers[name] = Pool(name)
+    drivers['web'].add_attr('pooltype', 'role')
+    drivers['api'].add_attr('pooltype', 'role')
+    drivers['everything'].insert(drivers['web'])
+    drivers['everything'].insert(drivers['db'])
+    memories = [4096, 8192, 'lots', 16384, 4096, [2048, 65536], 8192, '1024', None, 32768]
+    for i, memory in enumerate(memories):
+        server = drivers['s%d' % i] = BasicServer('s%d' % i)
+        drivers['r1' if i < 5 else 'r2'].insert(server, i % 5 + 1)
+        for value in memory if isinstance(memory, list) else [memory] if memory is not None else []:
+            server.add_attr('system', subkey='memory', value=value)
+        if i % 3:
+            server.set_attr('hostname', 'host%d.example.com' % i)
+        server.add_attr('ip', subkey='ipstring', value='10.0.%d.1' % i)
+        if i % 2:
+            server.add_attr('ip', subkey='ipstring', value='8.8.%d.8' % i)
+    for pool, members in (('web', [0, 1, 2, 3]), ('api', [3, 4, 7]), ('db', [5, 6, 7, 8])):
+        for i in members:
+            drivers[pool].insert(drivers['s%d' % i])
+    return drivers
+
+
+class CountingClusto(object):
+    """ Stands in for clusto in a Context, remembering the name of every entity whose Driver it fetches """
+
+    def __init__(self):
+        self.fetched = []
+
+    def __getattr__(self, name):
+        return getattr(clusto, name)
+
+    def get_entities(self, *args, **kwargs):
+        entities = clusto.get_entities(*args, **kwargs)
+        self.fetched.extend(e.name for e in entities)
+        return entities
+
+
+class NoClusto(object):
+    """ Stands in for clusto in a Context that mustn't fetch anything from it """
+
+    def __getattr__(self, name):
+        raise AssertionError('clusto.%s used by a fake context' % name)
+
+
+def fake_context(contains, attributes):
+    """ A Context restored from a snapshot of plain data, that never touches clusto
+
+    contains maps parent ContextKeys to their direct children and attributes
+    maps hosts to lists of (key, subkey, value); every key that appears is
+    loaded for every host, as is pooltype.
+    """
+    keys = set(attributes)
+    for parent, children in contains.iteritems():
+        keys.add(parent)
+        keys.update(children)
+    keys = sorted(keys)
+    index = dict((k, i) for i, k in enumerate(keys))
+    forward_map = dict((parent, set(children)) for parent, children in contains.iteritems() if children)
+    contents_dict = transitive_closure(forward_map)
+    attribute_map = {('pooltype', None): {}}
+    counts = collections.defaultdict(lambda: collections.defaultdict(list))
+    for host, values in attributes.iteritems():
+        for key, subkey, value in values:
+            attribute_map.setdefault((key, None), {}).setdefault(index[host], []).append((key, subkey, None, value))
+            counts[key][subkey].append((host, value))
+    return Context(NoClusto(), snapshot={
+        'version': None,
+        'entity_keys': keys,
+        'entity_count': len(keys),
+        'entity_drivers': [None] * len(keys),
+        'forward_map': dict((index[p], [index[c] for c in children]) for p, children in forward_map.iteritems()),
+        'contents_dict': dict((index[p], [index[c] for c in children]) for p, children in contents_dict.iteritems()),
+        'closed_types': sorted(Context.CONTEXT_TYPES),
+        'attribute_map': attribute_map,
+        'attribute_hosts': dict.fromkeys(attribute_map),
+        'attribute_counts': dict(
+            (key, dict((subkey, AttributeCounts(len(pairs), len(set(h for h, _ in pairs)),
+                                                len(set(v for _, v in pairs))))
+                       for subkey, pairs in by_subkey.iteritems()))
+            for key, by_subkey in counts.iteritems()
+        ),
+    })
+
+
+def random_site(seed, servers=60):
+    """ A fake_context of servers in random pools, some of them roles, and datacenters
+
+    Some servers have no role and some more than one; system.memory holds
+    ints, strings and several values on some servers, or nothing at all.
+    """
+    rnd = random.Random(seed)
+    hosts = [ContextKey('server', 's%02d' % i) for i in xrange(servers)]
+    pools = [ContextKey('pool', name) for name in ('web', 'api', 'db', 'cache', 'everything')]
+    datacenters = [ContextKey('datacenter', name) for name in ('dc1', 'dc2')]
+    contains = {}
+    for pool in pools[:-1]:
+        contains[pool] = set(rnd.sample(hosts, rnd.randint(0, servers / 3)))
+    # pools in pools, and pools and servers in datacenters
+    contains[pools[-1]] = set(pools[:2])
+    contains[datacenters[0]] = set([pools[2]] + hosts[:servers / 2])
+    contains[datacenters[1]] = set(hosts[servers / 2:])
+    attributes = dict((host, []) for host in hosts)
+    attributes[pools[0]] = [('pooltype', None, 'role')]
+    attributes[pools[1]] = [('pooltype', None, 'role')]
+    attributes[pools[2]] = [('pooltype', None, 'other')]
+    for host in hosts:
+        for _ in xrange(rnd.choice([0, 1, 1, 1, 2])):
+            attributes[host].append(('system', 'memory', rnd.choice([1024, 2048, 4096, 8192, 'lots', 'few'])))
+        if rnd.random() < 0.8:
+            attributes[host].append(('system', 'cpucount', rnd.randint(1, 32)))
+        attributes[host].append(('owner', None, rnd.choice(['ops', 'dev', 'ops-team', 'qa'])))
+    return fake_context(contains, attributes)
+
+
+# queries over a random_site that every engine should answer the same way
+ENGINE_QUERIES = [
+    'attr system.memory exists', 'attr system.cpucount exists', 'pool exists', 'role exists',
+    'attr system.memory = 4096', 'attr system.memory = lots', 'attr system.memory != 4096', 'attr owner = ops',
+    'attr system.cpucount > 16', 'attr system.cpucount >= 16', 'attr system.cpucount < 8',
+    'attr system.cpucount <= 8', 'attr system.memory > 2048', 'attr system.memory < 4096',
+    'attr owner ^ ops', 'attr owner , team', 'attr owner contains ps', 'name ^ s1', 'name , "5"',
+    'pool = web', 'pool != web', 'pool = everything', 'role = api', 'role != web', 'datacenter = dc1',
+    'clusto_type = server', 'clusto_type != pool',
+    'attr system.cpucount > 4 and attr system.cpucount < 20',
+    'attr system.memory >= 2048 and attr system.memory <= 4096 and pool != db',
+    'pool = web and role = api', 'pool = web or attr owner = qa', 'pool = everything - role = web',
+    'not pool = db', 'not (attr system.cpucount > 8 or pool = cache)',
+    '(pool = web - role = api) or (pool = db and not attr system.memory exists)',
+    'attr owner = ops - attr system.memory = lots - datacenter = dc2',
+    '(pool = web and attr owner = ops) or (attr owner = ops and pool = web) or attr owner = ops',
+    '(attr system.cpucount > 8 or role = web) and not (role = web or attr system.cpucount > 8)',
+]
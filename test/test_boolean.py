@@ -0,0 +1,80 @@
+import itertools
+import random
+import unittest
+
+from clusto_query.query.operator.boolean import Intersection, Union, Subtraction, Not
+
+from fixtures import random_site, parse
+
+
+CLAUSES = [
+    'pool = web', 'pool = everything', 'role = api', 'role != web', 'datacenter = dc1',
+    'attr system.memory > 2048', 'attr system.memory = lots', 'attr system.cpucount <= 16',
+    'attr owner ^ ops', 'not pool = db',
+]
+
+
+def unnarrowed(query, candidates, context):
+    """ What query matches, running every operand over all of candidates """
+    if isinstance(query, Intersection):
+        results = set(candidates)
+        for p in query.parameters:
+            results &= unnarrowed(p, candidates, context)
+        return results
+    elif isinstance(query, Union):
+        results = set()
+        for p in query.parameters:
+            results |= unnarrowed(p, candidates, context)
+        return results
+    elif isinstance(query, Subtraction):
+        results = unnarrowed(query.parameters[0], candidates, context)
+        for p in query.parameters[1:]:
+            results -= unnarrowed(p, candidates, context)
+        return results
+    elif isinstance(query, Not):
+        return set(candidates) - unnarrowed(query.parameters[0], candidates, context)
+    return set(query.run(candidates, context))
+
+
+class NarrowingTest(unittest.TestCase):
+    def assertUnchanged(self, query, candidates, context):
+        self.assertEqual(set(query.run(candidates, context)), unnarrowed(query, candidates, context), query)
+
+    def test_overlapping_operands(self):
+        for seed in xrange(3):
+            context = random_site(seed)
+            hosts = sorted(context.entity_map)
+            subset = random.Random(seed).sample(hosts, len(hosts) / 2)
+            for first, second in itertools.permutations(CLAUSES, 2):
+                for operator in (Intersection, Union, Subtraction):
+                    query = operator(parse(first), parse(second))
+                    self.assertUnchanged(query, hosts, context)
+                    self.assertUnchanged(query, subset, context)
+
+    def test_chains(self):
+        context = random_site(7)
+        hosts = sorted(context.entity_map)
+        for raw_query in ('pool = web or role = api or attr owner ^ ops or datacenter = dc1',
+                          'pool = everything - role = web - attr system.memory > 2048 - pool = db',
+                          'pool = web and (role = api or attr system.cpucount > 8) and not datacenter = dc2',
+                          '(pool = web or pool = api) - (role = api or attr owner = dev)',
+                          'role = web or (pool = web - role = web) or (pool = web and role = api)'):
+            self.assertUnchanged(parse(raw_query), hosts, context)
+
+    def test_results_are_candidates(self):
+        context = random_site(1)
+        candidates = sorted(context.entity_map)[::3]
+        for raw_query in ('pool = web or not role = api', 'not pool = db - attr owner = qa'):
+            self.assertTrue(set(parse(raw_query).run(candidates, context)) <= set(candidates))
+
+    def test_small_branches_skip_bitmaps(self):
+        context = random_site(3, servers=640)
+        hosts = sorted(context.entity_map)
+        host_ids = context.host_ids()
+        built = []
+        bits = host_ids.bits
+        host_ids.bits = lambda hosts: built.append(hosts) or bits(hosts)
+        for raw_query in ('name = s01 or name = s02 or name = s03 or name = s01',
+                          '(name = s01 or name = s02) - name = s02'):
+            self.assertUnchanged(parse(raw_query), hosts, context)
+        self.assertEqual(built, [])
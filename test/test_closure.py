@@ -0,0 +1,67 @@
+import random
+import unittest
+
+from clusto_query.closure import transitive_closure, update_closure
+
+
+def naive_closure(forward_map):
+    closure = {}
+    for parent, contents in forward_map.iteritems():
+        seen = set()
+        work_queue = list(contents)
+        while work_queue:
+            t = work_queue.pop(0)
+            if t in seen:
+                continue
+            seen.add(t)
+            work_queue.extend(forward_map.get(t, ()))
+        closure[parent] = seen
+    return closure
+
+
+class ClosureTest(unittest.TestCase):
+    def test_tree(self):
+        forward_map = {'dc': set(['rack1', 'rack2']), 'rack1': set(['a', 'b']), 'rack2': set(['c'])}
+        self.assertEqual(transitive_closure(forward_map), {
+            'dc': frozenset(['rack1', 'rack2', 'a', 'b', 'c']),
+            'rack1': frozenset(['a', 'b']),
+            'rack2': frozenset(['c']),
+        })
+
+    def test_shared_children(self):
+        forward_map = {'p1': set(['p3']), 'p2': set(['p3']), 'p3': set(['a'])}
+        closure = transitive_closure(forward_map)
+        self.assertEqual(closure['p1'], frozenset(['p3', 'a']))
+        self.assertEqual(closure['p2'], frozenset(['p3', 'a']))
+
+    def test_cycle(self):
+        forward_map = {'p1': set(['p2']), 'p2': set(['p1', 'a']), 'p3': set(['p3'])}
+        closure = transitive_closure(forward_map)
+        self.assertEqual(closure['p1'], frozenset(['p1', 'p2', 'a']))
+        self.assertEqual(closure['p2'], frozenset(['p1', 'p2', 'a']))
+        self.assertEqual(closure['p3'], frozenset(['p3']))
+
+    def test_matches_naive(self):
+        rnd = random.Random(4)
+        for _ in range(20):
+            forward_map = {}
+            for parent in range(30):
+                forward_map[parent] = set(rnd.sample(range(60), rnd.randint(0, 4)))
+            self.assertEqual(transitive_closure(forward_map), naive_closure(forward_map))
+
+    def test_update_matches_naive(self):
+        rnd = random.Random(5)
+        for _ in range(20):
+            forward_map = {}
+            for parent in range(30):
+                forward_map[parent] = set(rnd.sample(range(60), rnd.randint(0, 4)))
+            closure = transitive_closure(forward_map)
+            changed = rnd.sample(range(40), 3)
+            for parent in changed:
+                children = set(rnd.sample(range(60), rnd.randint(0, 4)))
+                if children:
+                    forward_map[parent] = children
+                else:
+                    forward_map.pop(parent, None)
+            update_closure(forward_map, closure, changed)
+            self.assertEqual(closure, naive_closure(forward_map))
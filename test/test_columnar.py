@@ -0,0 +1,97 @@
+import unittest
+
+import clusto
+
+from clusto_query import columnar
+from clusto_query.context import Context
+from clusto_query.optimizer import SharedQuery, eliminate_common_subexpressions
+from clusto_query.pushdown import PushedDownQuery, push_down
+from clusto_query.query.objects import Attribute
+from clusto_query.query.operator.affix import Equality, SubString, GT, LE, LT, Between
+from clusto_query.query.operator.boolean import Intersection, Union, Subtraction, Not
+
+from fixtures import ClustoTestCase, ENGINE_QUERIES, build_site, parse, random_site
+
+
+@unittest.skipIf(not columnar.HAVE_NUMPY, 'numpy is not installed')
+class ColumnTest(unittest.TestCase):
+    def setUp(self):
+        self.attribute = Attribute('system', 'memory', None)
+        uniques = [4096, 'lots', 2 ** 60, 8192.0]
+        self.column = columnar.Column([0, 0, 1, 2, 3], [0, 3, 1, 2, 0], uniques)
+
+    def test_compares_each_distinct_value(self):
+        truth = self.column.compare(GT(self.attribute, 5000))
+        # strings are greater than numbers, and big ints aren't rounded
+        self.assertEqual(truth.tolist(), [False, True, True, True])
+        truth = self.column.compare(GT(self.attribute, 2 ** 60 - 1))
+        self.assertEqual(truth.tolist(), [False, True, True, False])
+
+    def test_equality_compares_text(self):
+        truth = self.column.compare(Equality(self.attribute, '8192.0'))
+        self.assertEqual(truth.tolist(), [False, False, False, True])
+
+    def test_uncomparable_values(self):
+        column = columnar.Column([0], [0], ['abc'])
+        self.assertIsNone(column.compare(SubString(self.attribute, 1)))
+
+
+@unittest.skipIf(not columnar.HAVE_NUMPY, 'numpy is not installed')
+class ColumnarQueryTest(unittest.TestCase):
+    def setUp(self):
+        self.contexts = [random_site(seed) for seed in xrange(3)]
+
+    def assertColumnarMatches(self, query):
+        for context in self.contexts:
+            hosts = sorted(context.entity_map)
+            for candidates in (hosts, hosts[::3], []):
+                self.assertEqual(columnar.ColumnarQuery(query).run(candidates, context),
+                                 set(query.run(candidates, context)), query)
+
+    def test_queries(self):
+        for raw_query in ENGINE_QUERIES:
+            self.assertColumnarMatches(parse(raw_query))
+
+    def test_boolean_operators(self):
+        web, api, big = parse('pool = web'), parse('attr owner ^ ops'), parse('attr system.cpucount > 8')
+        for query in (Intersection(web, api, big), Union(web, api, big), Subtraction(web, api, big),
+                      Subtraction(big, Union(api, web)), Not(Union(web, big)), Not(Not(api)),
+                      Intersection(Union(web, api), Not(big))):
+            self.assertColumnarMatches(query)
+
+    def test_between(self):
+        for attribute in (Attribute('system', 'cpucount', None), Attribute('system', 'memory', None)):
+            self.assertColumnarMatches(Between(GT(attribute, 4), LT(attribute, 20)))
+            self.assertColumnarMatches(Between(GT(attribute, 1024), LE(attribute, 4096)))
+
+    def test_shared(self):
+        query = eliminate_common_subexpressions(parse(
+            '(attr owner = ops and attr system.cpucount > 4) or (pool = web - '
+            '(attr system.cpucount > 4 and attr owner = ops))'))
+        self.assertTrue(any(isinstance(node, SharedQuery) for node in query.visit_iter()))
+        self.assertColumnarMatches(query)
+        for context in self.contexts:
+            self.assertEqual(context.run_query(columnar.ColumnarQuery(query)), set(context.run_query(query)))
+
+
+@unittest.skipIf(not columnar.HAVE_NUMPY, 'numpy is not installed')
+class ColumnarPushDownTest(ClustoTestCase):
+    def test_pushed_down(self):
+        build_site()
+        context = Context(clusto)
+        for raw_query in ('attr system.memory > 5000 and pool = web', 'attr system.memory = 4096 - pool = db',
+                          'name ^ s1 or attr system.memory < 2000', 'not pool = db and attr system.memory exists',
+                          'clusto_type = server and not attr system.memory >= 8192', 'name = nothing'):
+            query = push_down(parse(raw_query))
+            self.assertTrue(any(isinstance(node, PushedDownQuery) for node in query.visit_iter()), raw_query)
+            self.assertEqual(context.run_query(columnar.ColumnarQuery(query)), set(context.run_query(query)),
+                             raw_query)
+
+    def test_evaluates_what_it_wraps(self):
+        build_site()
+        context = Context(clusto)
+        query = push_down(parse('attr system.memory > 5000 and pool = web'))
+        self.assertTrue(isinstance(query, PushedDownQuery))
+        self.assertEqual(set(h.name for h in context.run_query(columnar.ColumnarQuery(query))), set(['s1', 's2', 's3']))
+        # the attribute clause was answered from a column, not host by host
+        self.assertIn(('system', 'memory', None), context.column_store().columns)
@@ -0,0 +1,102 @@
+import unittest
+
+import clusto
+
+from clusto_query.compiler import CompiledQuery, compile_query, compile_predicate
+from clusto_query.context import Context
+from clusto_query.optimizer import SharedQuery, eliminate_common_subexpressions
+from clusto_query.pushdown import PushedDownQuery, push_down
+from clusto_query.query import QueryObject
+from clusto_query.query.objects import Attribute
+from clusto_query.query.operator.affix import Between, GT, LE, LT
+from clusto_query.query.operator.boolean import Intersection, Union, Subtraction, Not
+
+from fixtures import ClustoTestCase, ENGINE_QUERIES, build_site, parse, random_site
+
+
+class OddNames(QueryObject):
+    """ Something the compiler doesn't know, so has to run as it is """
+
+    def run(self, candidate_hosts, context):
+        return set(h for h in candidate_hosts if h.name[-1] in '13579')
+
+
+class CompilerTest(unittest.TestCase):
+    def setUp(self):
+        self.contexts = [random_site(seed) for seed in xrange(3)]
+
+    def assertCompiledMatches(self, query, contexts=None):
+        for context in contexts or self.contexts:
+            hosts = sorted(context.entity_map)
+            for candidates in (hosts, hosts[::3]):
+                expected = set(query.run(candidates, context))
+                self.assertEqual(compile_query(query).run(candidates, context), expected, query)
+                predicate = compile_predicate(query, candidates, context)
+                self.assertEqual(set(h for h in candidates if predicate(h)), expected, query)
+            self.assertEqual(context.run_query(compile_query(query)), set(context.run_query(query)), query)
+
+    def test_queries(self):
+        for raw_query in ENGINE_QUERIES:
+            self.assertCompiledMatches(parse(raw_query))
+
+    def test_between(self):
+        for attribute in (Attribute('system', 'cpucount', None), Attribute('system', 'memory', None)):
+            self.assertCompiledMatches(Between(GT(attribute, 4), LT(attribute, 20)))
+            self.assertCompiledMatches(Between(GT(attribute, 1024), LE(attribute, 4096)))
+
+    def test_shared(self):
+        shared = 0
+        for raw_query in ENGINE_QUERIES:
+            query = eliminate_common_subexpressions(parse(raw_query))
+            shared += sum(1 for node in query.visit_iter() if isinstance(node, SharedQuery))
+            # memoized by run_query, and without it
+            self.assertCompiledMatches(query)
+        self.assertTrue(shared)
+
+    def test_boolean_operators(self):
+        web, api, big = parse('pool = web'), parse('role = api'), parse('attr system.cpucount > 8')
+        for query in (Intersection(web, api, big), Union(web, api, big), Subtraction(web, api, big),
+                      Not(Union(web, big)), Intersection(Union(web, api), Not(big))):
+            self.assertCompiledMatches(query)
+
+    def test_falls_back_to_running(self):
+        for query in (OddNames(), QueryObject(), Intersection(parse('pool = web'), OddNames()),
+                      Union(OddNames(), parse('role = api')), Subtraction(parse('pool exists'), OddNames()),
+                      Not(OddNames()), CompiledQuery(parse('attr owner ^ ops or pool = db'))):
+            self.assertCompiledMatches(query)
+
+
+class CompiledPushDownTest(ClustoTestCase):
+    def test_pushed_down(self):
+        build_site()
+        context = Context(clusto)
+        for raw_query in ('attr system.memory > 5000', 'attr system.memory = 4096 - pool = db',
+                          'name ^ s1 or attr system.memory < 2000', 'pool = web and attr system.memory exists',
+                          'clusto_type = server and not attr system.memory >= 8192', 'name = nothing'):
+            query = push_down(parse(raw_query))
+            self.assertTrue(any(isinstance(node, PushedDownQuery) for node in query.visit_iter()), raw_query)
+            self.assertCompiledMatches(query, context)
+
+    def assertCompiledMatches(self, query, context):
+        self.assertEqual(context.run_query(compile_query(query)), set(context.run_query(query)), query)
+
+
+class CompiledPrefetchTest(ClustoTestCase):
+    def setUp(self):
+        super(CompiledPrefetchTest, self).setUp()
+        build_site()
+
+    def prefetched(self, query):
+        """ The hosts system.memory was prefetched for while running query """
+        context = Context(clusto)
+        context.run_query(query)
+        return context.attribute_hosts[('system', 'memory')]
+
+    def test_narrowed_by_indexed_clauses(self):
+        for raw_query in ('pool = db and attr system.memory = 4096', 'attr system.memory = 4096 and pool = db',
+                          'clusto_type = server and attr system.memory = 4096 and pool = db',
+                          'pool = db and (attr system.memory = 4096 or name = s5)'):
+            query = parse(raw_query)
+            compiled = self.prefetched(compile_query(query))
+            self.assertEqual(set(h.name for h in compiled), set(['s5', 's6', 's7', 's8']), raw_query)
+            self.assertEqual(compiled, self.prefetched(query), raw_query)
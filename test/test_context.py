@@ -0,0 +1,41 @@
+from clusto_query import settings
+from clusto_query.context import Context, ContextKey
+
+from fixtures import ClustoTestCase, CountingClusto, build_site, parse
+
+
+class EntityMapTest(ClustoTestCase):
+    def setUp(self):
+        super(EntityMapTest, self).setUp()
+        build_site()
+        self.clusto = CountingClusto()
+        self.context = Context(self.clusto)
+
+    def tearDown(self):
+        settings.merge_container_attrs = False
+        super(EntityMapTest, self).tearDown()
+
+    def test_lookup_fetches_one(self):
+        entity_map = self.context.entity_map
+        self.assertEqual(entity_map[ContextKey('server', 's3')].name, 's3')
+        self.assertEqual(self.clusto.fetched, ['s3'])
+        entity_map[ContextKey('server', 's3')]
+        self.assertEqual(self.clusto.fetched, ['s3'])
+        with self.assertRaises(KeyError):
+            entity_map[ContextKey('server', 'nothing')]
+
+    def test_load_some(self):
+        keys = [ContextKey('server', 's%d' % i) for i in xrange(4)]
+        self.context.entity_map.load(keys)
+        self.assertEqual(sorted(self.clusto.fetched), ['s0', 's1', 's2', 's3'])
+        self.context.entity_map.load(keys[:2])
+        for key in keys:
+            self.context.entity_map[key]
+        self.assertEqual(len(self.clusto.fetched), 4)
+
+    def test_role_with_merged_attributes(self):
+        settings.merge_container_attrs = True
+        names = set(h.name for h in self.context.run_query(parse('role = web')))
+        self.assertEqual(names, set(['s0', 's1', 's2']))
+        # only the pools' Drivers, for their pooltype
+        self.assertEqual(sorted(self.clusto.fetched), ['api', 'db', 'everything', 'web'])
@@ -0,0 +1,148 @@
+import cStringIO
+import json
+import optparse
+import shutil
+import sys
+import tempfile
+
+import clusto
+from clusto.drivers import BasicServer
+
+from clusto_query import columnar
+from clusto_query import server
+from clusto_query import settings
+from clusto_query import snapshot
+from clusto_query.scripts import main
+
+from fixtures import ClustoTestCase, build_site, clusto_config
+
+
+def daemon_opts(**kwargs):
+    opts = {'no_cache': True, 'cache_dir': None, 'refresh_interval': 60}
+    opts.update(kwargs)
+    return optparse.Values(opts)
+
+
+def request(query, engine='compiled', **output):
+    output.setdefault('formatter', '%name')
+    return {
+        'query': query,
+        'output': output,
+        'pushdown': True,
+        'engine': engine,
+        'type_filter': None,
+        'merge_container_attrs': bool(settings.merge_container_attrs),
+    }
+
+
+class QueryDaemonTest(ClustoTestCase):
+    def setUp(self):
+        super(QueryDaemonTest, self).setUp()
+        build_site()
+        self.daemon = main.QueryDaemon(daemon_opts(), clusto_config())
+
+    def tearDown(self):
+        settings.merge_container_attrs = False
+        super(QueryDaemonTest, self).tearDown()
+
+    def test_refreshes(self):
+        self.assertEqual(self.daemon(request('pool = api')), {'status': 0, 'output': ['s3', 's4', 's7']})
+        context = self.daemon.context
+        BasicServer('s10')
+        clusto.get_by_name('api').insert(clusto.get_by_name('s10'))
+        clusto.get_by_name('api').remove(clusto.get_by_name('s4'))
+        self.assertEqual(self.daemon(request('pool = api')), {'status': 0, 'output': ['s10', 's3', 's7']})
+        # brought up to date rather than reloaded
+        self.assertTrue(self.daemon.context is context)
+
+    def test_unparsed(self):
+        self.assertEqual(self.daemon(request('pool = api )')), {'status': 1, 'output': []})
+
+    def test_unsupported(self):
+        unmerged = request('pool = api')
+        settings.merge_container_attrs = True
+        self.assertIn('unsupported', self.daemon(unmerged))
+        settings.merge_container_attrs = False
+        original = columnar.HAVE_NUMPY
+        columnar.HAVE_NUMPY = False
+        try:
+            self.assertIn('unsupported', self.daemon(request('pool = api', engine='columnar')))
+        finally:
+            columnar.HAVE_NUMPY = original
+
+
+class UnversionedQueryDaemonTest(ClustoTestCase):
+    versioning = False
+
+    def setUp(self):
+        super(UnversionedQueryDaemonTest, self).setUp()
+        build_site()
+        self.daemon = main.QueryDaemon(daemon_opts(refresh_interval=3600), clusto_config(versioning=False))
+
+    def test_stale_until_reloaded(self):
+        response = self.daemon(request('pool = api'))
+        self.assertEqual(response['output'], ['s3', 's4', 's7'])
+        self.assertTrue(0 <= response['age'] < 3600)
+        clusto.get_by_name('api').insert(BasicServer('s10'))
+        # up to refresh_interval old
+        self.assertEqual(self.daemon(request('pool = api'))['output'], ['s3', 's4', 's7'])
+        self.daemon.loaded_at -= 3601
+        response = self.daemon(request('pool = api'))
+        self.assertEqual(response['output'], ['s10', 's3', 's4', 's7'])
+        self.assertTrue(response['age'] < 3600)
+
+
+class AskDaemonTest(ClustoTestCase):
+    def setUp(self):
+        super(AskDaemonTest, self).setUp()
+        build_site()
+        daemon = main.QueryDaemon(daemon_opts(), clusto_config())
+        # the transport is tested in test_server; this goes through JSON the same way
+        self.send_request = server.send_request
+        server.send_request = lambda path, request: json.loads(json.dumps(daemon(json.loads(json.dumps(request)))))
+        self.stdout = sys.stdout
+        sys.stdout = cStringIO.StringIO()
+
+    def tearDown(self):
+        server.send_request = self.send_request
+        sys.stdout = self.stdout
+        super(AskDaemonTest, self).tearDown()
+
+    def test_answered(self):
+        self.assertEqual(main.ask_daemon('daemon.sock', request('pool = web - pool = api'), 'text'), 0)
+        self.assertEqual(sys.stdout.getvalue(), 's0\ns1\ns2\n')
+
+    def test_falls_back(self):
+        original = columnar.HAVE_NUMPY
+        columnar.HAVE_NUMPY = False
+        try:
+            self.assertEqual(main.ask_daemon('daemon.sock', request('pool = web', engine='columnar'), 'text'), None)
+        finally:
+            columnar.HAVE_NUMPY = original
+        self.assertEqual(sys.stdout.getvalue(), '')
+
+
+class LoadContextTest(ClustoTestCase):
+    def setUp(self):
+        super(LoadContextTest, self).setUp()
+        build_site()
+        self.directory = tempfile.mkdtemp()
+        self.opts = daemon_opts(no_cache=False, cache_dir=self.directory)
+        self.conf = clusto_config()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(LoadContextTest, self).tearDown()
+
+    def test_types_without_a_snapshot(self):
+        context, path = main.load_context(self.opts, self.conf, set(['server']))
+        self.assertEqual(path, None)
+        self.assertEqual(set(h.item_type for h in context.entity_map), set(['server']))
+
+    def test_snapshot_has_everything(self):
+        context, path = main.load_context(self.opts, self.conf)
+        self.assertEqual(context.entity_types, None)
+        snapshot.save(path, self.conf.get('clusto', 'dsn'), context.to_snapshot())
+        restored, restored_path = main.load_context(self.opts, self.conf, set(['server']))
+        self.assertEqual(restored_path, path)
+        self.assertEqual(set(restored.entity_map), set(context.entity_map))
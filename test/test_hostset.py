@@ -0,0 +1,52 @@
+import unittest
+
+from clusto_query.context import ContextKey
+from clusto_query.hostset import HostIds, HostSet
+
+
+class HostSetTest(unittest.TestCase):
+    def setUp(self):
+        self.hosts = [ContextKey('server', 's%d' % i) for i in range(37)]
+        self.host_ids = HostIds(self.hosts)
+
+    def host_set(self, indexes):
+        return self.host_ids.host_set(self.hosts[i] for i in indexes)
+
+    def test_round_trip(self):
+        for indexes in ([], [0], [7, 8], [36], range(37), range(0, 37, 3)):
+            hosts = self.host_set(indexes)
+            self.assertEqual(list(hosts), [self.hosts[i] for i in indexes])
+            self.assertEqual(len(hosts), len(indexes))
+            self.assertEqual(bool(hosts), bool(indexes))
+
+    def test_membership(self):
+        hosts = self.host_set([1, 9, 36])
+        self.assertIn(self.hosts[9], hosts)
+        self.assertNotIn(self.hosts[8], hosts)
+        self.assertNotIn(ContextKey('server', 'elsewhere'), hosts)
+
+    def test_operators(self):
+        a = self.host_set(range(0, 20))
+        b = set(self.hosts[i] for i in range(10, 30))
+        self.assertEqual(a & b, set(self.hosts[10:20]))
+        self.assertEqual(a | b, set(self.hosts[:30]))
+        self.assertEqual(a - b, set(self.hosts[:10]))
+        self.assertIsInstance(a - self.host_ids.host_set(b), HostSet)
+        self.assertEqual(HostSet(self.host_ids), set())
+
+    def test_small_sets_skip_bitmaps(self):
+        small = set(self.hosts[:1])
+        large = set(self.hosts[1:])
+        self.host_ids.bits = None  # building a bitmap would fail
+        self.assertEqual(self.host_ids.union(small, set(self.hosts[1:2])), set(self.hosts[:2]))
+        self.assertEqual(self.host_ids.difference(small, large), small)
+        self.assertIsInstance(self.host_ids.union(set(), small), set)
+
+    def test_large_sets_become_bitmaps(self):
+        small = set(self.hosts[:1])
+        large = set(self.hosts[1:])
+        for result, expected in ((self.host_ids.union(small, large), set(self.hosts)),
+                                 (self.host_ids.difference(large, small), large),
+                                 (self.host_ids.union(small, self.host_set([5])), set(self.hosts[i] for i in (0, 5)))):
+            self.assertIsInstance(result, HostSet)
+            self.assertEqual(set(result), expected)
@@ -0,0 +1,66 @@
+import unittest
+
+from clusto_query.index import SortedValueIndex, AffixIndex, TrigramIndex, AddressIndex
+
+
+class SortedValueIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = SortedValueIndex([
+            (4, 'a'), (8, 'b'), (16, 'c'), (16, 'd'), (u'big', 'e'), (None, 'f'), (32.5, 'g'),
+        ])
+
+    def test_above(self):
+        self.assertEqual(self.index.above(8, False), set(['c', 'd', 'e', 'g']))
+        self.assertEqual(self.index.above(8, True), set(['b', 'c', 'd', 'e', 'g']))
+
+    def test_below(self):
+        self.assertEqual(self.index.below(16, False), set(['a', 'b', 'f']))
+        self.assertEqual(self.index.below(16, True), set(['a', 'b', 'c', 'd', 'f']))
+
+    def test_between(self):
+        self.assertTrue(self.index.single_valued)
+        self.assertEqual(self.index.between(4, False, 16, True), set(['b', 'c', 'd']))
+
+    def test_matches_comparisons(self):
+        pairs = [(v, i) for i, v in enumerate([0, 1, 2.5, 3, 3, None, u'x', [1], 10 ** 20])]
+        index = SortedValueIndex(pairs)
+        for bound in (-1, 0, 2.5, 3, 4, 10 ** 21):
+            self.assertEqual(index.above(bound, False), set(h for v, h in pairs if v > bound))
+            self.assertEqual(index.above(bound, True), set(h for v, h in pairs if v >= bound))
+            self.assertEqual(index.below(bound, False), set(h for v, h in pairs if v < bound))
+            self.assertEqual(index.below(bound, True), set(h for v, h in pairs if v <= bound))
+
+    def test_multi_valued(self):
+        index = SortedValueIndex([(1, 'a'), (20, 'a')])
+        self.assertFalse(index.single_valued)
+
+
+class AffixIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.names = [u'web01-peak1', u'web02-peak2', u'api01-peak2', u'web', u'we', u'db-web']
+        self.index = AffixIndex((n, n) for n in self.names)
+
+    def test_prefixed(self):
+        for prefix in (u'web', u'we', u'api', u'x', u''):
+            self.assertEqual(self.index.prefixed(prefix), set(n for n in self.names if n.startswith(prefix)))
+
+    def test_suffixed(self):
+        for suffix in (u'peak2', u'web', u'b', u'x', u''):
+            self.assertEqual(self.index.suffixed(suffix), set(n for n in self.names if n.endswith(suffix)))
+
+
+class TrigramIndexTest(unittest.TestCase):
+    def test_containing(self):
+        strings = [u'a big server', u'tiny box', u'serverish', u'server', u'sever', u'']
+        index = TrigramIndex((s, i) for i, s in enumerate(strings))
+        for substring in (u'server', u'erv', u'er', u'', u'box', u'missing', u'a big server!'):
+            self.assertEqual(index.containing(substring),
+                             set(i for i, s in enumerate(strings) if substring in s))
+
+
+class AddressIndexTest(unittest.TestCase):
+    def test_within(self):
+        index = AddressIndex([((4, 10), 'a'), ((4, 20), 'b'), ((6, 15), 'c'), ((4, 15), 'd')])
+        self.assertEqual(index.within(4, 10, 15), set(['a', 'd']))
+        self.assertEqual(index.within(6, 0, 100), set(['c']))
+        self.assertEqual(index.within(4, 21, 100), set())
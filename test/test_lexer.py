@@ -70,3 +70,15 @@ class LexerTest(unittest.TestCase):
         self.assertEqual(clusto_query.lexer.lex('pool = production and (attr haproxy.enabled = 1)'),
                          ['pool', '=', 'production', 'and', '(', 'attr', 'haproxy.enabled', '=',
                           1, ')'])
+
+    def test_tokenize_offsets(self):
+        self.assertEqual(list(clusto_query.lexer.tokenize('pool=a and  "b c" ')),
+                         [('pool', 0), ('=', 4), ('a', 5), ('and', 7), ('b c', 12)])
+
+    def test_lex_keyword_prefix(self):
+        self.assertEqual(clusto_query.lexer.lex('pooly - -b andx'),
+                         ['pooly', '-', '-b', 'andx'])
+
+    def test_lex_invalid(self):
+        with self.assertRaisesRegexp(StringParseError, 'column 8'):
+            clusto_query.lexer.lex('pool = !a')
@@ -0,0 +1,96 @@
+import clusto
+from clusto.drivers import BasicServer, Pool
+
+from clusto_query import clusto_types
+from clusto_query import loader
+from clusto_query.loader import AttributeChange, EntityChange
+
+from fixtures import ClustoTestCase, build_site
+
+
+class LoaderTest(ClustoTestCase):
+    def setUp(self):
+        super(LoaderTest, self).setUp()
+        self.drivers = build_site()
+        self.names = dict((d.entity.entity_id, name) for name, d in self.drivers.iteritems())
+
+    def batched(self, function, *args):
+        """ function(*args) as a list, streamed two rows at a time """
+        original = loader.STREAM_BATCH_SIZE
+        loader.STREAM_BATCH_SIZE = 2
+        try:
+            return list(function(*args))
+        finally:
+            loader.STREAM_BATCH_SIZE = original
+
+    def ids(self, *names):
+        return set(self.drivers[name].entity.entity_id for name in names)
+
+    def named_edges(self, edges):
+        return set((self.names[parent_id], self.names[child_id]) for parent_id, child_id in edges)
+
+    def test_contains_edges(self):
+        edges = list(loader.contains_edges(clusto_types.CONTEXT_TYPES))
+        self.assertEqual(self.named_edges(edges), set(
+            (parent.name, child.name)
+            for parent in clusto.get_entities(clusto_types=list(clusto_types.CONTEXT_TYPES))
+            for child in parent.contents()
+        ))
+        self.assertIn(('everything', 'web'), self.named_edges(edges))
+        self.assertEqual(sorted(self.batched(loader.contains_edges, clusto_types.CONTEXT_TYPES)), sorted(edges))
+
+    def test_contains_edges_of_types(self):
+        self.assertEqual(self.named_edges(loader.contains_edges(['datacenter'])),
+                         set([('dc1', 'r1'), ('dc2', 'r2')]))
+        self.assertEqual(list(loader.contains_edges([])), [])
+
+    def test_contains_edges_without_contents(self):
+        empty = Pool('empty')
+        self.names[empty.entity.entity_id] = 'empty'
+        self.drivers['web'].remove(self.drivers['s1'])
+        clusto.delete_entity(self.drivers['s7'].entity)
+        edges = self.named_edges(loader.contains_edges(clusto_types.CONTEXT_TYPES))
+        self.assertNotIn('empty', set(parent for parent, _ in edges))
+        self.assertNotIn(('web', 's1'), edges)
+        self.assertIn(('web', 's0'), edges)
+        # a deleted entity's memberships go with it
+        self.assertEqual(set(parent for parent, child in edges if child in ('s1', 's7')), set(['r1']))
+
+    def test_entity_keys(self):
+        wanted = self.ids('s0', 's9', 'web', 'dc2')
+        expected = sorted((self.drivers[name].entity.entity_id, typ, name)
+                          for name, typ in (('s0', 'server'), ('s9', 'server'), ('web', 'pool'), ('dc2', 'datacenter')))
+        self.assertEqual(sorted(loader.entity_keys(wanted)), expected)
+        self.assertEqual(sorted(self.batched(loader.entity_keys, wanted)), expected)
+        self.assertEqual(list(loader.entity_keys(set())), [])
+
+    def test_entity_keys_of_deleted(self):
+        wanted = self.ids('s0', 's9')
+        clusto.delete_entity(self.drivers['s9'].entity)
+        self.assertEqual([name for _, _, name in loader.entity_keys(wanted | set([-1]))], ['s0'])
+
+    def test_changes(self):
+        before = clusto.get_latest_version_number()
+        BasicServer('s10')
+        clusto.delete_entity(self.drivers['s9'].entity)
+        middle = clusto.get_latest_version_number()
+        self.drivers['s0'].add_attr('owner', 'ops')
+        self.drivers['web'].remove(self.drivers['s1'])
+        after = clusto.get_latest_version_number()
+
+        entity_changes = set(loader.entity_changes(before, after))
+        self.assertIn(EntityChange('s10', 'server', 'basicserver', False, True), entity_changes)
+        self.assertIn(EntityChange('s9', 'server', 'basicserver', True, False), entity_changes)
+        self.assertEqual(set(c.name for c in entity_changes), set(['s9', 's10']))
+        attribute_changes = set(loader.attribute_changes(before, after))
+        self.assertIn(AttributeChange('s0', 'server', 'owner', None), attribute_changes)
+        self.assertIn(AttributeChange('web', 'pool', '_contains', None), attribute_changes)
+
+        # only what changed in between, and nothing once up to date
+        self.assertEqual(set(c.name for c in loader.entity_changes(before, middle)), set(['s9', 's10']))
+        self.assertEqual(list(loader.entity_changes(middle, after)), [])
+        self.assertNotIn(('s0', 'owner'), set((c.entity_name, c.key) for c in loader.attribute_changes(before, middle)))
+        self.assertEqual(set((c.entity_name, c.key) for c in loader.attribute_changes(middle, after)),
+                         set([('s0', 'owner'), ('web', '_contains')]))
+        self.assertEqual(list(loader.entity_changes(after, after)), [])
+        self.assertEqual(list(loader.attribute_changes(after, after)), [])
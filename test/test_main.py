@@ -0,0 +1,245 @@
+import collections
+import cStringIO
+import json
+import optparse
+import sys
+import unittest
+
+import clusto
+
+from clusto_query import loader
+from clusto_query.context import Context, ContextKey
+from clusto_query.scripts import main
+from clusto_query.scripts.main import HostFormatter, EasierTemplate, output_records, write_records
+
+from fixtures import ClustoTestCase, CountingClusto, build_site, clusto_config
+
+
+FORMATTER = ('%name %hostname %role %type %rack %internal_ips %public_ips '
+             '%system.memory %ip.ipstring %system.missing')
+
+
+class HostFormatterTest(ClustoTestCase):
+    def setUp(self):
+        super(HostFormatterTest, self).setUp()
+        drivers = build_site()
+        # relations print as the Driver they point at
+        drivers['s0'].add_attr('backup', subkey='target', value=drivers['s1'])
+        drivers['s2'].add_attr('backup', subkey='target', value='elsewhere')
+
+    def formatted(self, formatter, prefetch):
+        context = Context(clusto)
+        template = EasierTemplate(formatter)
+        hosts = sorted(h for h in context.entity_map if h.item_type == 'server')
+        prefetched = {}
+        if prefetch:
+            prefetched = HostFormatter.prefetch(template.placeholders(), hosts, context)
+        return [template.substitute(HostFormatter(h, context, prefetched.get(h))) for h in hosts]
+
+    def test_prefetched_matches_drivers(self):
+        for formatter in (FORMATTER, '%hostname', '%system.memory', '%backup.target', '%rack,%role'):
+            self.assertEqual(self.formatted(formatter, True), self.formatted(formatter, False), formatter)
+
+    def test_multi_valued(self):
+        lines = dict(line.split(' ', 1) for line in self.formatted('%name %system.memory %public_ips', True))
+        self.assertEqual(lines['s5'], '2048,65536 8.8.5.8')
+        self.assertEqual(lines['s8'], ' ')
+
+    def test_prefetches_without_drivers(self):
+        context = Context(clusto)
+        hosts = sorted(h for h in context.entity_map if h.item_type == 'server')
+        prefetched = HostFormatter.prefetch(EasierTemplate(FORMATTER).placeholders(), hosts, context)
+        for host in hosts:
+            self.assertTrue(set(['hostname', 'rack', 'internal_ips', 'public_ips', 'system.memory', 'ip.ipstring'])
+                            <= set(prefetched[host]), host)
+
+
+class OutputDriversTest(ClustoTestCase):
+    def setUp(self):
+        super(OutputDriversTest, self).setUp()
+        drivers = build_site()
+        drivers['s0'].add_attr('backup', subkey='target', value=drivers['s1'])
+        self.clusto = CountingClusto()
+        self.context = Context(self.clusto)
+        self.hosts = set(h for h in self.context.entity_map if h.item_type == 'server')
+
+    def test_name_fetches_nothing(self):
+        records = list(output_records(self.hosts, self.context, '%name'))
+        self.assertEqual(records, sorted(h.name for h in self.hosts))
+        self.assertEqual(self.clusto.fetched, [])
+
+    def test_prefetched_fetches_nothing(self):
+        list(output_records(self.hosts, self.context, FORMATTER, output_format='json'))
+        self.assertEqual(self.clusto.fetched, [])
+
+    def test_fetches_what_prefetching_cant(self):
+        # relations print as Drivers, which only s0 has
+        records = list(output_records(self.hosts, self.context, '%name %backup.target'))
+        self.assertEqual(records[0], 's0 BasicServer(name=s1, type=server, driver=basicserver)')
+        self.assertEqual(self.clusto.fetched, ['s0'])
+
+
+class LimitDriversTest(ClustoTestCase):
+    def setUp(self):
+        super(LimitDriversTest, self).setUp()
+        drivers = build_site()
+        # every server's output needs its Driver
+        for i in xrange(10):
+            drivers['s%d' % i].add_attr('backup', subkey='target', value=drivers['s%d' % ((i + 1) % 10)])
+        self.clusto = CountingClusto()
+        self.context = Context(self.clusto)
+        self.hosts = set(h for h in self.context.entity_map if h.item_type == 'server')
+
+    def records(self, **kwargs):
+        return list(output_records(self.hosts, self.context, '%name %backup.target', **kwargs))
+
+    def test_limit(self):
+        self.assertEqual(len(self.records(limit=3)), 3)
+        self.assertEqual(sorted(self.clusto.fetched), ['s0', 's1', 's2'])
+
+    def test_unsorted_limit(self):
+        records = self.records(limit=4, unsorted=True)
+        self.assertEqual(sorted(self.clusto.fetched), sorted(r.split()[0] for r in records))
+        self.assertEqual(len(self.clusto.fetched), 4)
+
+    def test_batches(self):
+        original = main.PREFETCH_BATCH_SIZE
+        main.PREFETCH_BATCH_SIZE = 2
+        try:
+            self.assertEqual(len(self.records(limit=5)), 5)
+        finally:
+            main.PREFETCH_BATCH_SIZE = original
+        self.assertEqual(sorted(self.clusto.fetched), ['s0', 's1', 's2', 's3', 's4'])
+
+    def test_count(self):
+        self.assertEqual(self.records(count=True), [u'10'])
+        self.assertEqual(self.clusto.fetched, [])
+
+
+class RunBatchTest(ClustoTestCase):
+    def setUp(self):
+        super(RunBatchTest, self).setUp()
+        build_site()
+        self.opts = optparse.Values({
+            'formatter': '%name', 'output_format': 'text', 'limit': None, 'unsorted': False, 'count': False,
+            'no_pushdown': False, 'engine': 'compiled', 'no_cache': True, 'cache_dir': None,
+        })
+        self.contexts = []
+        self.loaded = []
+        load_context, attribute_rows = main.load_context, loader.attribute_rows
+
+        def counting_load_context(*args, **kwargs):
+            context, snapshot_path = load_context(*args, **kwargs)
+            self.contexts.append(context)
+            return context, snapshot_path
+
+        def counting_attribute_rows(keys, names=None):
+            self.loaded.extend(keys)
+            return attribute_rows(keys, names)
+        main.load_context, loader.attribute_rows = counting_load_context, counting_attribute_rows
+        self.addCleanup(setattr, main, 'load_context', load_context)
+        self.addCleanup(setattr, loader, 'attribute_rows', attribute_rows)
+
+    def run_batch(self, raw_queries):
+        stdout, sys.stdout = sys.stdout, cStringIO.StringIO()
+        try:
+            status = main.run_batch(raw_queries, self.opts, clusto_config(), None)
+            return status, sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_labelled_output(self):
+        status, output = self.run_batch(['pool = api', 'attr system.memory > 8192', 'pool = db and role = api'])
+        self.assertEqual(status, 0)
+        self.assertEqual(output, '# pool = api\ns3\ns4\ns7\n'
+                                 '# attr system.memory > 8192\ns2\ns3\ns5\ns9\n'
+                                 '# pool = db and role = api\ns7\n')
+
+    def test_unparsed_query(self):
+        status, output = self.run_batch(['pool = api', 'pool = api )', 'pool = db'])
+        self.assertEqual(status, 1)
+        # the others still run, and the one that didn't parse keeps its label
+        self.assertEqual(output, '# pool = api\ns3\ns4\ns7\n# pool = api )\n# pool = db\ns5\ns6\ns7\ns8\n')
+
+    def test_shares_context_and_prefetch(self):
+        status, output = self.run_batch(['attr system.memory > 8192', 'attr system.memory = 4096 or pool = db',
+                                         'attr system.memory > 8192 and pool = api'])
+        self.assertEqual(status, 0)
+        self.assertEqual(len(self.contexts), 1)
+        self.assertEqual(self.loaded, [('system', 'memory')])
+
+
+FakeDriver = collections.namedtuple('FakeDriver', ['name', 'type'])
+
+
+class FakeEntityMap(dict):
+    def load(self, keys=None):
+        pass
+
+    def driver_class(self, key):
+        return FakeDriver
+
+
+class FakeContext(object):
+    def __init__(self, hosts):
+        self.entity_map = FakeEntityMap((h, FakeDriver(h.name, h.item_type)) for h in hosts)
+
+
+class OutputRecordsTest(unittest.TestCase):
+    def setUp(self):
+        self.hosts = [ContextKey('server', name) for name in (u'web2', u'web10', u'db1', u'caf\xe9,1', u'say "hi"')]
+        self.context = FakeContext(self.hosts)
+        # results come back in no particular order
+        self.results = set(self.hosts)
+
+    def records(self, **kwargs):
+        return list(output_records(self.results, self.context, kwargs.pop('formatter', '%name'), **kwargs))
+
+    def test_text(self):
+        self.assertEqual(self.records(formatter='%type:%name'), [
+            u'server:caf\xe9,1', u'server:db1', u'server:say "hi"', u'server:web10', u'server:web2'])
+
+    def test_csv(self):
+        self.assertEqual(self.records(formatter='%name %type', output_format='csv'), [
+            u'name,type', u'"caf\xe9,1",server', u'db1,server', u'"say ""hi""",server', u'web10,server',
+            u'web2,server'])
+
+    def test_json(self):
+        records = self.records(formatter='%type %name', output_format='json')
+        self.assertEqual([json.loads(r, object_pairs_hook=collections.OrderedDict).items() for r in records[:2]], [
+            [(u'type', u'server'), (u'name', u'caf\xe9,1')], [(u'type', u'server'), (u'name', u'db1')]])
+        self.assertEqual(len(records), len(self.hosts))
+
+    def test_limit(self):
+        self.assertEqual(self.records(limit=2), [u'caf\xe9,1', u'db1'])
+        self.assertEqual(self.records(limit=2, output_format='csv'), [u'name', u'"caf\xe9,1"', u'db1'])
+        self.assertEqual(self.records(limit=0), [])
+        self.assertEqual(self.records(limit=10), self.records())
+
+    def test_unsorted(self):
+        records = self.records(unsorted=True)
+        self.assertEqual(sorted(records), self.records())
+        limited = self.records(unsorted=True, limit=3)
+        self.assertEqual(len(limited), 3)
+        self.assertTrue(set(limited) <= set(records))
+
+    def test_count(self):
+        self.assertEqual(self.records(count=True), [u'5'])
+        self.assertEqual(self.records(count=True, limit=2, output_format='csv'), [u'5'])
+
+    def test_batches(self):
+        expected = self.records(output_format='csv')
+        original = main.PREFETCH_BATCH_SIZE
+        main.PREFETCH_BATCH_SIZE = 2
+        try:
+            self.assertEqual(self.records(output_format='csv'), expected)
+        finally:
+            main.PREFETCH_BATCH_SIZE = original
+
+    def test_write_records(self):
+        out = cStringIO.StringIO()
+        write_records(self.records(limit=2), 'text', out)
+        self.assertEqual(out.getvalue(), 'caf\xc3\xa9,1\ndb1\n')
+        out = cStringIO.StringIO()
+        write_records(self.records(limit=2), 'nul', out)
+        self.assertEqual(out.getvalue(), 'caf\xc3\xa9,1\0db1\0')
@@ -0,0 +1,60 @@
+import random
+import unittest
+
+from clusto_query.query.operator.affix import Equality, Inequality, ExistsOperator
+
+from fixtures import random_site
+
+
+class MembershipIndexTest(unittest.TestCase):
+    VALUES = {
+        'pool': ['web', 'api', 'db', 'everything', 'nothing'],
+        'datacenter': ['dc1', 'dc2', 'nothing'],
+        'role': ['web', 'api', 'db', 'nothing'],
+        'clusto_type': ['server', 'pool', 'nothing'],
+    }
+
+    def candidate_sets(self, context, rnd):
+        hosts = sorted(context.entity_map)
+        return [hosts, set(rnd.sample(hosts, len(hosts) / 3)), set(hosts[:1]), set()]
+
+    def assertLookupMatchesScan(self, clause, context, candidates):
+        indexed = clause.lookup(candidates, context)
+        self.assertIsNotNone(indexed, clause)
+        self.assertEqual(set(indexed), clause.scan(candidates, context), clause)
+
+    def test_equality_and_inequality(self):
+        for seed in xrange(5):
+            context = random_site(seed)
+            rnd = random.Random(seed)
+            for candidates in self.candidate_sets(context, rnd):
+                for prop, values in sorted(self.VALUES.iteritems()):
+                    for value in values:
+                        for operator in (Equality, Inequality):
+                            self.assertLookupMatchesScan(operator(prop, value), context, candidates)
+
+    def test_exists(self):
+        for seed in xrange(5):
+            context = random_site(seed)
+            for candidates in self.candidate_sets(context, random.Random(seed)):
+                for prop in ('pool', 'datacenter', 'role'):
+                    self.assertLookupMatchesScan(ExistsOperator(prop), context, candidates)
+
+    def test_hosts_without_a_role(self):
+        context = random_site(0)
+        hosts = set(context.entity_map)
+        roleless = set(h for h in hosts if context.role_for_host(h) is None)
+        self.assertTrue(roleless)
+        self.assertTrue(roleless <= Inequality('role', 'web').run(hosts, context))
+        self.assertTrue(roleless <= Inequality('role', 'nothing').run(hosts, context))
+        self.assertFalse(roleless & Equality('role', 'web').run(hosts, context))
+
+    def test_hosts_in_more_than_one_role(self):
+        context = random_site(0)
+        hosts = [h for h in context.entity_map
+                 if set(['web', 'api']) <= set(p.name for p in context.context('pool', h))]
+        self.assertTrue(hosts)
+        for host in hosts:
+            role = context.role_for_host(host)
+            self.assertEqual(Equality('role', role).run([host], context), set([host]))
+            self.assertEqual(Inequality('role', role).run([host], context), set())
@@ -0,0 +1,38 @@
+import unittest
+
+from clusto_query.query.objects import SimpleCidrSet, RFC1918, parse_cidr
+
+
+class SimpleCidrSetTest(unittest.TestCase):
+    def test_rfc1918(self):
+        self.assertTrue('10.1.2.3' in RFC1918)
+        self.assertTrue('172.31.255.255' in RFC1918)
+        self.assertFalse('172.32.0.0' in RFC1918)
+        self.assertTrue('192.168.0.1' in RFC1918)
+        self.assertFalse('8.8.8.8' in RFC1918)
+        self.assertFalse('fd00::1' in RFC1918)
+
+    def test_ipv6(self):
+        cidr_set = SimpleCidrSet()
+        cidr_set.add_cidr('2001:db8::', 32)
+        self.assertTrue('2001:db8::1' in cidr_set)
+        self.assertTrue('2001:db8:ffff::1' in cidr_set)
+        self.assertFalse('2001:db9::1' in cidr_set)
+        self.assertFalse('32.1.13.184' in cidr_set)
+
+    def test_overlapping(self):
+        cidr_set = SimpleCidrSet()
+        cidr_set.add_cidr('10.1.0.0', 16)
+        cidr_set.add_cidr('10.0.0.0', 8)
+        cidr_set.add_cidr('10.2.0.0', 16)
+        self.assertEqual(len(cidr_set.ranges), 1)
+        self.assertTrue('10.3.0.1' in cidr_set)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            '10.0.0.300' in RFC1918
+        with self.assertRaises(ValueError):
+            parse_cidr('10.0.0.0', 33)
+
+    def test_parse_cidr(self):
+        self.assertEqual(parse_cidr('10.2.3.4', 16), (4, 10 << 24 | 2 << 16, 10 << 24 | 2 << 16 | 0xffff))
@@ -0,0 +1,114 @@
+import unittest
+
+from clusto_query import optimizer
+from clusto_query.context import AttributeCounts, ContextKey
+from clusto_query.lexer import lex
+from clusto_query.parser import parse_query
+from clusto_query.query.objects import Attribute
+from clusto_query.query.operator.affix import Equality, GT, LT, Between
+
+
+class FakeContext(object):
+    CONTEXT_TYPES = ('pool', 'datacenter')
+
+    def __init__(self):
+        self.entity_map = dict.fromkeys(ContextKey('server', 's%d' % i) for i in range(1000))
+        self.loaded = set()
+
+    def gather_attribute_counts(self, attributes):
+        pass
+
+    def attribute_counts(self, attribute):
+        return AttributeCounts(1000, 1000, 1000 if attribute.key == 'serial' else 4)
+
+    def attribute_loaded(self, attribute):
+        return attribute.key in self.loaded
+
+    def type_counts(self):
+        return {'server': 500}
+
+    def members(self, typ):
+        return {ContextKey(typ, 'big'): set(list(self.entity_map)[:300])}
+
+
+class SortClausesTest(unittest.TestCase):
+    def setUp(self):
+        self.context = FakeContext()
+        self.serial = Equality(Attribute('serial', None, None), 'abc')
+        self.flag = Equality(Attribute('flag', None, None), 1)
+        self.pool = Equality('pool', 'big')
+        self.server = Equality('clusto_type', 'server')
+
+    def test_cheap_selective_clause_first(self):
+        ordered = optimizer.sort_clauses([self.flag, self.serial, self.server, self.pool], self.context)
+        self.assertEqual(ordered, [self.pool, self.server, self.serial, self.flag])
+
+    def test_loaded_attributes_are_cheap(self):
+        self.context.loaded.add('flag')
+        ordered = optimizer.sort_clauses([self.serial, self.server, self.flag], self.context)
+        self.assertEqual(ordered, [self.flag, self.server, self.serial])
+
+    def test_between(self):
+        memory = Attribute('memory', None, None)
+        merged = optimizer.merge_ranges([GT(memory, 1), self.pool, LT(memory, 5)])
+        self.assertEqual(len(merged), 2)
+        self.assertTrue(isinstance(merged[1], Between))
+        self.assertEqual(optimizer.sort_clauses(merged, self.context)[0], self.pool)
+
+    def test_worth_indexing(self):
+        self.assertTrue(optimizer.worth_indexing(None, 1, 100, 1))
+        self.assertTrue(optimizer.worth_indexing(range(10), optimizer.FETCH_COST, 100, optimizer.LOAD_COST))
+        self.assertFalse(optimizer.worth_indexing(range(10), optimizer.MEMORY_COST, 100, optimizer.INDEX_COST))
+
+
+class CommonSubexpressionTest(unittest.TestCase):
+    def parse(self, query):
+        return parse_query(lex(query))[0]
+
+    def test_canonical_key(self):
+        self.assertEqual(optimizer.canonical_key(self.parse('pool = a and (attr b.c = 1 or name ^ x)')),
+                         optimizer.canonical_key(self.parse('(name ^ x or attr b.c = 1) and pool = a')))
+        self.assertNotEqual(optimizer.canonical_key(self.parse('pool = a - pool = b')),
+                            optimizer.canonical_key(self.parse('pool = b - pool = a')))
+        self.assertNotEqual(optimizer.canonical_key(self.parse('attr b.c = 1')),
+                            optimizer.canonical_key(self.parse('attr b.c = "1"')))
+
+    def test_shares_repeated_subqueries(self):
+        query = optimizer.eliminate_common_subexpressions(
+            self.parse('(pool = a and attr b = 1) or (attr b = 1 and pool = a) or attr b = 1'))
+        first, second, third = query.parameters
+        self.assertTrue(isinstance(first, optimizer.SharedQuery))
+        self.assertTrue(first is second)
+        self.assertTrue(isinstance(third, optimizer.SharedQuery))
+        self.assertTrue(third in first.query.parameters)
+
+    def test_leaves_unique_queries_alone(self):
+        query = self.parse('pool = a and (attr b = 1 or name ^ x)')
+        self.assertTrue(optimizer.eliminate_common_subexpressions(query) is query)
+
+    def test_shares_across_queries(self):
+        first, second = optimizer.share_common_subexpressions(
+            [self.parse('pool = a and attr b = 1'), self.parse('attr b = 1 or name ^ x')])
+        shared = [p for p in first.parameters if isinstance(p, optimizer.SharedQuery)]
+        self.assertEqual(len(shared), 1)
+        self.assertTrue(shared[0] in second.parameters)
+
+
+class EntityTypesTest(unittest.TestCase):
+    def types(self, *queries):
+        return optimizer.entity_types([parse_query(lex(q))[0] for q in queries])
+
+    def test_type_restrictions(self):
+        self.assertEqual(self.types('clusto_type = server and pool = a'), set(['server']))
+        self.assertEqual(self.types('(clusto_type = server or clusto_type = rack) - name = x'),
+                         set(['server', 'rack']))
+        self.assertEqual(self.types('clusto_type = server', 'clusto_type = pool'), set(['server', 'pool']))
+
+    def test_role_needs_pools(self):
+        self.assertEqual(self.types('clusto_type = server and role = web'), set(['server', 'pool']))
+
+    def test_unrestricted(self):
+        self.assertEqual(self.types('pool = a'), None)
+        self.assertEqual(self.types('clusto_type = server or name = x'), None)
+        self.assertEqual(self.types('not clusto_type = server'), None)
+        self.assertEqual(self.types('clusto_type = server', 'pool = a'), None)
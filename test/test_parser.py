@@ -0,0 +1,65 @@
+import unittest
+
+from clusto_query import parser
+from clusto_query.lexer import lex
+from clusto_query.exceptions import ExpectedTokenError, UnexpectedTokenError, StringParseError
+from clusto_query.query.operator.boolean import Intersection, Union, Subtraction
+
+
+class ParserTest(unittest.TestCase):
+    def parse(self, query):
+        return parser.parse_query(lex(query))
+
+    def test_chains_are_flat(self):
+        query, rest = self.parse('pool = a and pool = b and pool = c and pool = d')
+        self.assertEqual(rest, [])
+        self.assertTrue(isinstance(query, Intersection))
+        self.assertEqual(len(query.parameters), 4)
+
+    def test_groups_to_the_right(self):
+        query, _ = self.parse('pool = a and pool = b or pool = c - pool = d - pool = e')
+        self.assertTrue(isinstance(query, Intersection))
+        union = query.parameters[1]
+        self.assertTrue(isinstance(union, Union))
+        subtraction = union.parameters[1]
+        self.assertTrue(isinstance(subtraction, Subtraction))
+        self.assertTrue(isinstance(subtraction.parameters[1], Subtraction))
+
+    def test_parens(self):
+        query, rest = self.parse('(pool = a or pool = b) and pool = c')
+        self.assertEqual(rest, [])
+        self.assertTrue(isinstance(query.parameters[0], Union))
+
+    def test_unparsed(self):
+        query, rest = self.parse('pool = a ) and pool = b')
+        self.assertEqual(rest, [')', 'and', 'pool', '=', 'b'])
+
+    def test_long_chain(self):
+        query, _ = self.parse(' or '.join('name = host%d' % i for i in xrange(5000)))
+        self.assertEqual(len(query.parameters), 5000)
+
+    def test_errors(self):
+        with self.assertRaises(ExpectedTokenError):
+            self.parse('(pool = a')
+        with self.assertRaises(UnexpectedTokenError):
+            self.parse('pool = a and')
+
+    def test_error_columns(self):
+        with self.assertRaisesRegexp(ExpectedTokenError, "expected '\\)', got 'None'\\) at column 10$"):
+            self.parse('(pool = a')
+        with self.assertRaisesRegexp(UnexpectedTokenError, r"\['c'\] at column 24$"):
+            self.parse('pool = a or (pool = b) c')
+        with self.assertRaisesRegexp(UnexpectedTokenError, 'at column 14$'):
+            self.parse('pool = a and ')
+        with self.assertRaisesRegexp(StringParseError, 'at column 13;'):
+            self.parse('pool = a or system.memory = 1')
+        # tokens that didn't come from lex have no columns
+        with self.assertRaisesRegexp(UnexpectedTokenError, r"^\['b'\]$"):
+            parser.parse_query(['pool', '=', 'a', 'b'])
+
+    def test_cache(self):
+        first, _ = parser.cached_parse_query(lex('pool = a and attr b = 1'))
+        second, _ = parser.cached_parse_query(lex('pool=a  and attr b = 1'))
+        self.assertTrue(first is second)
+        third, _ = parser.cached_parse_query(lex('pool = a and attr b = "1"'))
+        self.assertFalse(first is third)
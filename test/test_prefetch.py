@@ -0,0 +1,56 @@
+import clusto
+
+from clusto_query import context as context_module
+from clusto_query.context import Context
+from clusto_query.query.objects import Attribute
+
+from fixtures import ClustoTestCase, build_site
+
+
+ATTRIBUTES = [
+    Attribute('system', 'memory', None), Attribute('system', None, None), Attribute('ip', 'ipstring', None),
+    Attribute('hostname', None, None), Attribute('pooltype', None, None), Attribute('missing', None, None),
+]
+
+
+class PrefetchAttributesTest(ClustoTestCase):
+    def setUp(self):
+        super(PrefetchAttributesTest, self).setUp()
+        build_site()
+        self.hosts = sorted(Context(clusto).entity_map)
+
+    def values(self, context, hosts):
+        return dict(((a.key, a.subkey, h), a.get(h, context)) for a in ATTRIBUTES for h in hosts)
+
+    def assertMatchesDrivers(self, context, hosts):
+        self.assertEqual(self.values(context, hosts), self.values(Context(clusto), hosts))
+
+    def test_every_host(self):
+        context = Context(clusto)
+        context.prefetch_attributes(ATTRIBUTES)
+        for attribute in ATTRIBUTES:
+            self.assertTrue(context.attribute_loaded(attribute))
+        self.assertMatchesDrivers(context, self.hosts)
+
+    def test_batches_of_hosts(self):
+        original = context_module.PREFETCH_BATCH_SIZE
+        context_module.PREFETCH_BATCH_SIZE = 3
+        try:
+            context = Context(clusto)
+            some = self.hosts[::2]
+            context.prefetch_attributes(ATTRIBUTES, some)
+            for attribute in ATTRIBUTES:
+                self.assertFalse(context.attribute_loaded(attribute))
+            self.assertEqual(context.attribute_values(self.hosts[1], 'system', 'memory'), None)
+            self.assertMatchesDrivers(context, some)
+            # the rest are loaded without loading the first ones twice
+            context.prefetch_attributes(ATTRIBUTES, self.hosts)
+            self.assertMatchesDrivers(context, self.hosts)
+        finally:
+            context_module.PREFETCH_BATCH_SIZE = original
+
+    def test_subkeys_of_a_loaded_key(self):
+        context = Context(clusto)
+        context.prefetch_attributes([Attribute('system', None, None)])
+        self.assertTrue(context.attribute_loaded(Attribute('system', 'memory', None)))
+        self.assertMatchesDrivers(context, self.hosts)
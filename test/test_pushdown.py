@@ -0,0 +1,77 @@
+import clusto
+from clusto.drivers import BasicServer, Pool
+
+from clusto_query.context import Context
+from clusto_query.pushdown import PushedDownQuery, compile_clause, push_down
+
+from fixtures import ClustoTestCase, parse
+
+
+class PushDownTest(ClustoTestCase):
+    def setUp(self):
+        super(PushDownTest, self).setUp()
+        pool = Pool('web')
+        memories = [4096, 8192, '8192', 'lots', '16', '1.5', None, 16384]
+        owners = ['ops_team', 'ops%', 'dev', u'Ops', 'OPS', None, 'ops', '']
+        servers = [BasicServer('s%d' % i) for i in range(len(memories))]
+        for i, (server, memory, owner) in enumerate(zip(servers, memories, owners)):
+            if memory is not None:
+                server.add_attr('system', subkey='memory', value=memory)
+            if owner is not None:
+                server.add_attr('owner', value=owner)
+            if i % 2:
+                pool.insert(server)
+        # multi-valued, with an int and a string
+        servers[4].add_attr('system', subkey='memory', value=2048)
+        servers[7].add_attr('system', subkey='memory', value='big')
+        self.context = Context(clusto)
+
+    def run_query(self, query):
+        return set(self.context.run_query(query))
+
+    def assertSuperset(self, raw_query):
+        query = parse(raw_query)
+        whereclause = compile_clause(query)
+        self.assertIsNotNone(whereclause, raw_query)
+        expected = self.run_query(query)
+        self.assertEqual(self.run_query(PushedDownQuery(query, whereclause)), expected, raw_query)
+        self.assertEqual(self.run_query(push_down(query)), expected, raw_query)
+
+    def test_equality(self):
+        for raw_query in ('attr system.memory = 4096', 'attr system.memory = 8192', 'attr system.memory = 16',
+                          'attr system.memory = 1.5', 'attr system.memory = lots', 'attr system.memory = "8192"',
+                          'attr owner = ops', 'attr owner = "ops%"', 'name = s3', 'clusto_type = server'):
+            self.assertSuperset(raw_query)
+
+    def test_inequality(self):
+        for raw_query in ('clusto_type = server and attr system.memory != 4096',
+                          'clusto_type = server and attr owner != ops',
+                          'name ^ s and name != s1'):
+            self.assertSuperset(raw_query)
+
+    def test_range(self):
+        for raw_query in ('attr system.memory > 4096', 'attr system.memory >= 4096', 'attr system.memory < 8192',
+                          'attr system.memory <= 16', 'attr system.memory > 1', 'attr system.memory < 2.5',
+                          'attr system.memory > 1000 and attr system.memory < 10000'):
+            self.assertSuperset(raw_query)
+
+    def test_affix(self):
+        for raw_query in ('name ^ s1', 'name , "3"', 'name contains "_"', 'attr owner ^ ops', 'attr owner , "%"',
+                          'attr owner contains _', 'attr owner contains "%"', 'attr owner contains P'):
+            self.assertSuperset(raw_query)
+
+    def test_not(self):
+        for raw_query in ('clusto_type = server and not attr system.memory > 5000',
+                          'attr owner exists and not attr owner ^ ops',
+                          'name ^ s and (not pool = web)'):
+            self.assertSuperset(raw_query)
+
+    def test_subtraction(self):
+        for raw_query in ('attr system.memory > 1000 - name ^ s1', 'attr system.memory exists - attr owner = ops',
+                          '(attr owner ^ o or name = s2) - attr system.memory < 5000'):
+            self.assertSuperset(raw_query)
+
+    def test_unions_need_every_branch(self):
+        self.assertIsNone(compile_clause(parse('attr owner = ops or pool = web')))
+        self.assertEqual(self.run_query(push_down(parse('attr owner = ops or pool = web'))),
+                         self.run_query(parse('attr owner = ops or pool = web')))
@@ -0,0 +1,105 @@
+import clusto
+from clusto.drivers import BasicServer, Pool
+
+from clusto_query import context as context_module
+from clusto_query.context import Context
+
+from fixtures import ClustoTestCase, build_site, parse
+
+
+QUERIES = [
+    'pool = web', 'pool = db', 'pool = everything', 'pool = extra', 'role = web', 'role = api', 'role = db',
+    'role != api', 'datacenter = dc1', 'datacenter = dc2', 'rack = r2', 'clusto_type = server', 'name ^ s1',
+    'hostname , .com', 'attr system.memory > 5000', 'attr system.memory = 4096', 'hostname contains st1',
+    'attr ip.ipstring in_cidr 10.0.0.0/16', 'attr system.memory exists - pool = web',
+]
+
+
+class RefreshTest(ClustoTestCase):
+    def setUp(self):
+        super(RefreshTest, self).setUp()
+        self.drivers = build_site()
+
+    def results(self, context):
+        return [set(context.run_query(parse(q))) for q in QUERIES]
+
+    def loaded_context(self):
+        """ A Context that has loaded everything QUERIES need, and built their indexes """
+        context = Context(clusto)
+        self.results(context)
+        context.column_store()
+        return context
+
+    def assertRefreshes(self, context):
+        self.assertTrue(context.refresh(clusto.get_latest_version_number()))
+        self.assertEqual(context.version, clusto.get_latest_version_number())
+        self.assertEqual(self.results(context), self.results(Context(clusto)))
+
+    def test_added(self):
+        context = self.loaded_context()
+        server = BasicServer('s10')
+        server.add_attr('system', subkey='memory', value=8192)
+        server.set_attr('hostname', 'host10.example.com')
+        self.drivers['web'].insert(server)
+        self.drivers['r2'].insert(server, 10)
+        extra = Pool('extra')
+        extra.insert(self.drivers['s0'])
+        self.assertRefreshes(context)
+
+    def test_removed(self):
+        context = self.loaded_context()
+        clusto.delete_entity(self.drivers['s3'].entity)
+        clusto.delete_entity(self.drivers['api'].entity)
+        self.assertRefreshes(context)
+
+    def test_reparented(self):
+        context = self.loaded_context()
+        self.drivers['db'].remove(self.drivers['s5'])
+        self.drivers['web'].insert(self.drivers['s5'])
+        self.drivers['everything'].remove(self.drivers['web'])
+        self.drivers['everything'].insert(self.drivers['api'])
+        self.drivers['dc1'].remove(self.drivers['r1'])
+        self.drivers['dc2'].insert(self.drivers['r1'])
+        self.assertRefreshes(context)
+
+    def test_changed_attributes(self):
+        context = self.loaded_context()
+        self.drivers['s0'].set_attr('system', subkey='memory', value=65536)
+        self.drivers['s5'].del_attrs('system', subkey='memory')
+        self.drivers['s8'].add_attr('system', subkey='memory', value='lots')
+        self.drivers['s1'].set_attr('hostname', 'renamed.example.org')
+        self.drivers['db'].add_attr('pooltype', 'role')
+        self.drivers['s2'].del_attrs('ip')
+        self.assertRefreshes(context)
+
+    def test_everything_at_once(self):
+        context = self.loaded_context()
+        BasicServer('s10').add_attr('system', subkey='memory', value=4096)
+        clusto.delete_entity(self.drivers['s9'].entity)
+        self.drivers['web'].remove(self.drivers['s0'])
+        self.drivers['api'].insert(self.drivers['s0'])
+        self.drivers['s4'].set_attr('system', subkey='memory', value=1)
+        self.assertRefreshes(context)
+
+    def test_deleted_and_recreated(self):
+        context = self.loaded_context()
+        clusto.delete_entity(self.drivers['s2'].entity)
+        server = BasicServer('s2')
+        server.add_attr('system', subkey='memory', value=99999)
+        self.drivers['db'].insert(server)
+        self.assertRefreshes(context)
+
+    def test_unusable(self):
+        context = Context(clusto)
+        version = context.version
+        self.assertTrue(context.refresh(version))
+        self.assertFalse(context.refresh(version - 1))
+        for i in xrange(3):
+            BasicServer('new%d' % i)
+        original = context_module.REFRESH_MAX_CHANGES
+        context_module.REFRESH_MAX_CHANGES = 2
+        try:
+            self.assertFalse(context.refresh(clusto.get_latest_version_number()))
+        finally:
+            context_module.REFRESH_MAX_CHANGES = original
+        self.assertEqual(context.version, version)
@@ -0,0 +1,52 @@
+import clusto
+from clusto.drivers import BasicServer, Pool
+
+from clusto_query.context import Context, ContextKey
+
+from fixtures import ClustoTestCase, parse
+
+
+class RoleTest(ClustoTestCase):
+    def setUp(self):
+        super(RoleTest, self).setUp()
+        self.pools = {}
+        for name in ('zeta', 'alpha', 'mid', 'plain'):
+            self.pools[name] = Pool(name)
+            if name != 'plain':
+                self.pools[name].add_attr('pooltype', 'role')
+        # the same pools, joined in different orders
+        for server, pools in (('s0', ['zeta', 'alpha']), ('s1', ['alpha', 'zeta']), ('s2', ['plain', 'mid', 'zeta']),
+                              ('s3', ['plain']), ('s4', ['zeta'])):
+            server = BasicServer(server)
+            for pool in pools:
+                self.pools[pool].insert(server)
+
+    def roles(self, context):
+        return dict((name, context.role_for_host(ContextKey('server', name)))
+                    for name in ('s0', 's1', 's2', 's3', 's4'))
+
+    def names(self, context, raw_query):
+        return set(h.name for h in context.run_query(parse(raw_query)))
+
+    def test_first_role_by_name(self):
+        context = Context(clusto)
+        self.assertEqual(self.roles(context), {'s0': 'alpha', 's1': 'alpha', 's2': 'mid', 's3': None, 's4': 'zeta'})
+        self.assertEqual(self.names(context, 'role = alpha'), set(['s0', 's1']))
+        self.assertEqual(self.names(context, 'role = zeta'), set(['s4']))
+        self.assertEqual(self.names(context, 'role = mid'), set(['s2']))
+        self.assertEqual(self.names(context, 'clusto_type = server and role != zeta'), set(['s0', 's1', 's2', 's3']))
+
+    def test_same_after_refresh_and_snapshot(self):
+        context = Context(clusto)
+        self.roles(context)
+        # a new role pool that sorts first, for a host that already has a role
+        aardvark = Pool('aardvark')
+        aardvark.add_attr('pooltype', 'role')
+        aardvark.insert(clusto.get_by_name('s4'))
+        self.assertTrue(context.refresh(clusto.get_latest_version_number()))
+        fresh = Context(clusto)
+        restored = Context(clusto, snapshot=context.to_snapshot())
+        for other in (context, restored):
+            self.assertEqual(self.roles(other), self.roles(fresh))
+            self.assertEqual(self.names(other, 'role = zeta'), self.names(fresh, 'role = zeta'))
+        self.assertEqual(fresh.role_for_host(ContextKey('server', 's4')), 'aardvark')
@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from clusto_query import server
+
+
+class QueryServerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'daemon.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def serve(self, answer, requests):
+        query_server = server.QueryServer(self.path, answer)
+
+        def handle():
+            for _ in xrange(requests):
+                query_server.handle_request()
+
+        thread = threading.Thread(target=handle)
+        thread.start()
+        return query_server, thread
+
+    def test_round_trip(self):
+        query_server, thread = self.serve(lambda request: {'output': [request['query'].upper()]}, 2)
+        try:
+            self.assertEqual(server.send_request(self.path, {'query': 'pool = a'}), {'output': ['POOL = A']})
+            self.assertEqual(server.send_request(self.path, {}), {'error': "KeyError: 'query'"})
+        finally:
+            thread.join()
+            query_server.server_close()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_no_daemon(self):
+        self.assertEqual(server.send_request(self.path, {'query': 'pool = a'}), None)
+
+    def test_stale_socket(self):
+        query_server = server.QueryServer(self.path, None)
+        query_server.socket.close()
+        # the file is left behind but nothing is listening
+        self.assertEqual(server.send_request(self.path, {}), None)
+        query_server, thread = self.serve(lambda request: {'ok': True}, 1)
+        try:
+            self.assertEqual(server.send_request(self.path, {}), {'ok': True})
+        finally:
+            thread.join()
+            query_server.server_close()
@@ -0,0 +1,122 @@
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import cStringIO
+import cPickle as pickle
+
+import clusto
+from clusto.drivers import BasicServer
+
+import clusto_query
+from clusto_query import context as context_module
+from clusto_query import snapshot
+from clusto_query.context import Context
+from clusto_query.scripts import main
+
+from fixtures import ClustoTestCase, build_site, clusto_config, parse
+
+
+QUERIES = [
+    'pool = web', 'pool = everything', 'role = api', 'role != web', 'datacenter = dc2', 'rack = r1',
+    'attr system.memory > 5000', 'attr system.memory = 4096 - pool = db', 'name ^ s1', 'hostname , example.com',
+    'attr ip.ipstring in_cidr 8.0.0.0/8',
+]
+
+
+class SnapshotTest(ClustoTestCase):
+    def setUp(self):
+        super(SnapshotTest, self).setUp()
+        build_site()
+        self.directory = tempfile.mkdtemp()
+        self.dsn = 'sqlite:///clusto.db'
+        self.path = snapshot.snapshot_path(self.directory, self.dsn)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(SnapshotTest, self).tearDown()
+
+    def results(self, context):
+        return [set(context.run_query(parse(q))) for q in QUERIES]
+
+    def test_round_trip(self):
+        context = Context(clusto)
+        expected = self.results(context)
+        snapshot.save(self.path, self.dsn, context.to_snapshot())
+        restored = Context(clusto, snapshot=snapshot.load(self.path, self.dsn))
+        self.assertFalse(restored.modified)
+        self.assertEqual(restored.version, context.version)
+        self.assertEqual(restored.attribute_map, context.attribute_map)
+        self.assertEqual(restored.contents_dict, context.contents_dict)
+        self.assertEqual(self.results(restored), expected)
+
+    def test_round_trip_before_anything_is_loaded(self):
+        context = Context(clusto)
+        snapshot.save(self.path, self.dsn, context.to_snapshot())
+        restored = Context(clusto, snapshot=snapshot.load(self.path, self.dsn))
+        self.assertEqual(self.results(restored), self.results(context))
+
+    def test_other_database(self):
+        snapshot.save(self.path, self.dsn, Context(clusto).to_snapshot())
+        self.assertIsNotNone(snapshot.load(self.path, self.dsn))
+        self.assertIsNone(snapshot.load(self.path, 'sqlite:///other.db'))
+        self.assertNotEqual(snapshot.snapshot_path(self.directory, 'sqlite:///other.db'), self.path)
+
+    def test_stale_format(self):
+        with open(self.path, 'wb') as f:
+            pickle.dump((snapshot.SNAPSHOT_FORMAT - 1, clusto_query.__version__, snapshot.dsn_digest(self.dsn)), f)
+            pickle.dump(Context(clusto).to_snapshot(), f)
+        self.assertIsNone(snapshot.load(self.path, self.dsn))
+
+    def test_missing_or_corrupt(self):
+        self.assertIsNone(snapshot.load(self.path, self.dsn))
+        with open(self.path, 'wb') as f:
+            f.write('not a pickle')
+        self.assertIsNone(snapshot.load(self.path, self.dsn))
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_worth_saving(self):
+        context = Context(clusto)
+        self.assertTrue(context.worth_saving())
+        context.run_query(parse('pool = web'))
+        restored = Context(clusto, snapshot=context.to_snapshot())
+        self.assertFalse(restored.worth_saving())
+        restored.run_query(parse('attr system.memory > 5000'))
+        self.assertTrue(restored.modified)
+        self.assertFalse(restored.worth_saving())
+        original = context_module.SNAPSHOT_MIN_NEW_ROWS
+        context_module.SNAPSHOT_MIN_NEW_ROWS = restored.unsaved_rows
+        try:
+            self.assertTrue(restored.worth_saving())
+        finally:
+            context_module.SNAPSHOT_MIN_NEW_ROWS = original
+        BasicServer('s10')
+        restored = Context(clusto, snapshot=context.to_snapshot())
+        self.assertTrue(restored.refresh(clusto.get_latest_version_number()))
+        self.assertTrue(restored.worth_saving())
+
+    def test_runs_rewrite_only_what_is_worth_it(self):
+        opts = optparse.Values({
+            'formatter': '%name', 'output_format': 'text', 'limit': None, 'unsorted': False, 'count': False,
+            'no_pushdown': False, 'engine': 'compiled', 'no_cache': False, 'cache_dir': self.directory,
+        })
+        saved = []
+        save = snapshot.save
+        snapshot.save = lambda *args: saved.append(args) or save(*args)
+        stdout, sys.stdout = sys.stdout, cStringIO.StringIO()
+        try:
+            def run(*raw_queries):
+                del saved[:]
+                self.assertEqual(main.run_batch(list(raw_queries), opts, clusto_config(self.dsn), None), 0)
+                return len(saved)
+            self.assertEqual(run('pool = web', 'attr system.memory > 5000'), 1)
+            # nothing new, or too little to be worth it
+            self.assertEqual(run('pool = web', 'attr system.memory > 5000'), 0)
+            self.assertEqual(run('hostname , example.com'), 0)
+            BasicServer('s10')
+            self.assertEqual(run('pool = web'), 1)
+            self.assertEqual(run('pool = web'), 0)
+        finally:
+            snapshot.save = save
+            sys.stdout = stdout